@@ -25,7 +25,7 @@ import pyarrow.parquet as pq
 import shutil
 print("Run Section 1 Import Libraries and Set Global Parameters...")
 begin_time = datetime.now()
-import os, sys, pandas as pd, geopandas as gpd
+import os, sys, pandas as pd
 
 if not sys.warnoptions:
     import warnings
@@ -71,6 +71,7 @@ analysis_routes = q_jump_route_list
 analysis_days = ['Monday']
 wmata_crs = 2248
 
+
 # 1.3 Import User-Defined Package
 ############################################
 import wmatarawnav as wr
@@ -92,13 +93,13 @@ wmata_schedule_dat = (
     .reset_index(drop=True)
 )
 
-wmata_schedule_gdf = (
-    gpd.GeoDataFrame(
-        wmata_schedule_dat, 
-        geometry = gpd.points_from_xy(wmata_schedule_dat.stop_lon,wmata_schedule_dat.stop_lat),
-        crs='EPSG:4326'
+# Stop coordinates projected to wmata_crs, to match the rawnav x_ft/y_ft columns
+wmata_schedule_xy_dat = (
+    wr.add_projected_xy(
+        wmata_schedule_dat,
+        crs_to = "EPSG:{}".format(wmata_crs),
+        lonlat_cols = ['stop_lon', 'stop_lat']
     )
-    .to_crs(epsg=wmata_crs)
 )
 
 # Make Output Directory
@@ -122,9 +123,9 @@ for analysis_route in analysis_routes:
                 wr.read_cleaned_rawnav(
                    analysis_routes_ = analysis_route,
                    analysis_days_ = analysis_day,
-                   path = os.path.join(path_processed_data, "rawnav_data.parquet")
+                   path = os.path.join(path_processed_data, "rawnav_data.parquet"),
+                   columns = wr.rawnav_data_cols + ['x_ft', 'y_ft']
                 )
-                .drop(columns=['blank', 'lat_raw', 'long_raw', 'sat_cnt'])
             )
         except Exception as e:
             print(e)  # usually no data found or something similar
@@ -148,22 +149,15 @@ for analysis_route in analysis_routes:
                                                 on=['filename', 'index_run_start'],
                                                 how='right')
 
-            rawnav_qjump_gdf = (
-                gpd.GeoDataFrame(
-                    rawnav_qjump_dat,
-                    geometry=gpd.points_from_xy(rawnav_qjump_dat.long, rawnav_qjump_dat.lat),
-                    crs='EPSG:4326'
-                )
-                .to_crs(epsg=wmata_crs)
-            )
-
         stop_summary, stop_index = (
             wr.merge_rawnav_wmata_schedule(
                 analysis_route_=analysis_route,
                 analysis_day_=analysis_day,
-                rawnav_dat_=rawnav_qjump_gdf,
+                rawnav_dat_=rawnav_qjump_dat,
                 rawnav_sum_dat_=rawnav_summary_dat,
-                wmata_schedule_dat_=wmata_schedule_gdf
+                wmata_schedule_dat_=wmata_schedule_xy_dat,
+                xy_cols=['x_ft', 'y_ft'],
+                unit='ft'
             )
         )
         
@@ -197,7 +191,7 @@ for analysis_route in analysis_routes:
             ignore_errors=True
         ) 
         
-        stop_index = wr.drop_geometry(stop_index)
+        stop_index = wr.drop_geometry(stop_index).drop(columns=['x_ft', 'y_ft'], errors='ignore')
         
         stop_index = stop_index.assign(wday=analysis_day)
                 
@@ -73,6 +73,12 @@ analysis_routes = q_jump_route_list
 
 run_inventory = False # inventory (or re-inventory files), otherwise reload saved inventory if available
 run_existing = False # whether to redo outputs that currently exist or skip over them
+inventory_workers = 1 # number of processes used to inventory files, None to use all cores
+use_inventory_cache = True # when run_inventory, only search files that are new or changed since the last inventory
+read_analysis_runs_only = True # read only the runs on analysis_routes from each file, rather than the whole file
+clean_workers = 1 # number of processes used to load and clean files, None to use all cores
+stream_output = False # write each file as it's cleaned, rather than holding all cleaned files in memory 
+output_schema_version = 3 # version of wr.rawnav_data_schema used for rawnav_data.parquet, 2 is more compact, 3 adds projected x_ft/y_ft
 
 # 1.3 Import User-Defined Package
 ############################################
@@ -91,7 +97,16 @@ zipped_files_dir_parent = os.path.join(path_source_data, "October 2019 Rawnav")
 file_universe = glob.glob(os.path.join(zipped_files_dir_parent, "*.txt.zip"))
 
 if run_inventory: 
-    rawnav_inventory = wr.find_rawnav_routes(file_universe, nmax=restrict_n, quiet=True)
+    if use_inventory_cache:
+        path_inventory_cache = os.path.join(path_processed_data, "rawnav_inventory_cache.parquet")
+    else:
+        path_inventory_cache = None
+        
+    rawnav_inventory = wr.find_rawnav_routes(file_universe, 
+                                             nmax=restrict_n, 
+                                             quiet=True,
+                                             workers=inventory_workers,
+                                             path_inventory_cache=path_inventory_cache)
     
     path_rawnav_inventory = os.path.join(path_processed_data,"rawnav_inventory.parquet")
     shutil.rmtree(path_rawnav_inventory, ignore_errors=True) 
@@ -134,155 +149,156 @@ if len(rawnav_inventory_filtered) == 0:
 execution_time = str(datetime.now() - begin_time).split('.')[0]
 print("Run Time Section 2 Identify Relevant Files for Analysis Routes : {}".format(execution_time))
 
-# 3 Load Raw RawNav data
+# 3 Load and Clean RawNav data
 ########################################################################################################################
 begin_time = datetime.now()
-# data is loaded into a dictionary named by the ID
-route_rawnav_tag_dict = {}
-
-# Iterate over each file, skipping to the first row where data in our filtered inventory is found
-# Rather than read run-by-run, we read the rest of the file, then filter to relevant routes later
-rawnav_inv_filt_first = rawnav_inventory_filtered.groupby(['fullpath', 'filename']).line_num.min().reset_index()
-rawnav_inventory_filtered_valid = rawnav_inventory_filtered
-
-for index, row in rawnav_inv_filt_first.iterrows():
-    tag_info_line_no = rawnav_inventory_filtered[rawnav_inventory_filtered['filename'] == row['filename']]
-    reference = min(tag_info_line_no.line_num)
-    # -1 refers to the fact that the tag line identifying the start of a run will be removed, such
-    # that the second row associated with a run will become the first row of data. This helps to 
-    # ensure that indices of the processed data will line up with values in the rawnav inventory
-    tag_info_line_no.loc[:, "new_line_no"] = tag_info_line_no.line_num - reference - 1
-    temp = wr.load_rawnav_data(
-        zip_folder_path=row['fullpath'],
-        skiprows=row['line_num'])
-
-    if type(temp) != type(None):
-        route_rawnav_tag_dict[row['filename']] = dict(RawData=temp, tagLineInfo=tag_info_line_no)
-    else:
-        remove_file = row['filename']  
-        rawnav_inventory_filtered_valid  = rawnav_inventory_filtered_valid.query('filename!= @remove_file')
-
-execution_time = str(datetime.now() - begin_time).split('.')[0]
-print("Run Time Section 3 Load Raw RawNav Data : {}".format(execution_time))
-
-# 4 Clean RawNav data
-########################################################################################################################
-begin_time = datetime.now()  ##
 
-rawnav_data_dict = {}
-summary_data_dict = {}
+# Each file is read from the first row where data in our filtered inventory is found and cleaned.
+# If read_analysis_runs_only, the byte offsets in the inventory are used to read only the runs on 
+# analysis routes. Otherwise we read the rest of the file, then filter to relevant routes later.
+# Inventories saved before byte offsets were added are read the latter way.
+# Files that can't be read are dropped from rawnav_inventory_filtered_valid.
+read_analysis_runs_only = read_analysis_runs_only and ('byte_offset' in rawnav_inventory_filtered.columns)
 
-for key, datadict in route_rawnav_tag_dict.items():
-    temp_dat = wr.clean_rawnav_data(
-        data_dict=datadict,
-        filename=key)
+# 3.1 Stream Output
+############################################
+# If stream_output, each file is loaded, cleaned and written to the outputs in section 4 before the next
+# is read, so cleaned files aren't held in memory, and the in-memory load and output below are skipped.
+if stream_output:
+    path_summary_rawnav = os.path.join(path_processed_data,"rawnav_summary.parquet")
+    path_rawnav_data = os.path.join(path_processed_data, "rawnav_data.parquet")
+
+    # Output routes where either output is missing, or all routes if run_existing
+    stream_routes = [
+        analysis_route for analysis_route in analysis_routes
+        if run_existing 
+        or not os.path.isdir(os.path.join(path_summary_rawnav,"route={}".format(analysis_route)))
+        or not os.path.isdir(os.path.join(path_rawnav_data,"route={}".format(analysis_route)))
+    ]
+    
+    if len(stream_routes) > 0:
+        rawnav_inventory_filtered_valid = wr.write_clean_rawnav_files(
+            rawnav_inventory_filtered,
+            analysis_routes=stream_routes,
+            path_rawnav_data=path_rawnav_data,
+            path_summary_rawnav=path_summary_rawnav,
+            read_analysis_runs_only=read_analysis_runs_only,
+            workers=clean_workers,
+            schema_version=output_schema_version)
+    else:
+        print('skipping output of {}'.format(analysis_routes))
 
-    rawnav_data_dict[key] = temp_dat['rawnavdata']
-    summary_data_dict[key] = temp_dat['summary_data']     
+    execution_time = str(datetime.now() - begin_time).split('.')[0]
+    print("Run Time Section 3 Load, Clean and Output RawNav Data : {}".format(execution_time))
 
-route_rawnav_tag_dict = None
+# 3.2 Load in Memory
+############################################
+else:
+    rawnav_data_dict, summary_data_dict, rawnav_inventory_filtered_valid = wr.clean_rawnav_files(
+        rawnav_inventory_filtered,
+        analysis_routes=analysis_routes if read_analysis_runs_only else None,
+        workers=clean_workers)
 
-execution_time = str(datetime.now() - begin_time).split('.')[0]
-print("Run Time Section 4 Clean RawNav Data : {}".format(execution_time))
+    execution_time = str(datetime.now() - begin_time).split('.')[0]
+    print("Run Time Section 3 Load and Clean RawNav Data : {}".format(execution_time))
 
-# 5 Output
+# 4 Output
 ########################################################################################################################
-begin_time = datetime.now()  
-# 5.1 Output Summary Rawnav data
-############################################
+# If stream_output, outputs were already written in section 3.1
+if not stream_output:
+    begin_time = datetime.now()  
+    # 4.1 Output Summary Rawnav data
+    ############################################
 
-# Combine summary files, filter to analysis routes, convert col types once NAs removed
-summary_rawnav = pd.concat(summary_data_dict.values())
+    # Combine summary files, filter to analysis routes, convert col types once NAs removed
+    summary_rawnav = pd.concat(summary_data_dict.values())
 
-summary_rawnav = summary_rawnav[summary_rawnav['route'].isin(analysis_routes)]
-summary_rawnav = summary_rawnav.assign(
-    route=lambda x: x.route.astype('str'),
-    pattern=lambda x: x.pattern.astype('int32'))
+    summary_rawnav = summary_rawnav[summary_rawnav['route'].isin(analysis_routes)]
+    summary_rawnav = summary_rawnav.assign(
+        route=lambda x: x.route.astype('str'),
+        pattern=lambda x: x.pattern.astype('int32'))
 
-# Remove duplicate runs
-summary_rawnav = summary_rawnav[
-    ~summary_rawnav.duplicated(['filename', 'index_run_start'], keep='last')]  
+    # Remove duplicate runs
+    summary_rawnav = summary_rawnav[
+        ~summary_rawnav.duplicated(['filename', 'index_run_start'], keep='last')]  
 
-# Output Summary Files
-path_summary_rawnav = os.path.join(path_processed_data,"rawnav_summary.parquet")
+    # Output Summary Files
+    path_summary_rawnav = os.path.join(path_processed_data,"rawnav_summary.parquet")
 
-if not os.path.isdir(path_summary_rawnav):
-    os.mkdir(path_summary_rawnav)
+    if not os.path.isdir(path_summary_rawnav):
+        os.mkdir(path_summary_rawnav)
       
-for analysis_route in analysis_routes:
+    for analysis_route in analysis_routes:
     
-    path_summary_route = os.path.join(path_summary_rawnav,"route={}".format(analysis_route))
+        path_summary_route = os.path.join(path_summary_rawnav,"route={}".format(analysis_route))
     
-    if (os.path.isdir(path_summary_route) and run_existing) or (not os.path.isdir(path_summary_route)): 
-        shutil.rmtree(os.path.join(path_summary_route), ignore_errors=True) 
+        if (os.path.isdir(path_summary_route) and run_existing) or (not os.path.isdir(path_summary_route)): 
+            shutil.rmtree(os.path.join(path_summary_route), ignore_errors=True) 
            
-        summary_rawnav_fil = summary_rawnav.query('route == @analysis_route')
-        
-        table_summary = pa.Table.from_pandas(summary_rawnav_fil,
-                                             schema = wr.rawnav_summary_schema())
+            summary_rawnav_fil = summary_rawnav.query('route == @analysis_route')
         
-        pq.write_to_dataset(table_summary, 
-                            root_path=os.path.join(path_summary_rawnav),
-                            partition_cols=['route','wday'])
-    else:
-        print('skipping summary output of {}'.format(analysis_route))
+            wr.write_rawnav_dataset(summary_rawnav_fil,
+                                    root_path=os.path.join(path_summary_rawnav),
+                                    schema=wr.rawnav_summary_schema(),
+                                    partition_cols=['route','wday'])
+        else:
+            print('skipping summary output of {}'.format(analysis_route))
     
-# 5.2 Output Processed Rawnav data
-############################################
-# Export Data
-path_rawnav_data = os.path.join(path_processed_data, "rawnav_data.parquet")
+    # 4.2 Output Processed Rawnav data
+    ############################################
+    # Export Data
+    path_rawnav_data = os.path.join(path_processed_data, "rawnav_data.parquet")
 
-if not os.path.isdir(path_rawnav_data):
-    os.mkdir(path_rawnav_data)
+    if not os.path.isdir(path_rawnav_data):
+        os.mkdir(path_rawnav_data)
 
-for analysis_route in analysis_routes:
+    for analysis_route in analysis_routes:
     
-    path_rawnav_route = os.path.join(path_rawnav_data,"route={}".format(analysis_route))
+        path_rawnav_route = os.path.join(path_rawnav_data,"route={}".format(analysis_route))
     
-    if (os.path.isdir(path_rawnav_route) and run_existing) or (not os.path.isdir(path_rawnav_route)): 
-        shutil.rmtree(os.path.join(path_rawnav_route), ignore_errors=True) 
+        if (os.path.isdir(path_rawnav_route) and run_existing) or (not os.path.isdir(path_rawnav_route)): 
+            shutil.rmtree(os.path.join(path_rawnav_route), ignore_errors=True) 
     
-        # Merge Cleaned Rawnav Files Containing The Analysis Route
-        out_rawnav_dat = wr.subset_rawnav_run(
-            rawnav_data_dict_=rawnav_data_dict,
-            rawnav_inventory_filtered_valid_=rawnav_inventory_filtered_valid,
-            analysis_routes_=analysis_route)
+            # Merge Cleaned Rawnav Files Containing The Analysis Route
+            out_rawnav_dat = wr.subset_rawnav_run(
+                rawnav_data_dict_=rawnav_data_dict,
+                rawnav_inventory_filtered_valid_=rawnav_inventory_filtered_valid,
+                analysis_routes_=analysis_route)
         
-        if out_rawnav_dat.shape == (0, 0):
-            continue
+            if out_rawnav_dat.shape == (0, 0):
+                continue
         
-        # Join Additional Identifying Information
-        temp = summary_rawnav.query('route == @analysis_route')\
-            [['filename', 'index_run_start', 'wday', 'start_date_time']]
+            # Join Additional Identifying Information
+            temp = summary_rawnav.query('route == @analysis_route')\
+                [['filename', 'index_run_start', 'wday', 'start_date_time']]
                 
-        out_rawnav_dat = out_rawnav_dat.merge(temp, 
-                                              on=['filename', 'index_run_start'], 
-                                              how='left')
+            out_rawnav_dat = out_rawnav_dat.merge(temp, 
+                                                  on=['filename', 'index_run_start'], 
+                                                  how='left')
     
-        assert (out_rawnav_dat.groupby(['filename', 'index_run_start', 'index_loc'])['index_loc'].
-                count().values.max() == 1)
+            assert (out_rawnav_dat.groupby(['filename', 'index_run_start', 'index_loc'])['index_loc'].
+                    count().values.max() == 1)
         
-        # Column conversion after missing values removed
-        out_rawnav_dat = out_rawnav_dat.assign(
-            route=lambda x: x.route.astype('str'),
-            #should be okay as int32 if everything goes to plan, but for safety will keep as double
-            # and convert pattern later
-            pattern=lambda x: x.pattern.astype('double')) 
+            # Column conversion after missing values removed
+            out_rawnav_dat = out_rawnav_dat.assign(
+                route=lambda x: x.route.astype('str'),
+                #should be okay as int32 if everything goes to plan, but for safety will keep as double
+                # and convert pattern later
+                pattern=lambda x: x.pattern.astype('double')) 
     
-        # Output    
-        shutil.rmtree(os.path.join(path_rawnav_data,"route={}".format(analysis_route)), ignore_errors=True) 
+            # Output    
+            shutil.rmtree(os.path.join(path_rawnav_data,"route={}".format(analysis_route)), ignore_errors=True) 
                 
-        table = pa.Table.from_pandas(out_rawnav_dat,
-                                     schema = wr.rawnav_data_schema())
-        
-        pq.write_to_dataset(table, 
-                            root_path=os.path.join(path_rawnav_data),
-                            partition_cols=['route','wday'])
-    else:
-        print('skipping output of {}'.format(analysis_route))
+            wr.write_rawnav_dataset(out_rawnav_dat,
+                                    root_path=os.path.join(path_rawnav_data),
+                                    schema=wr.rawnav_data_schema(version=output_schema_version),
+                                    partition_cols=['route','wday'])
+        else:
+            print('skipping output of {}'.format(analysis_route))
+
+    execution_time = str(datetime.now() - begin_time).split('.')[0]
+    print("Run Time Section 4 Output : {}".format(execution_time))
 
-execution_time = str(datetime.now() - begin_time).split('.')[0]
-print("Run Time Section 5 Output : {}".format(execution_time))
 end_time = datetime.now()
 print("End Time : {}".format(end_time))
 ########################################################################################################################
@@ -62,6 +62,11 @@ analysis_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturd
 
 # EPSG code for WMATA-area work
 wmata_crs = 2248
+
+# Local directory to cache the joined schedule pattern and stop table, None to read the schedule db
+# each time
+wmata_schedule_cache_dir = os.path.join(path_processed_data, "wmata_schedule_cache")
+
 # 1.3 Import User-Defined Package
 ############################################
 import wmatarawnav as wr
@@ -102,7 +107,8 @@ xwalk_wmata_route_dir_pattern = (
         path = os.path.join(path_source_data,
                             "wmata_schedule_data",
                             "Schedule_082719-201718.mdb"),
-        analysis_routes = analysis_routes)
+        analysis_routes = analysis_routes,
+        cache_dir = wmata_schedule_cache_dir)
     .filter(items = ['direction', 'route','pattern'])
     .drop_duplicates()
 )
@@ -162,8 +168,8 @@ for analysis_route in analysis_routes:
                 wr.read_cleaned_rawnav(
                    analysis_routes_ = analysis_route,
                    analysis_days_ = analysis_day,
-                   path = os.path.join(path_processed_data, "rawnav_data.parquet"))
-                .drop(columns=['blank', 'lat_raw', 'long_raw', 'sat_cnt'])
+                   path = os.path.join(path_processed_data, "rawnav_data.parquet"),
+                   columns = wr.rawnav_data_cols + ['x_ft', 'y_ft'])
                 )
         except:
             print(f'No data on analysis route {analysis_route} for {analysis_day}')
@@ -186,53 +192,50 @@ for analysis_route in analysis_routes:
                                                 on=['filename', 'index_run_start'],
                                                 how='right')
             
-            # Address Remaining Col Format issues
-            rawnav_qjump_gdf = (
-                gpd.GeoDataFrame(
-                    rawnav_qjump_dat, 
-                    geometry = gpd.points_from_xy(
-                        rawnav_qjump_dat.long,
-                        rawnav_qjump_dat.lat
-                    ),
-                    crs='EPSG:4326')
-                .to_crs(epsg=wmata_crs)
-            )
     
-            # Iterate on over Pattern-Segments Combinations Applicable to Route
+            # Pattern-Segments Combinations Applicable to Route
             xwalk_seg_pattern_subset = xwalk_seg_pattern.query('route == @analysis_route')
-                        
-            for seg in xwalk_seg_pattern_subset.seg_name_id.unique():
-                print('Processing segment {} ...'.format(seg))
-
-                # We pass the rawnav data and summary tables, check against a segment,
-                # and use the patterns_by_seg to indicate which patterns should be examined
-                index_run_segment_start_end, summary_run_segment = (
-                    wr.merge_rawnav_segment(
-                        rawnav_gdf_=rawnav_qjump_gdf,
-                        rawnav_sum_dat_=rawnav_summary_dat,
-                        target_=segments.loc[segments.seg_name_id == seg],
-                        patterns_by_seg_=xwalk_seg_pattern_subset.loc[xwalk_seg_pattern_subset.seg_name_id == seg]
-                    )
-                )
-                # Note that because seg_pattern_first_last is defined for route and pattern,
-                # our summary will implicitly drop any runs that are on 'wrong' pattern(s) for 
-                # a route. 
-                
-                index_run_segment_start_end['wday'] = analysis_day
-                summary_run_segment['wday'] = analysis_day
-                
-                # The additional partitioning here is excessive, but if fits better in the 
-                # iterative/chunking process above
-                pq.write_to_dataset(
-                    table = pa.Table.from_pandas(summary_run_segment),
-                    root_path = path_seg_summary,
-                    partition_cols = ['route','wday','seg_name_id']
-                )
-                
-                pq.write_to_dataset(
-                    table = pa.Table.from_pandas(index_run_segment_start_end),
-                    root_path = path_seg_index,
-                    partition_cols = ['route','wday','seg_name_id']
+            
+            if len(xwalk_seg_pattern_subset) == 0:
+                continue
+            
+            print('Processing segments {} ...'.format(list(xwalk_seg_pattern_subset.seg_name_id.unique())))
+
+            # We pass the rawnav data and summary tables, check against all segments at once,
+            # and use the patterns_by_seg to indicate which patterns should be examined for 
+            # each segment
+            index_run_segment_start_end, summary_run_segment = (
+                wr.merge_rawnav_segments(
+                    rawnav_gdf_=rawnav_qjump_dat,
+                    rawnav_sum_dat_=rawnav_summary_dat,
+                    segments_=segments,
+                    patterns_by_seg_=xwalk_seg_pattern_subset,
+                    xy_cols=['x_ft', 'y_ft'],
+                    unit='ft'
                 )
+            )
+            # Note that because seg_pattern_first_last is defined for route and pattern,
+            # our summary will implicitly drop any runs that are on 'wrong' pattern(s) for 
+            # a route. 
+            
+            if len(summary_run_segment) == 0:
+                continue
+            
+            index_run_segment_start_end['wday'] = analysis_day
+            summary_run_segment['wday'] = analysis_day
+            
+            # The additional partitioning here is excessive, but if fits better in the 
+            # iterative/chunking process above
+            pq.write_to_dataset(
+                table = pa.Table.from_pandas(summary_run_segment),
+                root_path = path_seg_summary,
+                partition_cols = ['route','wday','seg_name_id']
+            )
+            
+            pq.write_to_dataset(
+                table = pa.Table.from_pandas(index_run_segment_start_end),
+                root_path = path_seg_index,
+                partition_cols = ['route','wday','seg_name_id']
+            )
                 
 
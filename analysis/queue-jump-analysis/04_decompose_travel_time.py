@@ -62,6 +62,10 @@ analysis_routes = q_jump_route_list
 # EPSG code for WMATA-area work
 wmata_crs = 2248
      
+# Local directory to cache the joined schedule pattern and stop table, None to read the schedule db
+# each time
+wmata_schedule_cache_dir = os.path.join(path_processed_data, "wmata_schedule_cache")
+
 # 1.3 Import User-Defined Package
 #################################
 import wmatarawnav as wr
@@ -104,7 +108,8 @@ xwalk_wmata_route_dir_pattern = (
            "wmata_schedule_data",
            "Schedule_082719-201718.mdb"
            ),
-        analysis_routes = analysis_routes
+        analysis_routes = analysis_routes,
+        cache_dir = wmata_schedule_cache_dir
     )
     .filter(items = ['direction','route','pattern'])
     .drop_duplicates()
@@ -151,10 +156,14 @@ for seg in list(xwalk_seg_pattern_stop.seg_name_id.drop_duplicates()): #["eleven
     rawnav_dat = (
         wr.read_cleaned_rawnav(
            analysis_routes_ = seg_routes,
-           path = os.path.join(path_processed_data, "rawnav_data.parquet")
+           path = os.path.join(path_processed_data, "rawnav_data.parquet"),
+           columns = wr.rawnav_data_cols
         )
-        .drop(columns=['blank', 'lat_raw', 'long_raw', 'sat_cnt'])
     )
+    
+    # Add the speed over the next interval and other values by run once here rather than in 
+    # each of the decomposition functions below
+    rawnav_dat = wr.calc_rolling_vals(rawnav_dat)
             
     segment_summary = (
         pq.read_table(
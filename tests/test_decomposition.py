@@ -225,3 +225,80 @@ def test_resum_matches_total(get_tt_decomp):
     )
 
     assert(len(runs_with_bad_secs_totals) == 0)
+
+def test_stop_area_phases_by_run():
+    # One run that stops to serve passengers, one that never stops and one that stops 
+    # without opening its doors
+    rawnav = pd.DataFrame({
+        'filename': ['rawnav00001.txt'] * 10 + ['rawnav00002.txt'] * 6 + ['rawnav00003.txt'] * 7,
+        'index_run_start': [0] * 10 + [5] * 6 + [0] * 7,
+        'index_loc': list(range(10)) + list(range(5, 11)) + list(range(7)),
+        'odom_ft': [0, 50, 100, 120, 120, 120, 120, 140, 200, 300,
+                    0, 60, 120, 180, 240, 300,
+                    0, 60, 120, 120, 120, 180, 240],
+        'sec_past_st': [0, 2, 4, 6, 8, 10, 12, 14, 16, 18,
+                        0, 1, 2, 3, 4, 5,
+                        0, 1, 2, 3, 4, 5, 6],
+        'door_state': ['C'] * 4 + ['O', 'O'] + ['C'] * 4 + ['C'] * 6 + ['C'] * 7
+    })
+    segment_summary = pd.DataFrame({
+        'filename': ['rawnav00001.txt', 'rawnav00002.txt', 'rawnav00003.txt'],
+        'index_run_start': [0, 5, 0],
+        'start_index_loc_segment': [0, 5, 0],
+        'end_index_loc_segment': [9, 10, 6]
+    })
+    stop_index = pd.DataFrame({
+        'filename': ['rawnav00001.txt', 'rawnav00002.txt', 'rawnav00003.txt'],
+        'index_run_start': [0, 5, 0],
+        'odom_ft_qj_stop': [120.0, 150.0, 120.0],
+        'stop_id': [18042, 18042, 18042]
+    })
+    
+    stop_area_decomp = wr.decompose_stop_area(rawnav, segment_summary, stop_index, 100, 100)
+    
+    assert(stop_area_decomp.stop_area_phase.tolist() == 
+           ['t_decel_phase', 't_decel_phase', 't_l_initial', 't_stop1', 't_stop1', 
+            't_accel_phase', 't_accel_phase', 't_accel_phase'] 
+           + ['t_nostopnopax'] * 4
+           + ['t_decel_phase', 't_stop', 't_stop', 't_accel_phase', 't_accel_phase'])
+    assert(stop_area_decomp.door_state_changes.tolist()[:8] == [1, 1, 1, 2, 2, 3, 3, 3])
+
+def test_calc_rolling_vals_leaves_input():
+    rawnav = pd.DataFrame({
+        'filename': ['rawnav00001.txt'] * 5 + ['rawnav00002.txt'] * 3 + ['rawnav00001.txt'],
+        'index_run_start': [0] * 5 + [5] * 3 + [0],
+        'index_loc': [0, 1, 2, 3, 4, 5, 6, 7, 5],
+        'odom_ft': [0, 10, 30, 60, 100, 0, 20, 40, 150],
+        'sec_past_st': [0, 1, 2, 3, 4, 0, 2, 4, 5]
+    })
+    rawnav_in = rawnav.copy()
+    
+    rawnav_add = wr.calc_rolling_vals(rawnav)
+    
+    pd.testing.assert_frame_equal(rawnav, rawnav_in)
+    # The last row is part of the first run, so its values continue that run's.
+    pd.testing.assert_series_equal(
+        rawnav_add.odom_ft_next, 
+        rawnav.groupby(['filename','index_run_start']).odom_ft.shift(-1),
+        check_names = False
+    )
+    pd.testing.assert_series_equal(
+        rawnav_add.fps_next3,
+        (rawnav.groupby(['filename','index_run_start']).odom_ft.shift(-3) - rawnav.odom_ft) 
+        / (rawnav.groupby(['filename','index_run_start']).sec_past_st.shift(-3) - rawnav.sec_past_st),
+        check_names = False
+    )
+    assert(wr.has_rolling_vals(rawnav_add) and not wr.has_rolling_vals(rawnav))
+    
+    # Decomposition functions reuse the fields when present
+    segment_summary = pd.DataFrame({
+        'filename': ['rawnav00001.txt', 'rawnav00002.txt'],
+        'index_run_start': [0, 5],
+        'start_index_loc_segment': [0, 5],
+        'end_index_loc_segment': [5, 7]
+    })
+    pd.testing.assert_frame_equal(
+        wr.decompose_segment_ff(rawnav_add, segment_summary),
+        wr.decompose_segment_ff(rawnav, segment_summary)
+    )
+    pd.testing.assert_frame_equal(rawnav, rawnav_in)
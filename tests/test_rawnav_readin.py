@@ -15,8 +15,12 @@ Created on Wed Jun 10 03:48:45 2020
 import pytest
 import os
 import pandas as pd
+import geopandas as gpd
+import numpy as np
 import json
 import glob
+import io
+import zipfile
 import sys
 
 sys.path.append('.')
@@ -123,6 +127,110 @@ def test_expect_certain_flags_1(get_rawnav_inventory):
     assert found_tags == expected_tags
 
 
+def test_scan_tag_lines_block_edges():
+    # Tags should be found with the same line numbers no matter where block boundaries fall
+    rawnav_text = (
+        b"Header line one\r\n"
+        b"PO04726,8,10/06/19,05:15:24,36476,05280\r\n"
+        b"38.921298,-76.969803,312,C,S,0,0,17,   ,9,38.921298,-76.969803\r\n"
+        b"APC\r\n"
+        b"/ 05:36:00 Buswares navigation reported end of route\r\n"
+        b"   U601,8,10/06/19,05:36:41,36476,05280\r\n"
+        b"38.921298,-76.969803,312,C,S,0,0,17,   ,9,38.921298,-76.969803"
+    )
+    expected_tags = ["2,PO04726,8,10/06/19,05:15:24,36476,05280",
+                     "6,   U601,8,10/06/19,05:36:41,36476,05280"]
+    
+    for block_size in [5, 41, 2**24]:
+        found_tags = wr.scan_tag_lines(io.BytesIO(rawnav_text), block_size=block_size)
+        assert found_tags == expected_tags
+
+
+def test_load_runs_blank_lines_match_full_load(tmp_path):
+    # Blank lines are dropped by load_rawnav_data, so reading only some runs should still
+    # number rows the same way when blank lines fall in runs that are and aren't read
+    rawnav_text = (
+        b"Header line one\r\n"
+        b"   U601,8,10/06/19,05:15:24,36476,05280\r\n"
+        b"38.921298,-76.969803,312,C,S,0,0,17,   ,9,38.921298,-76.969803\r\n"
+        b"\r\n"
+        b"38.921298,-76.969803,312,C,S,5,1,17,   ,9,38.921298,-76.969803\r\n"
+        b"PO04726,8,10/06/19,05:36:41,36476,05280\r\n"
+        b"38.921298,-76.969803,312,C,S,0,0,17,   ,9,38.921298,-76.969803\r\n"
+        b"\r\n"
+        b"   \r\n"
+        b"38.921298,-76.969803,312,C,S,8,4,17,   ,9,38.921298,-76.969803\r\n"
+        b"   U602,8,10/06/19,05:50:02,36476,05280\r\n"
+        b"38.921298,-76.969803,312,C,S,0,0,17,   ,9,38.921298,-76.969803\r\n"
+        b"\r\n"
+        b"38.921298,-76.969803,312,C,S,9,2,17,   ,9,38.921298,-76.969803\r\n"
+    )
+    zip_path = os.path.join(str(tmp_path), "rawnav00008191007.txt.zip")
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr("rawnav00008191007.txt", rawnav_text)
+    tag_info = wr.find_rawnav_routes([zip_path], nmax=None, quiet=True)
+    tag_info.line_num = tag_info.line_num.astype(int)
+    skiprows = tag_info.line_num.min()
+    
+    raw_data_full = wr.load_rawnav_data(zip_folder_path=zip_path, skiprows=skiprows)
+    raw_data_runs = wr.load_rawnav_data_runs(zip_folder_path=zip_path,
+                                             skiprows=skiprows,
+                                             tag_info=tag_info,
+                                             analysis_routes=['U6'])
+    
+    # All rows but those of the PO04726 run after its tag line
+    assert raw_data_runs.index.tolist() == [0, 1, 2, 5, 6, 7]
+    pd.testing.assert_frame_equal(raw_data_runs, raw_data_full.loc[raw_data_runs.index],
+                                  check_dtype=False)
+
+
+def test_parallel_inventory_matches_serial(get_cwd, get_rawnav_inventory):
+    # Searching files across processes should return the same inventory, in the same order,
+    # as the serial search
+    zipped_files_dir_parent = os.path.join(get_cwd, "data/00-raw/demo_data/01_notebook_data")
+    file_universe = glob.glob(os.path.join(zipped_files_dir_parent, 'rawnav*.zip'))
+    rawnav_inventory_parallel = wr.find_rawnav_routes(file_universe, 
+                                                      nmax=None, 
+                                                      quiet=True, 
+                                                      workers=2, 
+                                                      chunksize=1)
+    
+    pd.testing.assert_frame_equal(rawnav_inventory_parallel, get_rawnav_inventory)
+
+
+def test_inventory_cache_matches_full_scan(get_cwd, get_rawnav_inventory, tmp_path):
+    # The inventory built from the cache should match a full scan, both on the first run 
+    # that creates the cache and on a rerun that reuses it
+    zipped_files_dir_parent = os.path.join(get_cwd, "data/00-raw/demo_data/01_notebook_data")
+    file_universe = glob.glob(os.path.join(zipped_files_dir_parent, 'rawnav*.zip'))
+    path_inventory_cache = os.path.join(str(tmp_path), "rawnav_inventory_cache.parquet")
+    
+    for run in range(2):
+        rawnav_inventory_cached = wr.find_rawnav_routes(file_universe, 
+                                                        nmax=None, 
+                                                        quiet=True, 
+                                                        path_inventory_cache=path_inventory_cache)
+        pd.testing.assert_frame_equal(rawnav_inventory_cached, get_rawnav_inventory)
+    
+    # Dropping a file from the universe leaves its entry in the cache, but not in the result
+    rawnav_inventory_cached = wr.find_rawnav_routes(file_universe[1:], 
+                                                    nmax=None, 
+                                                    quiet=True, 
+                                                    path_inventory_cache=path_inventory_cache)
+    assert(file_universe[0] not in set(rawnav_inventory_cached.fullpath))
+    assert(file_universe[0] in set(pd.read_parquet(path_inventory_cache).fullpath))
+
+
+def test_file_stats_missing_file(tmp_path):
+    # Missing files shouldn't turn the nanosecond modification times into floats
+    path_file = tmp_path / "rawnav00001191007.txt.zip"
+    path_file.write_bytes(b"a")
+    os.utime(path_file, ns=(2 ** 60 + 1, 2 ** 60 + 1))
+    file_stats = wr.get_file_stats([str(path_file), str(tmp_path / "missing.zip")])
+    assert(file_stats.file_mtime.iloc[0] == 2 ** 60 + 1)
+    assert(file_stats.file_mtime.isna().tolist() == [False, True])
+
+
 def test_expect_first_row(get_route_rawnav_tag_dict):
     route_rawnav_tag_dict = get_route_rawnav_tag_dict
     # Expect that first lines are what you would expect
@@ -171,3 +279,339 @@ def test_summary_match(get_rawnav_rawnav_summary_dict):
 
     assert found_summary_vals == expect_summary_vals
 
+
+
+def test_load_runs_matches_full_load(get_rawnav_inventory, get_rawnav_inv_filt_first, 
+                                     get_rawnav_rawnav_summary_dict):
+    # Reading only the runs on the analysis route should give the same cleaned data and
+    # summary for that route as reading the whole file
+    rawnav_inventory = get_rawnav_inventory
+    rawnav_data_dict, summary_data_dict = get_rawnav_rawnav_summary_dict
+    analysis_routes = ['U6']
+    for index, row in get_rawnav_inv_filt_first.iterrows():
+        tag_info_line_no = rawnav_inventory[rawnav_inventory['filename'] == row['filename']].copy()
+        tag_info_line_no.line_num = tag_info_line_no.line_num.astype(int)
+        reference = min(tag_info_line_no.line_num)
+        tag_info_line_no.loc[:, "new_line_no"] = tag_info_line_no.line_num - reference - 1
+        temp = wr.load_rawnav_data_runs(zip_folder_path=row['fullpath'], 
+                                        skiprows=row['line_num'],
+                                        tag_info=tag_info_line_no,
+                                        analysis_routes=analysis_routes)
+        temp = wr.clean_rawnav_data({'RawData': temp, 'tagLineInfo': tag_info_line_no}, row['filename'])
+        
+        pd.testing.assert_frame_equal(
+            temp['rawnavdata'].query('route in @analysis_routes').reset_index(drop=True),
+            rawnav_data_dict[row['filename']].query('route in @analysis_routes').reset_index(drop=True),
+            check_dtype=False)
+        pd.testing.assert_frame_equal(
+            temp['summary_data'].query('route in @analysis_routes').reset_index(drop=True),
+            summary_data_dict[row['filename']].query('route in @analysis_routes').reset_index(drop=True),
+            check_dtype=False)
+
+
+def test_run_dividers_interval_join():
+    # Rows should get one copy per run they fall in, in run order, and rows outside 
+    # any run should be kept without run info
+    data = pd.DataFrame({'index_loc': [0, 1, 2, 3, 4, 5]})
+    for col in ['lat', 'long', 'heading', 'door_state', 'veh_state', 'odom_ft', 'sec_past_st',
+                'sat_cnt', 'stop_window', 'blank', 'lat_raw', 'long_raw']:
+        data[col] = 0
+    data['row_before_apc'] = [False, True, False, False, False, False]
+    summary_data = pd.DataFrame({'route_pattern': ['U601', 'U602'],
+                                 'route': ['U6', 'U6'],
+                                 'pattern': ['01', '02'],
+                                 'index_run_start': [0, 2],
+                                 'index_run_end': [2, 3]})
+    
+    found = wr.add_run_dividers(data, summary_data)
+    
+    assert found.index_loc.tolist() == [0, 1, 2, 2, 3, 4, 5]
+    assert found.route_pattern.tolist()[:5] == ['U601', 'U601', 'U601', 'U602', 'U602']
+    assert found.route_pattern.isna().tolist()[5:] == [True, True]
+    assert found.row_before_apc.tolist() == [0, 1, 0, 0, 0, 0, 0]
+
+
+def test_classify_rawnav_rows():
+    # Each kind of raw line should get its label, with the same validity checks as 
+    # check_valid_data_entry
+    raw_data = pd.DataFrame([['38.921298', '-76.969803', '312', 'C', 'S'],
+                             ['PO04726', '8', '10/06/19', '05:15:24', '36476'],
+                             ['/ 05:36:00 Buswares navigation reported end of route', None, None, None, None],
+                             ['CAL', None, None, None, None],
+                             ['APC', None, None, None, None],
+                             ['38.921298', '-76.969803', '361', 'C', 'S'],
+                             ['38.921298', '-76.969803', '312', 'X', 'S']],
+                            index=[0, 1, 2, 3, 4, 5, 6])
+    
+    row_class = wr.classify_rawnav_rows(raw_data, tag_indices=[1])
+    
+    assert row_class.row_type.tolist() == ['data', 'tag', 'end_route', 'cal', 'apc', 'invalid', 'invalid']
+    assert row_class.run_end_time[2] == '05:36:00'
+    assert (row_class.row_type == 'data').tolist() == raw_data.apply(wr.check_valid_data_entry, axis=1).tolist()
+
+
+def test_distance_latlong_matches_geopandas():
+    # Array-based distances should match reprojecting points with geopandas and taking the 
+    # distance between them
+    import geopandas as gpd
+    from shapely.geometry import Point
+    points = pd.DataFrame({'lat_start': [38.921298, 38.902072, 38.95], 
+                           'long_start': [-76.969803, -77.048249, -77.0], 
+                           'lat_end': [38.902146, 38.921298, None], 
+                           'long_end': [-77.048212, -76.969803, -77.1]})
+    geometry1 = [Point(xy) for xy in zip(points.long_start, points.lat_start)]
+    geometry2 = [Point(xy) for xy in zip(points.long_end, points.lat_end)]
+    expected_ft = (
+        gpd.GeoSeries(geometry1, crs="EPSG:4326").to_crs(epsg=3310)
+        .distance(gpd.GeoSeries(geometry2, crs="EPSG:4326").to_crs(epsg=3310))
+        .values * 3.28084)
+    
+    found_mi = wr.get_distance_latlong_mi(points, "lat_start", "long_start", "lat_end", "long_end")
+    found_ft = wr.get_distance_latlong_ft_from_geom(pd.Series(geometry1), pd.Series(geometry2))
+    
+    np.testing.assert_allclose(found_ft[:2], expected_ft[:2], rtol=1e-9)
+    np.testing.assert_allclose(found_mi[:2], expected_ft[:2] / 3.28084 * 0.000621371, rtol=1e-9)
+    assert np.isnan(found_mi[2]) and np.isnan(found_ft[2])
+
+
+def test_clean_rawnav_files_matches_serial(get_rawnav_inventory, get_rawnav_rawnav_summary_dict):
+    # Loading and cleaning files across processes should match cleaning them one at a time
+    rawnav_inventory = get_rawnav_inventory
+    rawnav_data_dict, summary_data_dict = get_rawnav_rawnav_summary_dict
+    analysis_routes = ['U6']
+    rawnav_inventory_filtered = (
+        rawnav_inventory[
+            rawnav_inventory
+            .groupby('filename')['route']
+            .transform(lambda x: x.isin(analysis_routes).any())
+        ]
+        .astype({"line_num": 'int'})
+    )
+    
+    rawnav_data_dict_parallel, summary_data_dict_parallel, rawnav_inventory_filtered_valid = \
+        wr.clean_rawnav_files(rawnav_inventory_filtered, workers=2)
+    
+    assert sorted(rawnav_data_dict_parallel.keys()) == sorted(rawnav_data_dict.keys())
+    for filename in rawnav_data_dict.keys():
+        pd.testing.assert_frame_equal(rawnav_data_dict_parallel[filename], rawnav_data_dict[filename])
+        pd.testing.assert_frame_equal(summary_data_dict_parallel[filename], summary_data_dict[filename])
+    assert len(rawnav_inventory_filtered_valid) == len(rawnav_inventory_filtered)
+
+
+def test_stream_output_matches_in_memory(get_rawnav_inventory, get_rawnav_rawnav_summary_dict, tmp_path):
+    # Writing files as they are cleaned should give the same runs and rows as combining 
+    # the cleaned files in memory
+    rawnav_inventory = get_rawnav_inventory
+    rawnav_data_dict, summary_data_dict = get_rawnav_rawnav_summary_dict
+    analysis_routes = ['U6']
+    rawnav_inventory_filtered = rawnav_inventory.astype({"line_num": 'int'})
+    path_rawnav_data = os.path.join(str(tmp_path), "rawnav_data.parquet")
+    path_summary_rawnav = os.path.join(str(tmp_path), "rawnav_summary.parquet")
+    
+    wr.write_clean_rawnav_files(rawnav_inventory_filtered, 
+                                analysis_routes, 
+                                path_rawnav_data, 
+                                path_summary_rawnav)
+    
+    summary_found = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_summary_rawnav)
+    rawnav_found = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_rawnav_data)
+    
+    summary_expected = pd.concat(summary_data_dict.values()).query('route in @analysis_routes')
+    rawnav_expected = pd.concat(rawnav_data_dict.values()).query('route in @analysis_routes')
+    
+    assert (sorted(zip(summary_found.filename, summary_found.index_run_start)) 
+            == sorted(zip(summary_expected.filename, summary_expected.index_run_start)))
+    assert len(rawnav_found) == len(rawnav_expected)
+    assert rawnav_found.start_date_time.notna().all()
+
+
+def test_compact_schema_matches_default(get_rawnav_inventory, tmp_path):
+    # Data written with version 2 of the data schema should read back with the same values 
+    # as version 1, only with smaller types
+    rawnav_inventory = get_rawnav_inventory
+    analysis_routes = ['U6']
+    rawnav_inventory_filtered = rawnav_inventory.astype({"line_num": 'int'})
+    rawnav_found = {}
+    
+    for version in [1, 2]:
+        path_version = os.path.join(str(tmp_path), "v{}".format(version))
+        os.mkdir(path_version)
+        path_rawnav_data = os.path.join(path_version, "rawnav_data.parquet")
+        wr.write_clean_rawnav_files(rawnav_inventory_filtered, 
+                                    analysis_routes, 
+                                    path_rawnav_data, 
+                                    os.path.join(path_version, "rawnav_summary.parquet"),
+                                    schema_version=version)
+        rawnav_found[version] = (
+            wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_rawnav_data)
+            .reset_index(drop=True))
+    
+    assert rawnav_found[2].index_loc.dtype == 'int32'
+    assert rawnav_found[2].row_before_apc.dtype == 'bool'
+    assert rawnav_found[2].filename.dtype == 'category'
+    category_cols = rawnav_found[2].select_dtypes('category').columns
+    pd.testing.assert_frame_equal(rawnav_found[1], 
+                                  rawnav_found[2].astype({col: 'object' for col in category_cols}),
+                                  check_dtype=False)
+
+
+def test_projected_xy_matches_to_crs(get_rawnav_inventory, tmp_path):
+    # x_ft and y_ft written with version 3 of the data schema, or projected on read from 
+    # earlier versions, should match reprojecting points with geopandas
+    rawnav_inventory = get_rawnav_inventory
+    analysis_routes = ['U6']
+    rawnav_inventory_filtered = rawnav_inventory.astype({"line_num": 'int'})
+    rawnav_found = {}
+    
+    for version in [1, 3]:
+        path_version = os.path.join(str(tmp_path), "v{}".format(version))
+        os.mkdir(path_version)
+        path_rawnav_data = os.path.join(path_version, "rawnav_data.parquet")
+        wr.write_clean_rawnav_files(rawnav_inventory_filtered, 
+                                    analysis_routes, 
+                                    path_rawnav_data, 
+                                    os.path.join(path_version, "rawnav_summary.parquet"),
+                                    schema_version=version)
+        rawnav_found[version] = (
+            wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, 
+                                   path=path_rawnav_data,
+                                   columns=['lat', 'long', 'x_ft', 'y_ft'])
+            .reset_index(drop=True))
+    
+    rawnav_gdf = (
+        gpd.GeoDataFrame(rawnav_found[1],
+                         geometry=gpd.points_from_xy(rawnav_found[1].long, rawnav_found[1].lat),
+                         crs='EPSG:4326')
+        .to_crs(epsg=2248)
+    )
+    
+    assert np.allclose(rawnav_found[3].x_ft, rawnav_gdf.geometry.x, equal_nan=True)
+    assert np.allclose(rawnav_found[3].y_ft, rawnav_gdf.geometry.y, equal_nan=True)
+    pd.testing.assert_series_equal(rawnav_found[1].x_ft, rawnav_found[3].x_ft)
+    pd.testing.assert_series_equal(rawnav_found[1].y_ft, rawnav_found[3].y_ft)
+
+
+def test_read_cleaned_rawnav_filters(get_rawnav_inventory, tmp_path):
+    # Columns, runs and time filters pushed into the read should match filtering after the read
+    rawnav_inventory = get_rawnav_inventory
+    analysis_routes = ['U6']
+    path_rawnav_data = os.path.join(str(tmp_path), "rawnav_data.parquet")
+    wr.write_clean_rawnav_files(rawnav_inventory.astype({"line_num": 'int'}), 
+                                analysis_routes, 
+                                path_rawnav_data, 
+                                os.path.join(str(tmp_path), "rawnav_summary.parquet"))
+    rawnav_all = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_rawnav_data)
+    
+    rawnav_cols = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, 
+                                         path=path_rawnav_data, 
+                                         columns=['odom_ft'])
+    assert set(rawnav_cols.columns) == set(['odom_ft', 'filename', 'index_run_start', 'index_loc', 
+                                            'route', 'wday', 'pattern'])
+    assert len(rawnav_cols) == len(rawnav_all)
+    
+    runs = rawnav_all[['filename', 'index_run_start']].drop_duplicates().iloc[::2]
+    rawnav_runs = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, 
+                                         path=path_rawnav_data, 
+                                         runs=runs)
+    assert len(rawnav_runs) == len(rawnav_all.merge(runs, on=['filename', 'index_run_start']))
+    
+    start_time = rawnav_all.start_date_time.min() + pd.Timedelta(hours=1)
+    rawnav_time = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, 
+                                         path=path_rawnav_data, 
+                                         start_time=start_time)
+    assert len(rawnav_time) == (rawnav_all.start_date_time >= start_time).sum()
+
+
+def test_manifest_rewrite_replaces_runs(get_rawnav_inventory, tmp_path):
+    # Writing runs again should replace them, so readers can skip deduplicating
+    rawnav_inventory = get_rawnav_inventory
+    analysis_routes = ['U6']
+    path_rawnav_data = os.path.join(str(tmp_path), "rawnav_data.parquet")
+    wr.write_clean_rawnav_files(rawnav_inventory.astype({"line_num": 'int'}), 
+                                analysis_routes, 
+                                path_rawnav_data, 
+                                os.path.join(str(tmp_path), "rawnav_summary.parquet"))
+    rawnav_dat = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_rawnav_data)
+    day_of_week = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+    assert wr.check_rawnav_manifest_unique(path_rawnav_data, analysis_routes, day_of_week)
+    
+    runs = rawnav_dat[['filename', 'index_run_start']].drop_duplicates().iloc[::2]
+    wr.write_rawnav_dataset(rawnav_dat.merge(runs, on=['filename', 'index_run_start']),
+                            path_rawnav_data,
+                            wr.rawnav_data_schema())
+    
+    assert wr.check_rawnav_manifest_unique(path_rawnav_data, analysis_routes, day_of_week)
+    rawnav_rewrite = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_rawnav_data)
+    assert len(rawnav_rewrite) == len(rawnav_dat)
+    assert not rawnav_rewrite.duplicated(['filename', 'index_run_start', 'index_loc']).any()
+
+
+def test_read_run_matches_partition_read(get_rawnav_inventory, tmp_path):
+    # Reading one run through the manifest row ranges should match filtering a full read
+    rawnav_inventory = get_rawnav_inventory
+    analysis_routes = ['U6']
+    path_rawnav_data = os.path.join(str(tmp_path), "rawnav_data.parquet")
+    wr.write_clean_rawnav_files(rawnav_inventory.astype({"line_num": 'int'}), 
+                                analysis_routes, 
+                                path_rawnav_data, 
+                                os.path.join(str(tmp_path), "rawnav_summary.parquet"))
+    rawnav_dat = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_rawnav_data)
+    
+    for filename, index_run_start in (rawnav_dat[['filename', 'index_run_start']]
+                                      .drop_duplicates()
+                                      .itertuples(index=False)):
+        rawnav_run = wr.read_run(path_rawnav_data, filename, index_run_start)
+        rawnav_expected = rawnav_dat.query('filename == @filename & index_run_start == @index_run_start')
+        assert rawnav_run.index_loc.tolist() == rawnav_expected.index_loc.tolist()
+        assert rawnav_run.odom_ft.tolist() == rawnav_expected.odom_ft.tolist()
+
+
+def test_cached_read_matches_parquet_read(get_rawnav_inventory, tmp_path):
+    # Reads through the Arrow cache should match parquet reads, including after the data is
+    # rewritten
+    rawnav_inventory = get_rawnav_inventory
+    analysis_routes = ['U6']
+    path_rawnav_data = os.path.join(str(tmp_path), "rawnav_data.parquet")
+    path_cache = os.path.join(str(tmp_path), "cache")
+    wr.write_clean_rawnav_files(rawnav_inventory.astype({"line_num": 'int'}), 
+                                analysis_routes, 
+                                path_rawnav_data, 
+                                os.path.join(str(tmp_path), "rawnav_summary.parquet"))
+    rawnav_dat = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_rawnav_data)
+    
+    for _ in range(2):
+        rawnav_cached = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, 
+                                               path=path_rawnav_data,
+                                               cache_dir=path_cache)
+        pd.testing.assert_frame_equal(rawnav_dat.reset_index(drop=True), 
+                                      rawnav_cached[rawnav_dat.columns].reset_index(drop=True))
+    
+    runs = rawnav_dat[['filename', 'index_run_start']].drop_duplicates().iloc[:1]
+    wr.write_rawnav_dataset(rawnav_dat.merge(runs, on=['filename', 'index_run_start'])
+                            .assign(odom_ft=lambda x: x.odom_ft + 1),
+                            path_rawnav_data,
+                            wr.rawnav_data_schema())
+    rawnav_cached = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, 
+                                           path=path_rawnav_data,
+                                           cache_dir=path_cache)
+    assert rawnav_cached.odom_ft.sum() == rawnav_dat.odom_ft.sum() + len(rawnav_dat.merge(runs))
+
+
+def test_cache_dir_from_environment(get_rawnav_inventory, tmp_path, monkeypatch):
+    # Without cache_dir, reads should cache to the directory in WMATARAWNAV_CACHE_DIR
+    rawnav_inventory = get_rawnav_inventory
+    analysis_routes = ['U6']
+    path_rawnav_data = os.path.join(str(tmp_path), "rawnav_data.parquet")
+    path_cache = os.path.join(str(tmp_path), "cache")
+    wr.write_clean_rawnav_files(rawnav_inventory.astype({"line_num": 'int'}), 
+                                analysis_routes, 
+                                path_rawnav_data, 
+                                os.path.join(str(tmp_path), "rawnav_summary.parquet"))
+    rawnav_dat = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_rawnav_data)
+    assert not os.path.isdir(path_cache)
+    
+    monkeypatch.setenv('WMATARAWNAV_CACHE_DIR', path_cache)
+    rawnav_cached = wr.read_cleaned_rawnav(analysis_routes_=analysis_routes, path=path_rawnav_data)
+    assert len(os.listdir(path_cache)) > 0
+    pd.testing.assert_frame_equal(rawnav_dat.reset_index(drop=True), 
+                                  rawnav_cached[rawnav_dat.columns].reset_index(drop=True))
@@ -197,6 +197,56 @@ def test_expect_fail_too_far(get_segment_results):
     
     assert fail_result
 
+def test_merge_rawnav_segments_matches_single(get_rawnav_gdf,get_summary,get_segments,get_patterns,
+                                              get_segment_results):
+    index_run_segment_start_end, summary_run_segment = get_segment_results
+    
+    # A second segment for the same pattern, to check that segments don't affect each other
+    seg = get_segments.loc[get_segments.seg_name_id == "irving_fifteenth_sixteenth_stub"]
+    seg_copy = seg.assign(seg_name_id = "irving_copy")
+    seg_copy['geometry'] = seg_copy.geometry.translate(100, 100)
+    segs = pd.concat([get_segments, seg_copy], ignore_index=True)
+    patterns = pd.concat([get_patterns, get_patterns.assign(seg_name_id = "irving_copy")])
+    
+    index_run_segments_start_end, summary_run_segments = (
+        wr.merge_rawnav_segments(
+            rawnav_gdf_=get_rawnav_gdf,
+            rawnav_sum_dat_=get_summary,
+            segments_=segs,
+            patterns_by_seg_=patterns
+        )
+    )
+    
+    assert set(summary_run_segments.seg_name_id) == {"irving_fifteenth_sixteenth_stub", "irving_copy"}
+    pd.testing.assert_frame_equal(
+        index_run_segment_start_end,
+        index_run_segments_start_end.query('seg_name_id == "irving_fifteenth_sixteenth_stub"'))
+    pd.testing.assert_frame_equal(
+        summary_run_segment,
+        summary_run_segments
+        .query('seg_name_id == "irving_fifteenth_sixteenth_stub"')
+        .reset_index(drop=True))
+
+def test_subset_rawnav_to_segments():
+    # Overlapping segments each get their own copy of the shared rawnav rows, runs without
+    # rawnav data are skipped
+    rawnav_dat = pd.DataFrame({'filename': ['a'] * 5 + ['b'] * 3,
+                               'index_run_start': [1] * 5 + [7] * 3,
+                               'index_loc': [1, 2, 3, 4, 5, 7, 8, 9],
+                               'odom_ft': [0, 10, 20, 30, 40, 0, 5, 10]})
+    seg_boundary_dat = pd.DataFrame({'filename': ['a', 'a', 'b', 'c'],
+                                     'index_run_start': [1, 1, 7, 1],
+                                     'seg_name_id': ['seg1', 'seg2', 'seg1', 'seg1'],
+                                     'index_loc_first_stop': [2, 3, 0, 1],
+                                     'index_loc_last_stop': [4, 10, 7, 2],
+                                     'first_stop_dist_nearest_point': [1.0, 2.0, 3.0, 4.0]})
+    rawnav_seg_dat = wr.subset_rawnav_to_segments(rawnav_dat, seg_boundary_dat, 
+                                                  ['index_loc', 'odom_ft'],
+                                                  seg_columns=['first_stop_dist_nearest_point'])
+    assert rawnav_seg_dat.index_loc.tolist() == [2, 3, 4, 3, 4, 5, 7]
+    assert rawnav_seg_dat.seg_name_id.tolist() == ['seg1'] * 3 + ['seg2'] * 3 + ['seg1']
+    assert rawnav_seg_dat.first_stop_dist_nearest_point.tolist() == [1.0] * 3 + [2.0] * 3 + [3.0]
+
 def test_explode(get_segments):
     segments = get_segments
     seg_irving = segments.loc[segments.seg_name_id == "irving_fifteenth_sixteenth_stub"]
@@ -218,6 +268,19 @@ def test_explode(get_segments):
     assert test_last.all()
     # note that these endpoints were also manually verified on map    
     
+def test_explode_all_segments(get_segments, get_patterns):
+    segments = get_segments.merge(get_patterns, on = 'seg_name_id', how = 'left')
+    
+    seg_first_last = wr.explode_first_last(segments)
+    
+    assert len(seg_first_last) == 2 * len(segments)
+    assert (seg_first_last.seg_name_id.to_numpy()[::2] == segments.seg_name_id.to_numpy()).all()
+    assert (seg_first_last.location.to_numpy()[::2] == "first").all()
+    assert (seg_first_last.location.to_numpy()[1::2] == "last").all()
+    # Attributes keep their dtypes rather than becoming object columns
+    assert (seg_first_last.dtypes.drop(['location', 'geometry']) 
+            == segments.dtypes.drop('geometry')).all()
+    
 # Note: determination of point nearest to start and end of segment uses same matching function
 # as the schedule stop merge, so no additional checks performed here.
 # The schedule stop merge functions were largely validated using review of interactive maps 
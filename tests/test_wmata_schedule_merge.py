@@ -14,7 +14,9 @@ Created on Mon Jun 22 10:18 2020
 import pytest
 import os
 import sys
+import json
 import pandas as pd
+import numpy as np
 import geopandas as gpd
 sys.path.append('.')
 
@@ -178,3 +180,170 @@ def test_nearest_point(get_stops_results):
     assert(nearest_long_match)
 
     
+
+def test_merge_rawnav_target_matches_per_run(get_rawnav_data, get_wmata_schedule_data):
+    # Searching all runs at once should give the same nearest points as ckdnearest on each run
+    rawnav_dat = get_rawnav_data
+    wmata_schedule_dat = get_wmata_schedule_data.query('route == "H8"')
+    
+    nearest_found = wr.merge_rawnav_target(target_dat=wmata_schedule_dat, rawnav_dat=rawnav_dat)
+    
+    nearest_expected = []
+    for (route, pattern, filename, index_run_start), rawnav_run in (
+            rawnav_dat.groupby(['route', 'pattern', 'filename', 'index_run_start'])):
+        target_dat = wmata_schedule_dat.query('route == @route & pattern == @pattern')
+        if len(target_dat) > 0:
+            nearest_expected.append(wr.ckdnearest(target_dat.copy(), rawnav_run.copy()))
+    nearest_expected = wr.reorder_first_cols(pd.concat(nearest_expected),
+                                             ['filename', 'index_run_start', 'index_loc'])
+    
+    pd.testing.assert_frame_equal(wr.drop_geometry(nearest_found), 
+                                  wr.drop_geometry(nearest_expected))
+
+def test_merge_rawnav_target_projected_xy(get_rawnav_data, get_wmata_schedule_data):
+    # Rawnav data with projected x_ft/y_ft columns should match the same data as points
+    rawnav_dat = get_rawnav_data
+    rawnav_xy_dat = wr.add_projected_xy(wr.drop_geometry(rawnav_dat))
+    wmata_schedule_dat = get_wmata_schedule_data.query('route == "H8"')
+    
+    assert np.allclose(rawnav_xy_dat.x_ft, rawnav_dat.geometry.x)
+    assert np.allclose(rawnav_xy_dat.y_ft, rawnav_dat.geometry.y)
+    
+    nearest_found = wr.merge_rawnav_target(target_dat=wmata_schedule_dat, rawnav_dat=rawnav_xy_dat)
+    nearest_expected = wr.merge_rawnav_target(target_dat=wmata_schedule_dat, rawnav_dat=rawnav_dat)
+    
+    pd.testing.assert_frame_equal(nearest_found, nearest_expected)
+
+def test_merge_rawnav_target_xy_units(get_rawnav_data, get_wmata_schedule_data):
+    # Coordinates in meters should give the same nearest points, with distances still in feet
+    rawnav_dat = get_rawnav_data
+    wmata_schedule_dat = get_wmata_schedule_data.query('route == "H8"')
+    rawnav_xy_dat = (
+        wr.drop_geometry(rawnav_dat)
+        .assign(x_m = rawnav_dat.geometry.x / 3.28084, y_m = rawnav_dat.geometry.y / 3.28084))
+    wmata_schedule_xy_dat = (
+        wr.drop_geometry(wmata_schedule_dat)
+        .assign(x_m = wmata_schedule_dat.geometry.x / 3.28084, 
+                y_m = wmata_schedule_dat.geometry.y / 3.28084))
+    
+    nearest_found = wr.merge_rawnav_target_xy(target_dat=wmata_schedule_xy_dat, 
+                                              rawnav_dat=rawnav_xy_dat,
+                                              xy_cols=['x_m', 'y_m'],
+                                              unit='m')
+    nearest_expected = wr.merge_rawnav_target(target_dat=wmata_schedule_dat, rawnav_dat=rawnav_dat)
+    
+    assert type(nearest_found) == pd.DataFrame
+    assert (nearest_found.index_loc.values == nearest_expected.index_loc.values).all()
+    assert np.allclose(nearest_found.dist_to_nearest_point, nearest_expected.dist_to_nearest_point)
+
+def test_ckdnearest_leaves_inputs_unchanged(get_rawnav_data, get_wmata_schedule_data):
+    rawnav_dat = get_rawnav_data.iloc[::2]
+    wmata_schedule_dat = get_wmata_schedule_data.query('route == "H8"')
+    rawnav_index = rawnav_dat.index.copy()
+    wmata_schedule_index = wmata_schedule_dat.index.copy()
+    
+    nearest = wr.ckdnearest(wmata_schedule_dat, rawnav_dat)
+    dist, idx = wr.ckdnearest(wr.get_xy_array(wmata_schedule_dat), 
+                              wr.get_xy_array(rawnav_dat), 
+                              return_indices=True)
+    
+    assert rawnav_dat.index.equals(rawnav_index)
+    assert wmata_schedule_dat.index.equals(wmata_schedule_index)
+    assert (nearest.dist_to_nearest_point.values == dist).all()
+    assert (nearest.index_loc.values == rawnav_dat.index_loc.values[idx]).all()
+
+def test_longest_nondecreasing_mask():
+    # A single early stop snapped late in the run should be the only one removed
+    index_loc = pd.Series([5000, 100, 200, 300, 300, 450]).to_numpy()
+    assert wr.longest_nondecreasing_mask(index_loc).tolist() == [False, True, True, True, True, True]
+    # Of equally long orders, the earlier stop is kept
+    index_loc = pd.Series([100, 300, 200]).to_numpy()
+    assert wr.longest_nondecreasing_mask(index_loc).tolist() == [True, True, False]
+
+def test_subset_rawnav_to_first_last_stop():
+    rawnav_dat = pd.DataFrame({'filename': ['a'] * 5 + ['b'] * 3,
+                               'index_run_start': [1] * 5 + [7] * 3,
+                               'index_loc': [1, 2, 3, 4, 5, 7, 8, 9],
+                               'odom_ft': [0, 10, 20, 30, 40, 0, 5, 10]})
+    first_last_stop_dat = pd.DataFrame({'filename': ['a', 'a'],
+                                        'index_run_start': [1, 1],
+                                        'index_loc_first_stop': [2, 2],
+                                        'index_loc_last_stop': [4, 4],
+                                        'stop_id': [10, 20]})
+    rawnav_stop_dat = wr.subset_rawnav_to_first_last_stop(rawnav_dat, first_last_stop_dat, 
+                                                          ['index_loc', 'odom_ft'],
+                                                          stop_columns=['index_loc_first_stop'])
+    assert rawnav_stop_dat.index_loc.tolist() == [2, 3, 4]
+    assert (rawnav_stop_dat.index_loc_first_stop == 2).all()
+
+def test_read_sched_db_patterns_sources(tmp_path):
+    stop_dat = pd.DataFrame({'GeoID': [1, 2, 3],
+                             'StopID': [101, 102, 103],
+                             'Longitude': [-77.03, -77.02, -77.01],
+                             'Latitude': [38.90, 38.91, 38.92],
+                             'Heading': [0, 0, 90]})
+    pattern_dat = pd.DataFrame({'PatternID': [11, 12], 'TARoute': ['70', 'S9'], 
+                                'PatternName': ['a', 'b'], 'Direction': ['SOUTH', 'NORTH'],
+                                'Distance': [5.0, 6.0], 'CDRoute': ['70', 'S9'], 'CDVariation': [1, 2],
+                                'PatternDestination': ['x', 'y'], 'RouteText': ['x', 'y'], 
+                                'RouteKey': [1, 2], 'PubRouteDir': ['SOUTH', 'NORTH'], 
+                                'DirectionID': [1, 0]})
+    pattern_detail_dat = pd.DataFrame({'PatternID': [11, 11, 12], 'GeoID': [1, 2, 3],
+                                       'Order': [1, 2, 1], 'StopSortOrder': [1, 2, 1],
+                                       'Distance': [0.0, 0.5, 0.0], 'SortOrder': [1, 2, 1],
+                                       'GeoPathID': [1, 1, 2], 'TimePointID': [None, None, None]})
+    import sqlite3
+    with sqlite3.connect(str(tmp_path / "sched.sqlite")) as cnxn:
+        stop_dat.to_sql('Stop', cnxn, index=False)
+        pattern_dat.to_sql('Pattern', cnxn, index=False)
+        pattern_detail_dat.to_sql('PatternDetail', cnxn, index=False)
+    os.mkdir(tmp_path / "csv")
+    stop_dat.to_csv(tmp_path / "csv" / "sched Stop.csv", index=False)
+    pattern_dat.to_csv(tmp_path / "csv" / "sched Pattern.csv", index=False)
+    pattern_detail_dat.to_csv(tmp_path / "csv" / "sched PatternDetail.csv", index=False)
+
+    sched_sqlite = wr.read_sched_db_patterns(str(tmp_path / "sched.sqlite"), ['70'])
+    sched_csv = wr.read_sched_db_patterns(str(tmp_path / "csv"), ['70'])
+    sched_csv_cache = wr.read_sched_db_patterns(str(tmp_path / "csv"), ['70'], 
+                                                cache_dir=str(tmp_path / "cache"))
+    sched_csv_cached = wr.read_sched_db_patterns(str(tmp_path / "csv"), ['70'], 
+                                                 cache_dir=str(tmp_path / "cache"))
+    assert sched_sqlite.stop_id.tolist() == [101, 102]
+    pd.testing.assert_frame_equal(sched_sqlite, sched_csv)
+    pd.testing.assert_frame_equal(sched_csv, sched_csv_cache)
+    pd.testing.assert_frame_equal(sched_csv, sched_csv_cached)
+    
+    # Changing the source invalidates the cached table
+    (pattern_dat
+     .assign(CDRoute = ['79', 'S9'], TARoute = ['79', 'S9'])
+     .to_csv(tmp_path / "csv" / "sched Pattern.csv", index=False))
+    sched_csv_changed = wr.read_sched_db_patterns(str(tmp_path / "csv"), ['79'], 
+                                                  cache_dir=str(tmp_path / "cache"))
+    assert sched_csv_changed.route.unique().tolist() == ['79']
+    
+    # Route names that are all numbers are still read as strings in both route columns
+    (pattern_dat
+     .assign(CDRoute = ['70', '79'], TARoute = ['70', '79'])
+     .to_csv(tmp_path / "csv" / "sched Pattern.csv", index=False))
+    sched_csv_numeric = wr.read_sched_db_patterns(str(tmp_path / "csv"), ['70', '79'])
+    assert sched_csv_numeric.route.unique().tolist() == ['70', '79']
+
+def test_hash_sched_db_source(tmp_path):
+    path_source = tmp_path / "sched.sqlite"
+    path_hashes = tmp_path / "wmata_schedule_hashes.json"
+    path_source.write_bytes(b"a")
+    source_hash = wr.hash_sched_db_source(str(path_source), 'sqlite', str(tmp_path))
+    
+    # A cache hit leaves the hashes file untouched
+    os.utime(path_hashes, ns=(0, 0))
+    assert wr.hash_sched_db_source(str(path_source), 'sqlite', str(tmp_path)) == source_hash
+    assert path_hashes.stat().st_mtime_ns == 0
+    
+    # Entries for other files are dropped, and no temporary files are left
+    path_source_new = tmp_path / "sched_new.sqlite"
+    path_source_new.write_bytes(b"b")
+    assert wr.hash_sched_db_source(str(path_source_new), 'sqlite', str(tmp_path)) != source_hash
+    with open(path_hashes) as f:
+        assert list(json.load(f)) == [str(path_source_new)]
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['sched.sqlite', 'sched_new.sqlite', 'wmata_schedule_hashes.json']
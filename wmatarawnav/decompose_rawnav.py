@@ -28,7 +28,12 @@ def decompose_segment_ff(rawnav,
     rawnav_fil = filter_to_segment(rawnav,
                                    segment_summary_)
     
-    rawnav_fil = calc_rolling_vals(rawnav)
+    # The speed profile fields by run may already have been added once for all of the 
+    # decomposition functions
+    if has_rolling_vals(rawnav):
+        rawnav_fil = rawnav
+    else:
+        rawnav_fil = calc_rolling_vals(rawnav)
            
     freeflow_seg = (
         rawnav_fil
@@ -62,7 +67,7 @@ def decompose_traveltime(
     basic_decomp_agg = (
         stop_area_decomp
         # Note that we drop any stop_id grouping here, since this method just needs us to sum t_stop1s
-        .groupby(['filename','index_run_start','stop_area_phase'])
+        .groupby(['filename','index_run_start','stop_area_phase'], observed = True)
         # While we can sum marginal values for t_stop1, if we do so for the accel phase, we'll
         # include a value outside of the segment. Instead, we subtract the min from the max value
         # to find the difference
@@ -102,7 +107,7 @@ def decompose_traveltime(
     basic_decomp_agg_fil = (
         basic_decomp_agg[
             basic_decomp_agg
-            .groupby(['filename','index_run_start'])['stop_area_phase']
+            .groupby(['filename','index_run_start'], observed = True)['stop_area_phase']
             .transform(lambda x: x.isin(['t_stop','t_stop1']).any())
         ]
     )
@@ -146,14 +151,17 @@ def decompose_traveltime(
     ) 
         
     # calc total secs
-    rawnav_fil_seg = calc_rolling_vals(rawnav)
+    if has_rolling_vals(rawnav):
+        rawnav_fil_seg = rawnav
+    else:
+        rawnav_fil_seg = calc_rolling_vals(rawnav)
 
     rawnav_fil_seg = filter_to_segment(rawnav_fil_seg,
                                        segment_summary_)
 
     totals = (
         rawnav_fil_seg
-        .groupby(['filename','index_run_start'])
+        .groupby(['filename','index_run_start'], observed = True)
         .agg({"odom_ft": [lambda x: max(x) - min(x)],
               "sec_past_st" : [lambda x: max(x) - min(x)]})
         .pipe(ll.reset_col_names)
@@ -264,7 +272,9 @@ def decompose_stop_area(rawnav,
     assert(len(segment_summary_) > 0), print("Halting, no stops provided in segment_summary_")
     assert(len(stop_index_fil) > 0), print("Halting, no stops provided in stop_index_fil")
 
-    rawnav_fil_1 = filter_to_segment(rawnav,
+    # Any speed profile fields already on rawnav are calculated by run, so we leave them out 
+    # and recalculate them by run and stop within the segment below
+    rawnav_fil_1 = filter_to_segment(rawnav.drop(columns = rolling_vals_cols, errors = 'ignore'),
                                      segment_summary_)
 
     # We'll also filter to those runs that have a match to the QJ stop while adding detail
@@ -288,196 +298,128 @@ def decompose_stop_area(rawnav,
                                    groupvars = ['filename','index_run_start','stop_id'])
    
     # Filter to Stop Area
-    rawnav_fil_stop_area_1 = (
+    stop_area = (
         rawnav_fil
         .query('odom_ft >= (odom_ft_qj_stop - @stop_area_upstream_ft) & odom_ft <= (odom_ft_qj_stop + @stop_area_downstream_ft)')
         .reset_index()
     )
     
+    del rawnav_fil
+    
     # In the event that a ping ends up in two stop areas, we keep the last occurrence, as usually
     # we need more room on the upstream side. 
-    rawnav_fil_stop_area_1 = (
-        rawnav_fil_stop_area_1
+    stop_area = (
+        stop_area
         .loc[
-            ~rawnav_fil_stop_area_1.duplicated(['filename','index_run_start','index_loc'], keep = "last")
+            ~stop_area.duplicated(['filename','index_run_start','index_loc'], keep = "last")
         ]
+        .reset_index(drop = True)
     )
     
+    # Everything below is calculated by run and stop. Rather than grouping and merging 
+    # summaries back for each step, we find where each group starts once and work on arrays 
+    # in group order, adding the results as columns to the one frame. 
+    order, group_id = ll.get_group_order(stop_area,
+                                         groupvars = ['filename','index_run_start','stop_id'])
+    
+    door_state = stop_area.door_state.to_numpy()[order]
+    fps_next = stop_area.fps_next.to_numpy(dtype = float)[order]
+    
     # Add binary variables
-    rawnav_fil_stop_area_2 = (
-        rawnav_fil_stop_area_1
-        .assign(
-            door_state_closed=lambda x: x.door_state == "C",
-            # note this returns False when fps_next is undefined. We'll have to handle this 
-            # carefully in later stages, as we don't want to inadvertently signal this as a change
-            # in status.
-            veh_state_moving=lambda x: x.fps_next > 0                                                                                               
-        )
-    )
+    door_state_closed = door_state == "C"
+    # note this returns False when fps_next is undefined. We'll have to handle this 
+    # carefully in later stages, as we don't want to inadvertently signal this as a change
+    # in status.
+    veh_state_moving = fps_next > 0
     
     # Add a sequential numbering that increments each time door changes in a run/segment combination   
-    rawnav_fil_stop_area_2['door_state_changes'] = (
-        rawnav_fil_stop_area_2
-        .groupby(['filename','index_run_start','stop_id'])['door_state_closed']
-        .transform(lambda x: x.diff().ne(0).cumsum())
-    )
+    door_state_changes = ll.group_change_count(door_state_closed, group_id)
     
     # We have to be more careful for vehicle state changes. At times, we'll get undefined speeds
     # (e.g., two pings have the same distance and time values) and given how such values are 
     # handled in python, this could be categorized  as a change in state if we use the 
-    # same approach as above. Instead, we'll create a separate
-    # table without 'bad' speed records, run the calc on state changes,
-    # join back to the original dataset,
-    # and then fill the missing values based on nearby ones.
+    # same approach as above. Instead, we'll count state changes only among records with 
+    # 'good' speeds and then fill the missing values based on nearby ones.
     # Filling based on surrounding values is itself imperfect, but likely to be sufficient 
     # in many cases. This still isn't the end of the story -- in cases where we see no vehicle
     # state changes but see the door open at some point, we'll assume the vehicle actually did
     # stop, however, briefly.
-    veh_state = (
-        rawnav_fil_stop_area_2
-        .filter(items = ['filename','index_run_start','stop_id','index_loc','veh_state_moving'])
-        .loc[~rawnav_fil_stop_area_2.fps_next.isnull()]
-    )
-    
-    veh_state['veh_state_changes'] = (
-            veh_state
-            .groupby(['filename','index_run_start','stop_id'])['veh_state_moving']
-            .transform(lambda x: x.diff().ne(0).cumsum())
-    )
-
-    rawnav_fil_stop_area_3 = (
-        rawnav_fil_stop_area_2
-        .merge(
-            veh_state
-            .drop(columns = ['veh_state_moving']),
-            on = ['filename','index_run_start','stop_id','index_loc'],
-            how = 'left'
-        )
-    )
+    fps_valid = ~np.isnan(fps_next)
+    veh_state_changes = np.full(len(order), np.nan)
+    veh_state_changes[fps_valid] = ll.group_change_count(veh_state_moving[fps_valid],
+                                                         group_id[fps_valid])
     
     # Note that this could miss cases of transition where the null value for speed occurs
     # at a stop where passengers board/alight. However, if that's the case, we don't use 
     # these values anyhow.
-    rawnav_fil_stop_area_3['veh_state_changes'] = (
-        rawnav_fil_stop_area_3
-        .groupby(['filename','index_run_start','stop_id'])['veh_state_changes']
-        .transform(lambda x: x.ffill())
-        .transform(lambda x: x.bfill())
-    )
-           
+    # Values are carried forward within a run and stop, then back in row order. The backward 
+    # fill isn't limited to the run and stop, so a stop area without any defined speeds picks 
+    # up the values of the following one.
+    veh_state_changes = ll.group_ffill(veh_state_changes, group_id)
+    
     # To identify the cases of the first door opening and last at each stop (needed for decomposition),
-    # we'll summarize to a different dataframe and rejoin. 
+    # we'll find the first and last door state counter where the door is open.
     # The 'min' is almost always 2, but we're extra careful here in case the door is open at the 
     # start of the segment.
     # 'max' will be interesting - we'll add anything after the first door closing to the last reclosing
     # as 't_l_addl' (which under some circumstances would be signal delay)
-    door_open_cases = (
-        rawnav_fil_stop_area_3
-        .loc[rawnav_fil_stop_area_3.door_state == "O"]
-        .groupby(['filename','index_run_start','stop_id','door_state'])
-        .agg({"door_state_changes" : ['min','max']})
-        .pipe(ll.reset_col_names)
-        .drop(columns = ['door_state'])
-    )
-       
-    # Before we make use of the door_open_cases min and max files, we'll do a similar check on where 
-    # the bus came to be not moving. The object namign is a little fuzzy here -- we'll call this
+    door_open = door_state == "O"
+    door_state_changes_min = ll.group_agg(door_state_changes, door_open, group_id, np.fmin)
+    door_state_changes_max = ll.group_agg(door_state_changes, door_open, group_id, np.fmax)
+
+    # Before we make use of the door open min and max, we'll do a similar check on where 
+    # the bus came to be not moving. The object naming is a little fuzzy here -- we'll call this
     # 'veh_stop' to distinguish that we're talking about the bus literally not moving, 
     # rather than something to do with a 'bus stop'. This helps with runs where the bus does not
     # stop at all.
-    veh_stop_cases = (
-        rawnav_fil_stop_area_3
-        .loc[(~rawnav_fil_stop_area_3.veh_state_moving & rawnav_fil_stop_area_3.fps_next.notnull())]
-        .groupby(['filename','index_run_start','stop_id','veh_state_moving'])
-        .agg({"veh_state_changes" : ['min','max']})
-        .pipe(ll.reset_col_names)
-        .rename(columns = {"filename_" : "filename",
-                          "index_run_start_": "index_run_start",
-                          "stop_id_":"stop_id",
-                          "veh_state_changes_min": "veh_stopped_min",
-                          "veh_state_changes_max": "veh_stopped_max"})
-        .drop(columns = ['veh_state_moving'])
-    )
-    
     # There will be nans remaining here from cases where bus did not stop or did not pick up 
     # passengers. This is okay, we'll handle these in a bit.
-
-    rawnav_fil_stop_area_4 = (
-        rawnav_fil_stop_area_3
-        .merge(
-            door_open_cases,
-            on = ['filename','index_run_start','stop_id'],
-            how = 'left'
-        )
-        .merge(
-            veh_stop_cases,
-            on = ['filename','index_run_start','stop_id'],
-            how = 'left'
-        )
-    )
+    veh_stopped = ~veh_state_moving & fps_valid
+    veh_stopped_min = ll.group_agg(veh_state_changes, veh_stopped, group_id, np.fmin)
+    veh_stopped_max = ll.group_agg(veh_state_changes, veh_stopped, group_id, np.fmax)
     
     # For convience in other downstream calcs, we'll add flags to help with certain cases 
     # where vehicle didn't stop at all or doors didn't open.
-    # Similar approach for door open but directly applied
-    rawnav_fil_stop_area_4['any_door_open'] = (
-        rawnav_fil_stop_area_4
-        .groupby(['filename','index_run_start','stop_id'])['door_state_closed']
-        .transform(lambda x: any(~x))       
-    )
+    any_door_open = ll.group_agg(~door_state_closed, np.ones(len(order), dtype = bool), 
+                                 group_id, np.fmax) == 1
     
-    # These will be decomposed a little bit differently.
-    # We'll reuse a table we made earlier since we've dealt with fps_next nulls here.
-    veh_state_any_move = (
-        veh_state 
-        .drop(columns = ['veh_state_changes'])
+    # These will be decomposed a little bit differently. Stop areas without any defined speeds
+    # are left undefined here and filled back in the same way as veh_state_changes below.
+    any_veh_stopped = ll.group_ffill(
+        np.where(fps_valid, ll.group_agg(veh_stopped, fps_valid, group_id, np.fmax), np.nan),
+        group_id
     )
     
-    veh_state_any_move['any_veh_stopped'] = (
-        veh_state_any_move
-        .groupby(['filename','index_run_start','stop_id'])['veh_state_moving']
-        .transform(lambda x: any(~x))
-    )
-
-    rawnav_fil_stop_area_4 = (
-        rawnav_fil_stop_area_4 
-        .merge(
-            veh_state_any_move
-            .drop(columns = ['veh_state_moving']),
-            on = ['filename','index_run_start','stop_id','index_loc'],
-            how = "left"
-        )
-        # some NA's may appear after join. We'll usually fill to address these (see below),
-    )
+    # Put the arrays back in row order and add them to the frame
+    inverse = np.empty(len(order), dtype = np.int64)
+    inverse[order] = np.arange(len(order))
     
-    rawnav_fil_stop_area_4['any_veh_stopped'] = (
-        rawnav_fil_stop_area_4
-        .groupby(['filename','index_run_start','stop_id'])['any_veh_stopped']
-        .transform(lambda x: x.ffill())
-        .transform(lambda x: x.bfill())
-    )
-
-   # in the case where we know doors opened, we'll override and say the vehicle
-   # stopped at some point.
-    rawnav_fil_stop_area_4 = (
-        rawnav_fil_stop_area_4
-        .assign(any_veh_stopped = lambda x: 
-                np.where(
-                    x.any_door_open,  
-                    True,
-                    x.any_veh_stopped
-                )
-        )
+    stop_area['door_state_closed'] = door_state_closed[inverse]
+    stop_area['veh_state_moving'] = veh_state_moving[inverse]
+    stop_area['door_state_changes'] = door_state_changes[inverse]
+    stop_area['veh_state_changes'] = ll.bfill_array(veh_state_changes[inverse])
+    stop_area['door_state_changes_min'] = door_state_changes_min[inverse]
+    stop_area['door_state_changes_max'] = door_state_changes_max[inverse]
+    stop_area['veh_stopped_min'] = veh_stopped_min[inverse]
+    stop_area['veh_stopped_max'] = veh_stopped_max[inverse]
+    stop_area['any_door_open'] = any_door_open[inverse]
+    any_veh_stopped = ll.bfill_array(any_veh_stopped[inverse])
+    # in the case where we know doors opened, we'll override and say the vehicle
+    # stopped at some point.
+    any_veh_stopped[stop_area.any_door_open.to_numpy()] = 1
+    stop_area['any_veh_stopped'] = (
+        pd.Series(any_veh_stopped == 1, dtype = object)
+        .where(~np.isnan(any_veh_stopped))
     )
-            
-    rawnav_fil_stop_area_5 = rawnav_fil_stop_area_4
+    
     # We start to sort row records into phase based on vars we've created. This is just a first cut.
-    rawnav_fil_stop_area_5['rough_phase_by_door'] = np.select(
+    stop_area['rough_phase_by_door'] = np.select(
         [
-            (rawnav_fil_stop_area_5.door_state_changes < rawnav_fil_stop_area_5.door_state_changes_min), 
-            ((rawnav_fil_stop_area_5.door_state == "O") 
-              & (rawnav_fil_stop_area_5.door_state_changes == rawnav_fil_stop_area_5.door_state_changes_min)),
-            (rawnav_fil_stop_area_5.door_state_changes > rawnav_fil_stop_area_5.door_state_changes_min),
-            (rawnav_fil_stop_area_5.door_state_changes_min.isnull()),
+            (stop_area.door_state_changes < stop_area.door_state_changes_min), 
+            ((stop_area.door_state == "O") 
+              & (stop_area.door_state_changes == stop_area.door_state_changes_min)),
+            (stop_area.door_state_changes > stop_area.door_state_changes_min),
+            (stop_area.door_state_changes_min.isnull()),
         ], 
         [
             "t_decel_phase", #we'll cut this up a bit further later
@@ -495,14 +437,14 @@ def decompose_stop_area(rawnav,
     # stop earlier at t_5 and again at t_10; thus, the phase as calculated by veh state and 
     # by door state can be inconsistent). In practice, we won't use the values in this column except
     # in some special cases where bus is not serving pax.
-    rawnav_fil_stop_area_5['rough_phase_by_veh_state'] = np.select(
+    stop_area['rough_phase_by_veh_state'] = np.select(
        [
-        (rawnav_fil_stop_area_5.veh_state_changes < rawnav_fil_stop_area_5.veh_stopped_min),
-        (rawnav_fil_stop_area_5.veh_state_changes == rawnav_fil_stop_area_5.veh_stopped_min),
-        ((rawnav_fil_stop_area_5.veh_state_changes > rawnav_fil_stop_area_5.veh_stopped_min)
-         & (rawnav_fil_stop_area_5.veh_state_changes <= rawnav_fil_stop_area_5.veh_stopped_max)),
-        (rawnav_fil_stop_area_5.veh_state_changes > rawnav_fil_stop_area_5.veh_stopped_max),
-        (rawnav_fil_stop_area_5.veh_stopped_min.isnull())
+        (stop_area.veh_state_changes < stop_area.veh_stopped_min),
+        (stop_area.veh_state_changes == stop_area.veh_stopped_min),
+        ((stop_area.veh_state_changes > stop_area.veh_stopped_min)
+         & (stop_area.veh_state_changes <= stop_area.veh_stopped_max)),
+        (stop_area.veh_state_changes > stop_area.veh_stopped_max),
+        (stop_area.veh_stopped_min.isnull())
        ],     
        [
         "t_decel_phase",
@@ -519,38 +461,42 @@ def decompose_stop_area(rawnav,
     # Note that based on t_stop1 definition, this only happens first time bus opens doors
     # This will be off in cases where the bus has door open time (t_stop1) but 
     # the vehicle never appears to stop, but our logic downstream will be unaffected.
-    rawnav_fil_stop_area_5['at_stop']= (
-        rawnav_fil_stop_area_5
-        .groupby(['filename','index_run_start','stop_id','veh_state_changes'])['rough_phase_by_door']
-        .transform(lambda var: var.isin(['t_stop1']).any())
-    )
+    # Rows are put in order by run, stop and veh_state_changes so that each combination is a 
+    # block of rows.
+    veh_state_changes = stop_area.veh_state_changes.to_numpy()[order]
+    order_veh_state = np.lexsort((veh_state_changes, group_id))
+    veh_state_changes = veh_state_changes[order_veh_state]
+    veh_state_group_id = np.cumsum(
+        (np.diff(group_id[order_veh_state], prepend = -1) != 0)
+        | (np.diff(veh_state_changes, prepend = np.nan) != 0)
+    )
+    at_stop = np.empty(len(order), dtype = bool)
+    at_stop[order[order_veh_state]] = ll.group_agg(
+        stop_area.rough_phase_by_door.to_numpy()[order[order_veh_state]] == "t_stop1",
+        ~np.isnan(veh_state_changes), 
+        veh_state_group_id, 
+        np.fmax
+    ) == 1
     
     # Though not strictly necessary, we'll fix teh cases where the vehicle never really stops
     # but we see door open time. Just in case anyone goes looking, don't want incorrect values
-    rawnav_fil_stop_area_5 = (
-        rawnav_fil_stop_area_5 
-        .assign(
-            at_stop = lambda x: 
-                np.where(
-                    x.veh_stopped_min.isna().to_numpy() 
-                    & (x.rough_phase_by_door.to_numpy() != "t_stop1"),
-                    False,
-                    x.at_stop
-                )
-        )
+    stop_area['at_stop'] = (
+        at_stop
+        & ~(stop_area.veh_stopped_min.isna().to_numpy() 
+            & (stop_area.rough_phase_by_door.to_numpy() != "t_stop1"))
     )
 
-    rawnav_fil_stop_area_5['at_stop_phase'] = np.select(
+    stop_area['at_stop_phase'] = np.select(
         [
-            ((rawnav_fil_stop_area_5.at_stop) 
+            ((stop_area.at_stop) 
              # One might consider condition that is less sensitive. Maybe speed under 2 mph?
              # Note that we don't use a test on fps_next because 0 dist and 0 second ping could
              # lead to NA value
-                 & (rawnav_fil_stop_area_5.odom_ft_marg == 0)
-                 & (rawnav_fil_stop_area_5.rough_phase_by_door == "t_decel_phase")),
-            ((rawnav_fil_stop_area_5.at_stop) 
-                & (rawnav_fil_stop_area_5.odom_ft_marg == 0)
-                & (rawnav_fil_stop_area_5.rough_phase_by_door == "t_accel_phase"))
+                 & (stop_area.odom_ft_marg == 0)
+                 & (stop_area.rough_phase_by_door == "t_decel_phase")),
+            ((stop_area.at_stop) 
+                & (stop_area.odom_ft_marg == 0)
+                & (stop_area.rough_phase_by_door == "t_accel_phase"))
         ],
         [
             "t_l_initial",
@@ -560,39 +506,31 @@ def decompose_stop_area(rawnav,
     )
 
     # Finally, we combine the door state columns for the decomposition
-    rawnav_fil_stop_area_6 = (
-        rawnav_fil_stop_area_5
-        # Assign the at_stop_phase corrections
-        .assign(stop_area_phase = lambda x: np.where(x.at_stop_phase != "NA",
-                                                     x.at_stop_phase,
-                                                     x.rough_phase_by_door))
-        # Assign the additional records between the first door closing to last door closing to
-        # t_l_addl as well
-        .assign(stop_area_phase = lambda x: np.where(
-            (x.stop_area_phase == "t_accel_phase")
-            & (x.door_state_changes <= x.door_state_changes_max),
-            "t_l_addl",
-            x.stop_area_phase
-            )
-        )
+    # Assign the at_stop_phase corrections
+    stop_area['stop_area_phase'] = np.where(stop_area.at_stop_phase != "NA",
+                                            stop_area.at_stop_phase,
+                                            stop_area.rough_phase_by_door)
+    # Assign the additional records between the first door closing to last door closing to
+    # t_l_addl as well
+    stop_area['stop_area_phase'] = np.where(
+        (stop_area.stop_area_phase == "t_accel_phase")
+        & (stop_area.door_state_changes <= stop_area.door_state_changes_max),
+        "t_l_addl",
+        stop_area.stop_area_phase
     )
     # And we do a final pass cleaning up the runs that don't serve passengers or don't stop at all
-    stop_area_decomp = (  
-        rawnav_fil_stop_area_6
-        # runs that don't stop
-        .assign(stop_area_phase = lambda x: np.where(x.any_veh_stopped == False,
-                                                     "t_nostopnopax",
-                                                     x.stop_area_phase))
-        .assign(stop_area_phase = lambda x: np.where(((x.any_door_open == False) 
-                                                      & (x.any_veh_stopped == True)),
-                                                     x.rough_phase_by_veh_state,
-                                                     x.stop_area_phase)
-        )
-    )
+    # runs that don't stop
+    stop_area['stop_area_phase'] = np.where(stop_area.any_veh_stopped == False,
+                                            "t_nostopnopax",
+                                            stop_area.stop_area_phase)
+    stop_area['stop_area_phase'] = np.where(((stop_area.any_door_open == False) 
+                                             & (stop_area.any_veh_stopped == True)),
+                                            stop_area.rough_phase_by_veh_state,
+                                            stop_area.stop_area_phase)
     
     # Note: Columns maintained in output are likely excessive for most needs, but are left in 
     # for any debugging necessary.
-    return(stop_area_decomp)
+    return(stop_area)
 
 # Helper Functions 
 # ################
@@ -634,6 +572,10 @@ def filter_to_segment(rawnav,
     return(rawnav_seg_fil)
     
 
+# Fields added by calc_rolling_vals
+rolling_vals_cols = ['odom_ft_next', 'sec_past_st_next', 'odom_ft_next3', 'sec_past_st_next3',
+                     'secs_marg', 'odom_ft_marg', 'fps_next', 'fps_next3']
+
 def calc_rolling_vals(rawnav,
                       groupvars = ['filename','index_run_start']):
     """
@@ -643,7 +585,7 @@ def calc_rolling_vals(rawnav,
     groupvars: list of column names. 
     Returns
     -------
-    rawnav_add: pd.DataFrame, rawnav data with additional fields.
+    rawnav_add: pd.DataFrame, copy of rawnav data with additional fields. rawnav is left as is.
     Notes
     -----
     Because wmatarawnav functions generally leave source rawnav data untouched except 
@@ -653,24 +595,38 @@ def calc_rolling_vals(rawnav,
     
     By default calculations are grouped by run, but in certain phases of data processing, it
     can be appropriate to group by run and stop.
+    
+    To avoid repeating the calculations by run, call this once on the rawnav data for a 
+    partition (ala rawnav = calc_rolling_vals(rawnav)) before passing it to the decomposition
+    functions. decompose_segment_ff and decompose_traveltime reuse these columns when present.
+    decompose_stop_area still recalculates them by run and stop within the segment, as values
+    for the last points in a segment should not look past the segment end.
     """
+    # Find the next and third next rows in each group from where each group ends, rather than
+    # shifting each column by group
+    order, group_id = ll.get_group_order(rawnav, groupvars)
+    starts = ll.get_group_starts(group_id)
+    group_end = np.append(np.flatnonzero(starts)[1:], len(order))[np.cumsum(starts) - 1]
+    positions = np.arange(len(order))
+    
+    odom_sec = rawnav[['odom_ft','sec_past_st']].to_numpy(dtype = float)[order]
     
-    rawnav[['odom_ft_next','sec_past_st_next']] = (
-        rawnav
-        .groupby(groupvars, sort = False)[['odom_ft','sec_past_st']]
-        .shift(-1)
-    )
-
     # We'll use a bigger lag for more stable values for free flow speed
-    rawnav[['odom_ft_next3','sec_past_st_next3']] = (
-        rawnav
-        .groupby(groupvars, sort = False)[['odom_ft','sec_past_st']]
-        .shift(-3)
-    )
+    lead = {}
+    for lag in [1, 3]:
+        lead_ordered = np.full(odom_sec.shape, np.nan)
+        lead_ordered[:-lag] = odom_sec[lag:]
+        lead_ordered[(positions + lag >= group_end) | (group_id < 0)] = np.nan
+        lead[lag] = np.empty_like(lead_ordered)
+        lead[lag][order] = lead_ordered
     
     rawnav_add = (
         rawnav
         .assign(
+            odom_ft_next=lead[1][:, 0],
+            sec_past_st_next=lead[1][:, 1],
+            odom_ft_next3=lead[3][:, 0],
+            sec_past_st_next3=lead[3][:, 1],
             secs_marg=lambda x: x.sec_past_st_next - x.sec_past_st,
             odom_ft_marg=lambda x: x.odom_ft_next - x.odom_ft,
             fps_next=lambda x: ((x.odom_ft_next - x.odom_ft) / 
@@ -681,6 +637,17 @@ def calc_rolling_vals(rawnav,
     )
     
     return(rawnav_add)
+
+def has_rolling_vals(rawnav):
+    """
+    Parameters
+    ----------
+    rawnav: pd.DataFrame, rawnav data.
+    Returns
+    -------
+    bool, whether rawnav already has all of the fields added by calc_rolling_vals.
+    """
+    return(set(rolling_vals_cols).issubset(rawnav.columns))
     
 def calc_ad_decomp(nonstop,stop, summary):
     """
@@ -717,17 +684,18 @@ def calc_ad_decomp(nonstop,stop, summary):
 
     ad_method_stop_by_run = (
         stop
-        .groupby(['filename','index_run_start','seg_name_id'], as_index = False)
+        .groupby(['filename','index_run_start','seg_name_id'], as_index = False, observed = True)
         # drop the last record, since we're about to sum the marginal values. 
         .apply(lambda x: x.iloc[:-1])
-        .groupby(['filename','index_run_start','seg_name_id','stop_area_phase'])
+        .groupby(['filename','index_run_start','seg_name_id','stop_area_phase'], observed = True)
         .agg({'secs_marg' : ['sum']})
         .pipe(ll.reset_col_names)
         .rename(columns = {'secs_marg_sum':'secs'})
         .pivot_table(
             index = ['filename','index_run_start','seg_name_id'],
             columns = ['stop_area_phase'],
-            values = ['secs']
+            values = ['secs'],
+            observed = True
         )
        .pipe(ll.reset_col_names)
     )
@@ -745,7 +713,8 @@ def calc_ad_decomp(nonstop,stop, summary):
         .pivot_table(
             index = ['filename','index_run_start','seg_name_id'],
             values = ['subsegment_min_sec','subsegment_delay_sec'],
-            columns = ['segment_part']
+            columns = ['segment_part'],
+            observed = True
         )
         .pipe(ll.reset_col_names)
     )
@@ -6,9 +6,16 @@ Created on Mon Jul  6 22:38:06 2020
 """
 import pandas as pd 
 import geopandas as gpd
-from shapely.geometry import Point
 from scipy.spatial import cKDTree
 import numpy as np
+import bisect
+from functools import lru_cache
+from pyproj import Transformer
+try:
+    from shapely import get_coordinates, get_num_coordinates
+except ImportError:
+    # Shapely < 2, see explode_first_last
+    get_coordinates = None
 
 
 def tribble(columns, *data):
@@ -75,8 +82,12 @@ def drop_geometry(gdf):
     -------
     df: pd.DataFrame
        Dataframe containing all columns of the GeoDataFrame except for 'geometry', inspired
-       by sf::st_drop_geometry and https://github.com/geopandas/geopandas/issues/544
+       by sf::st_drop_geometry and https://github.com/geopandas/geopandas/issues/544. 
+       DataFrames without geometry are returned as is.
     """
+    if not isinstance(gdf, gpd.GeoDataFrame):
+        return(pd.DataFrame(gdf))
+    
     df = pd.DataFrame(gdf[[col for col in gdf.columns if col != gdf._geometry_column_name]])
     
     return(df)
@@ -91,43 +102,101 @@ def explode_first_last(gdf):
     -------
     line_first_last: gpd.DataFrame, geodataframe with one row for the first and last vertex 
         of each geometry in the input gdf. The attributes of each original row are carried 
-        forward to the output gdf.
+        forward to the output gdf with their original dtypes. Vertices keep their Z coordinate
+        if every line has one, otherwise only x and y are kept.
     """
     assert(all(gdf.geom_type.to_numpy() == "LineString")), print("Currently only LineString segment geometry supported")
-    line_first_last_list = []
-     
-    # Not especially pythonic, but preserves dtypes nicely relative to itertuples and esp. iterrows
-    for i in range(0,len(gdf)):
-
-        justone = gdf.iloc[i,:]
-        
-        # There are issues if only one segment is passed
-        if (isinstance(justone,pd.Series)):
-            justone = justone.to_frame().transpose()
-            justone = gpd.GeoDataFrame(justone, crs = gdf.crs, geometry = "geometry")
-    
-        first_point = Point(list(justone['geometry'].iloc[0].coords)[0])
-        last_point = Point(list(justone['geometry'].iloc[0].coords)[-1])
-        
-        first_row = gpd.GeoDataFrame(
-            drop_geometry(justone).assign(location = 'first'),
-            geometry = [first_point],
-            crs = justone.crs)
-        
-        last_row = gpd.GeoDataFrame(
-            drop_geometry(justone).assign(location = 'last'),
-            geometry = [last_point],
-            crs = justone.crs)
-
-        line_first_last_list.append(first_row)
-        line_first_last_list.append(last_row)
-    
-    line_first_last = gpd.GeoDataFrame(pd.concat( line_first_last_list, ignore_index=True, axis = 0),
-                                       crs = gdf.crs)
+    
+    # Rows for the first and last vertex of each line, in the order first_0, last_0, first_1, ...
+    line_pos = np.repeat(np.arange(len(gdf)), 2)
+    
+    n_dim = 3 if (len(gdf) > 0 and gdf.has_z.all()) else 2
+    if get_coordinates is not None:
+        # Vertices of all lines at once, taking the first and last of each by its offset
+        lines = gdf.geometry.to_numpy()
+        line_coords = get_coordinates(lines, include_z = (n_dim == 3))
+        line_n_coords = get_num_coordinates(lines)
+        line_ends = np.cumsum(line_n_coords)
+        line_starts = line_ends - line_n_coords
+        vertex_xy = line_coords[np.column_stack([line_starts, line_ends - 1]).ravel()]
+    else:
+        vertex_xy = np.array(
+            [(line.coords[0][:n_dim], line.coords[-1][:n_dim]) for line in gdf.geometry.to_numpy()],
+            dtype = float
+        ).reshape(-1, n_dim)
+    
+    line_first_last = (
+        drop_geometry(gdf)
+        .iloc[line_pos]
+        .reset_index(drop=True)
+        .assign(location = np.tile(['first', 'last'], len(gdf)))
+    )
+    
+    line_first_last = gpd.GeoDataFrame(
+        line_first_last,
+        geometry = gpd.points_from_xy(vertex_xy[:, 0], vertex_xy[:, 1], 
+                                      vertex_xy[:, 2] if n_dim == 3 else None),
+        crs = gdf.crs
+    )
     
     return(line_first_last)
 
-def ckdnearest(gdA, gdB):
+def get_xy_array(gdf, xy_cols=None):
+    """
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame, pd.DataFrame or np.ndarray
+        points, or an array of coordinates with x and y in its two columns
+    xy_cols : list
+        columns of gdf with x and y coordinates, ala ['x_ft', 'y_ft']. The default None uses
+        the geometry of a GeoDataFrame, and the x_ft and y_ft columns of other DataFrames (see
+        add_projected_xy).
+    Returns
+    -------
+    xy : np.ndarray
+        array of x and y coordinates with a row per point, read without iterating over points
+    """
+    if isinstance(gdf, np.ndarray):
+        assert (gdf.ndim == 2 and gdf.shape[1] == 2), print("Coordinate arrays need two columns")
+        return gdf.astype('float64', copy=False)
+    if (xy_cols is None) and (not isinstance(gdf, gpd.GeoDataFrame)):
+        xy_cols = ['x_ft', 'y_ft']
+    if xy_cols is not None:
+        return np.column_stack([gdf[xy_cols[0]].to_numpy(dtype='float64'),
+                                gdf[xy_cols[1]].to_numpy(dtype='float64')])
+    return np.column_stack([gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy()])
+
+def add_projected_xy(df, crs_to="EPSG:2248", xy_cols=['x_ft', 'y_ft'], lonlat_cols=['long', 'lat']):
+    """
+    Parameters
+    ----------
+    df : pd.DataFrame
+        data with longitude and latitude columns in decimal degrees (EPSG:4326), such as 
+        rawnav data
+    crs_to : str
+        CRS to project to. The default EPSG:2248 (Maryland State Plane, US survey feet) is the
+        CRS used for measurement in the merge functions.
+    xy_cols : list
+        names of the projected x and y columns to add
+    lonlat_cols : list
+        names of the longitude and latitude columns of df, ala ['stop_lon', 'stop_lat'] for 
+        wmata schedule data. The default is ['long', 'lat'].
+    Returns
+    -------
+    df : pd.DataFrame
+        copy of df with the projected coordinates in xy_cols
+    Notes
+    -----
+    Same coordinates as building points with gpd.points_from_xy and calling to_crs, but 
+    projected as arrays without creating shapely objects. Missing lat/long give missing x/y.
+    """
+    transformer = get_transformer("EPSG:4326", crs_to)
+    x, y = transformer.transform(df[lonlat_cols[0]].to_numpy(dtype='float64'), 
+                                 df[lonlat_cols[1]].to_numpy(dtype='float64'))
+    df = df.assign(**{xy_cols[0]: np.asarray(x), xy_cols[1]: np.asarray(y)})
+    return(df)
+
+def ckdnearest(gdA, gdB, return_indices=False):
     """
     # https://gis.stackexchange.com/questions/222315/geopandas-find-nearest-point-in-other-dataframe
     Parameters
@@ -136,26 +205,269 @@ def ckdnearest(gdA, gdB):
         typically wmata schedule data for the correct route and direction.
     gdB : gpd.GeoDataFrame
         rawnav data: only nearest points to gdA are kept in the output.
+    return_indices : bool
+        if True, return only distances and positions of the nearest points, in which case 
+        gdA and gdB can also be coordinate arrays, see get_xy_array. The default is False.
     Returns
     -------
     gdf : gpd.GeoDataFrame
         wmata schedule data for the correct route and direction with the closest rawnav point.
+    dist, idx : np.ndarray
+        if return_indices, the distance from each row of gdA to the nearest row of gdB and 
+        the position of that row in gdB.
+    Notes
+    -----
+    gdA and gdB are not modified.
     """
-    
-    gdA.reset_index(inplace=True, drop=True);
-    gdB.reset_index(inplace=True, drop=True)
-    nA = np.array(list(zip(gdA.geometry.x, gdA.geometry.y)))
-    nB = np.array(list(zip(gdB.geometry.x, gdB.geometry.y)))
+    nA = get_xy_array(gdA)
+    nB = get_xy_array(gdB)
     btree = cKDTree(nB)
     dist, idx = btree.query(nA, k=1)
+    if return_indices:
+        return dist, idx
+    
     gdf = pd.concat(
         [gdA.reset_index(drop=True),
-         gdB.loc[idx, ['filename', 'index_run_start', 'index_loc', 'odom_ft', 'sec_past_st', 'lat', 'long']].reset_index(
+         gdB[['filename', 'index_run_start', 'index_loc', 'odom_ft', 'sec_past_st', 'lat', 'long']].iloc[idx].reset_index(
              drop=True),
          pd.Series(dist, name='dist_to_nearest_point')], axis=1)
     return gdf
 
 
+def longest_nondecreasing_mask(values):
+    """
+    Parameters
+    ----------
+    values : np.ndarray
+        sequence of values, ala index_loc of the rawnav point nearest each stop in stop order
+    Returns
+    -------
+    keep : np.ndarray
+        boolean mask of the longest subsequence of values that never decreases. Where several
+        are equally long, earlier values are kept in preference to later ones.
+    """
+    n = len(values)
+    # Length of the longest non-decreasing subsequence starting at each value, found by 
+    # patience sorting the negated values in reverse
+    length_from = np.empty(n, dtype=np.int64)
+    tails = []
+    for i in range(n - 1, -1, -1):
+        j = bisect.bisect_right(tails, -values[i])
+        if j == len(tails):
+            tails.append(-values[i])
+        else:
+            tails[j] = -values[i]
+        length_from[i] = j + 1
+    
+    keep = np.zeros(n, dtype=bool)
+    need = len(tails)
+    last = None
+    for i in range(n):
+        if need == 0:
+            break
+        if length_from[i] == need and (last is None or values[i] >= last):
+            keep[i] = True
+            last = values[i]
+            need -= 1
+    return keep
+
+def ckdnearest_groups(gdA, gdB, group_cols, xy_cols=None):
+    """
+    Parameters
+    ----------
+    gdA : gpd.GeoDataFrame
+        typically wmata schedule data for the correct route and direction.
+    gdB : gpd.GeoDataFrame
+        rawnav data: only nearest points to gdA in each group are kept in the output.
+    group_cols : list
+        columns of gdB identifying groups, typically ['filename', 'index_run_start']
+    xy_cols : list
+        columns of gdA and gdB with x and y coordinates, see get_xy_array. The default None 
+        uses the geometry of GeoDataFrames and x_ft/y_ft of other DataFrames.
+    Returns
+    -------
+    gdf : gpd.GeoDataFrame
+        gdA repeated for each group in gdB with the closest rawnav point in that group, same 
+        columns and index as stacking the results of ckdnearest for each group. Groups are 
+        in sorted order, as with gdB.groupby(group_cols).
+    Notes
+    -----
+    Same results as calling ckdnearest on each group, including which point is returned when
+    several are equally near, but coordinates are taken from the geometries once and the 
+    output is built in one step rather than per group.
+    """
+    group_id = gdB.groupby(group_cols, sort=True, observed=True).ngroup().to_numpy()
+    
+    # Positions of gdB rows by group, keeping row order within groups
+    posB = np.argsort(group_id, kind='stable')
+    posB = posB[group_id[posB] >= 0]
+    group_bounds = np.flatnonzero(np.diff(group_id[posB])) + 1
+    group_starts = np.concatenate([[0], group_bounds])
+    group_stops = np.concatenate([group_bounds, [len(posB)]])
+    
+    nA = get_xy_array(gdA, xy_cols)
+    nB = get_xy_array(gdB, xy_cols)[posB]
+    
+    # group_starts always holds the start of a first group, so there are no groups if gdB has no rows
+    n_groups = len(group_starts) if len(posB) else 0
+    dist = np.empty((n_groups, len(nA)))
+    idx = np.empty((n_groups, len(nA)), dtype=np.int64)
+    for i in range(n_groups):
+        btree = cKDTree(nB[group_starts[i]:group_stops[i]])
+        dist[i], idx[i] = btree.query(nA, k=1)
+        idx[i] += group_starts[i]
+    
+    query_posA = np.tile(np.arange(len(nA)), n_groups)
+    gdf = pd.concat(
+        [gdA.iloc[query_posA].reset_index(drop=True),
+         gdB[['filename', 'index_run_start', 'index_loc', 'odom_ft', 'sec_past_st', 'lat', 'long']].iloc[posB[idx.ravel()]].reset_index(
+             drop=True),
+         pd.Series(dist.ravel(), name='dist_to_nearest_point')], axis=1)
+    gdf.index = query_posA
+    return gdf
+
+
+def get_group_order(df, groupvars):
+    """
+    Parameters
+    ----------
+    df : pd.DataFrame
+        data with one or more rows per group, ala rawnav data for several runs.
+    groupvars : list
+        columns of df identifying groups, ala ['filename', 'index_run_start']
+    Returns
+    -------
+    order : np.ndarray
+        positions of df rows by group, keeping row order within groups. Groups are in order of 
+        first appearance, so this is just the row positions when each group's rows are together.
+    group_id : np.ndarray
+        group number of each row in that order, never decreasing. Rows with a missing value in
+        groupvars are numbered -1, as with df.groupby(groupvars).ngroup().
+    """
+    group_id = df.groupby(groupvars, sort=False, observed=True).ngroup().to_numpy()
+    if (np.diff(group_id) >= 0).all():
+        order = np.arange(len(group_id))
+    else:
+        order = np.argsort(group_id, kind='stable')
+    return order, group_id[order]
+
+def get_group_starts(group_id):
+    """
+    Parameters
+    ----------
+    group_id : np.ndarray
+        group of each row, with each group's rows together
+    Returns
+    -------
+    starts : np.ndarray
+        boolean mask, True for the first row of each group
+    """
+    starts = np.ones(len(group_id), dtype=bool)
+    starts[1:] = group_id[1:] != group_id[:-1]
+    return starts
+
+def group_change_count(values, group_id):
+    """
+    Parameters
+    ----------
+    values : np.ndarray
+        values of a state, ala whether the door is closed
+    group_id : np.ndarray
+        group of each row, with each group's rows together
+    Returns
+    -------
+    changes : np.ndarray
+        numbering of the rows in each group that starts at 1 and increases by one each time 
+        the value changes. Same as groupby(...).transform(lambda x: x.diff().ne(0).cumsum()).
+    """
+    starts = get_group_starts(group_id)
+    change = starts.copy()
+    change[1:] |= values[1:] != values[:-1]
+    changes = np.cumsum(change)
+    # Subtract the count before each group's first row
+    changes -= np.maximum.accumulate(np.where(starts, changes - 1, 0))
+    return changes
+
+def group_agg(values, mask, group_id, ufunc):
+    """
+    Parameters
+    ----------
+    values : np.ndarray
+        values to summarize
+    mask : np.ndarray
+        boolean mask of the values to include
+    group_id : np.ndarray
+        group of each row, with each group's rows together
+    ufunc : np.ufunc
+        nan-ignoring reduction, np.fmin or np.fmax
+    Returns
+    -------
+    agg : np.ndarray
+        float summary of the masked values in each group, repeated for each row of the group. 
+        Groups without any masked values are nan.
+    """
+    if len(values) == 0:
+        return np.empty(0)
+    starts = get_group_starts(group_id)
+    agg = ufunc.reduceat(np.where(mask, values, np.nan), np.flatnonzero(starts))
+    return agg[np.cumsum(starts) - 1]
+
+def group_ffill(values, group_id):
+    """
+    Parameters
+    ----------
+    values : np.ndarray
+        float values with nans to fill
+    group_id : np.ndarray
+        group of each row, with each group's rows together
+    Returns
+    -------
+    filled : np.ndarray
+        values with nans replaced by the last value before them in the same group, as with 
+        groupby(...).ffill(). Nans before the first value in a group are left as they are.
+    """
+    positions = np.arange(len(values))
+    last_valid = np.maximum.accumulate(np.where(np.isnan(values), -1, positions))
+    group_start = np.maximum.accumulate(np.where(get_group_starts(group_id), positions, 0))
+    filled = np.where(last_valid >= group_start, values[last_valid], np.nan)
+    return filled
+
+def bfill_array(values):
+    """
+    Parameters
+    ----------
+    values : np.ndarray
+        float values with nans to fill
+    Returns
+    -------
+    filled : np.ndarray
+        values with nans replaced by the next value after them, as with pd.Series.bfill().
+    """
+    n = len(values)
+    next_valid = np.minimum.accumulate(
+        np.where(np.isnan(values), n, np.arange(n))[::-1]
+    )[::-1]
+    filled = np.where(next_valid < n, values[np.minimum(next_valid, n - 1)], np.nan)
+    return filled
+
+@lru_cache(maxsize=None)
+def get_transformer(crs_from, crs_to):
+    """
+    Parameters
+    ----------
+    crs_from: str
+        CRS of input coordinates, ala "EPSG:4326"
+    crs_to: str
+        CRS of output coordinates, ala "EPSG:3310"
+    Returns
+    -------
+    transformer: pyproj.Transformer
+        Transformer between the two CRS, taking and returning coordinates in x, y (long, lat)
+        order. Transformers are slow to create, so they are cached and reused across calls.
+    """
+    transformer = Transformer.from_crs(crs_from, crs_to, always_xy=True)
+    return(transformer)
+
 def reset_col_names(df):
     """
     # https://gis.stackexchange.com/questions/222315/geopandas-find-nearest-point-in-other-dataframe
@@ -5,10 +5,20 @@ Created on Tue Apr 28 15:07:59 2020
 Purpose: Functions for processing rawnav & wmata_schedule data
 """
 import os
+import glob
+import json
+import hashlib
+import tempfile
+import sqlite3
 import inflection
 import pandas as pd
-import pyodbc
+try:
+    import pyodbc
+except ImportError:
+    # Only needed to read the schedule db from access, see read_sched_db_tables
+    pyodbc = None
 import geopandas as gpd
+import pyproj
 from shapely.geometry import Point
 from shapely.geometry import LineString
 import numpy as np
@@ -17,26 +27,182 @@ from folium import plugins
 import re
 from . import low_level_fns as ll
 
+# Feet per unit of projected coordinates, see merge_rawnav_target_xy
+unit_to_ft = {'ft': 1.0, 'm': 3.28084}
+
 
 def read_sched_db_patterns(path,
                            analysis_routes,
                            UID="",
-                           PWD=""):
+                           PWD="",
+                           source=None,
+                           cache_dir=None):
     """
     Parameters
     ----------
     path: str,
-        full path to the wmata schedule db
+        full path to the wmata schedule db. See read_sched_db_tables for the sources that 
+        can be read.
     analysis_routes: list,
         list of route names to filter schedule db to
     UID: str,
         user id used to access db, if needed
     PWD: str,
         password used to access db, if needed
+    source: str, optional
+        one of 'access', 'csv' or 'sqlite'. The default None infers the source from path.
+    cache_dir: str, optional
+        directory used to cache the joined pattern and stop table between calls. The default
+        None reads the schedule db on every call.
     Returns
     -------
     wmata_schedule_dat: pd.DataFrame, wmata_schedule data
+    Notes
+    -----
+    The cache holds the table for all routes, so calls with different analysis_routes share 
+    it. Cached tables are keyed on a hash of the schedule db's contents, see 
+    hash_sched_db_source.
+    """
+    if cache_dir is None:
+        pattern_pattern_detail_stop_dat = clean_sched_db_tables(
+            *read_sched_db_tables(path, UID=UID, PWD=PWD, source=source))
+    else:
+        pattern_pattern_detail_stop_dat = read_sched_db_patterns_cached(
+            path, cache_dir, analysis_routes=analysis_routes, UID=UID, PWD=PWD, source=source)
+
+    # Filter to Relevant Routes
+    q_jump_route_list = analysis_routes
+    pattern_pattern_detail_stop_q_jump_route_dat = (
+        pattern_pattern_detail_stop_dat
+        .query('route in @q_jump_route_list')
+        .reset_index(drop=True)
+    )
+    if set(pattern_pattern_detail_stop_q_jump_route_dat.route.unique()) != set(q_jump_route_list):
+        miss_routes = set(q_jump_route_list) - set(pattern_pattern_detail_stop_q_jump_route_dat.route.unique())
+        print("Schedule data does not include the following route(s): {}".format(miss_routes))
+
+    (pattern_pattern_detail_stop_q_jump_route_dat
+     .sort_values(by=['route', 'pattern', 'order'], inplace=True)
+    )
+
+    # Check for Missing Lat Long In Stops   
+    mask_nan_latlong = (
+        pattern_pattern_detail_stop_q_jump_route_dat[['stop_lat', 'stop_lon']].isna().all(axis=1)
+    )
+    
+    assert_stop_sort_order_zero_has_nan_latlong = (
+        sum(pattern_pattern_detail_stop_q_jump_route_dat[mask_nan_latlong].stop_sort_order - 0)
+    )
+        
+    assert (assert_stop_sort_order_zero_has_nan_latlong == 0), \
+        print("Missing LatLong values found for stops, please address in source database")
+
+    # Ensure Table Values are Consistent and then Drop Superfluous Cols
+    assert (0 == sum(~ pattern_pattern_detail_stop_q_jump_route_dat.
+                     eval('''direction==pub_route_dir& route==ta_route''')))
+    pattern_pattern_detail_stop_q_jump_route_dat.drop(columns=['pub_route_dir', 'ta_route'], inplace=True)
+
+    return pattern_pattern_detail_stop_q_jump_route_dat
+
+
+def read_sched_db_tables(path,
+                         UID="",
+                         PWD="",
+                         source=None):
     """
+    Parameters
+    ----------
+    path: str,
+        full path to the wmata schedule db. One of:
+            an access db (.mdb or .accdb), read with pyodbc and the Microsoft Access Driver
+            a sqlite db (.sqlite, .sqlite3 or .db) holding the same tables
+            a directory of csv exports of the tables, named as '<prefix>Stop.csv', 
+            '<prefix>Pattern.csv' and '<prefix>PatternDetail.csv' 
+    UID: str,
+        user id used to access db, if needed. Only used for access dbs.
+    PWD: str,
+        password used to access db, if needed. Only used for access dbs.
+    source: str, optional
+        one of 'access', 'csv' or 'sqlite'. The default None infers the source from path.
+    Returns
+    -------
+    stop_dat, pattern_dat, pattern_detail_dat: pd.DataFrame,
+        Stop, Pattern and PatternDetail tables as stored in the schedule db
+    """
+    if source is None:
+        source = infer_sched_db_source(path)
+
+    if source == 'access':
+        cnxn = connect_sched_db_access(path, UID=UID, PWD=PWD)
+    elif source == 'sqlite':
+        cnxn = sqlite3.connect(path)
+    elif source == 'csv':
+        table_paths = find_sched_db_csv_tables(path)
+        # Route names like '70' would otherwise be read as numbers
+        return (pd.read_csv(table_paths['Stop']),
+                pd.read_csv(table_paths['Pattern'], dtype={'CDRoute': str, 'TARoute': str}),
+                pd.read_csv(table_paths['PatternDetail']))
+    else:
+        raise ValueError("source should be one of 'access', 'csv' or 'sqlite', not {}".format(source))
+
+    # Load Tables
+    # NOTE: The creation of the table returned by read_sched_db_patterns could largely be done 
+    # with SQL, but we instead just load the tables as dataframes for some of the convenience of 
+    # working with Python and pandas syntax.
+    try:
+        stop_dat = pd.read_sql("SELECT * FROM Stop",
+                               cnxn)
+
+        pattern_dat = pd.read_sql("SELECT * FROM Pattern",
+                                  cnxn)
+
+        pattern_detail_dat = pd.read_sql("SELECT * FROM PatternDetail",
+                                         cnxn)
+    finally:
+        cnxn.close()
+
+    return stop_dat, pattern_dat, pattern_detail_dat
+
+
+def infer_sched_db_source(path):
+    """
+    Parameters
+    ----------
+    path: str,
+        full path to the wmata schedule db
+    Returns
+    -------
+    source: str, one of 'access', 'csv' or 'sqlite'
+    """
+    if os.path.isdir(path):
+        return 'csv'
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ['.mdb', '.accdb']:
+        return 'access'
+    elif extension in ['.sqlite', '.sqlite3', '.db']:
+        return 'sqlite'
+    else:
+        raise ValueError("Can't infer the schedule db source from {}, set source to one of "
+                         "'access', 'csv' or 'sqlite'".format(path))
+
+
+def connect_sched_db_access(path, UID="", PWD=""):
+    """
+    Parameters
+    ----------
+    path: str,
+        full path to the wmata schedule access db
+    UID: str,
+        user id used to access db, if needed
+    PWD: str,
+        password used to access db, if needed
+    Returns
+    -------
+    cnxn: pyodbc.Connection
+    """
+    if pyodbc is None:
+        raise ImportError("pyodbc is needed to read access dbs, install it or use a csv or "
+                          "sqlite export of the schedule db")
     # Open Connection
     pyodbc_available_drivers = [x for x in pyodbc.drivers() if x.startswith('Microsoft')]
     if 'Microsoft Access Driver (*.mdb, *.accdb)' not in pyodbc_available_drivers:
@@ -48,23 +214,42 @@ def read_sched_db_patterns(path,
     cnxn = pyodbc.connect(r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=' + path + \
                           r';UID="' + UID + \
                           r'";PWD="' + PWD + r'";')
+    return cnxn
 
-    # Load Tables
-    # NOTE: The creation of the table returned by this function could largely be done with SQL, 
-    # but we instead just load the tables as dataframes for some of the convenience of working
-    # with Python and pandas syntax.
-    with cnxn:
-        stop_dat = pd.read_sql("SELECT * FROM Stop",
-                               cnxn)
-
-        pattern_dat = pd.read_sql("SELECT * FROM Pattern",
-                                  cnxn)
 
-        pattern_detail_dat = pd.read_sql("SELECT * FROM PatternDetail",
-                                         cnxn)
+def find_sched_db_csv_tables(path):
+    """
+    Parameters
+    ----------
+    path: str,
+        directory of csv exports of the schedule db
+    Returns
+    -------
+    table_paths: dict,
+        path to the csv export of each of the Stop, Pattern and PatternDetail tables
+    """
+    table_paths = {}
+    for table in ['Stop', 'Pattern', 'PatternDetail']:
+        table_files = glob.glob(os.path.join(path, "*{}.csv".format(table)))
+        # '*Stop.csv' would also match a 'BusStop.csv', so require a single match
+        assert (len(table_files) == 1), \
+            print("Expected one csv export of the {} table in {}, found {}".format(table, path, table_files))
+        table_paths[table] = table_files[0]
+    return table_paths
 
-        # We let Pandas close the connection automatically
 
+def clean_sched_db_tables(stop_dat, pattern_dat, pattern_detail_dat):
+    """
+    Parameters
+    ----------
+    stop_dat, pattern_dat, pattern_detail_dat: pd.DataFrame,
+        Stop, Pattern and PatternDetail tables, see read_sched_db_tables
+    Returns
+    -------
+    pattern_pattern_detail_stop_dat: pd.DataFrame,
+        stops of each pattern of all routes in the schedule db, not yet sorted or checked.
+        See read_sched_db_patterns.
+    """
     # Lightly Clean Tables
     stop_dat = stop_dat.dropna(axis=1)
     stop_dat.columns = [inflection.underscore(col_nm) for col_nm in stop_dat.columns]
@@ -78,6 +263,7 @@ def read_sched_db_patterns(path,
                                'RouteText', 'RouteKey', 'PubRouteDir', 'DirectionID']]
     pattern_dat.columns = [inflection.underscore(col_nm) for col_nm in pattern_dat.columns]
     pattern_dat.cd_route = pattern_dat.cd_route.astype(str).str.strip()
+    pattern_dat.ta_route = pattern_dat.ta_route.astype(str).str.strip()
     pattern_dat.cd_variation = pattern_dat.cd_variation.astype('int32')
     pattern_dat.rename(columns={
         'cd_route': 'route',
@@ -90,49 +276,128 @@ def read_sched_db_patterns(path,
     pattern_detail_dat.columns = [inflection.underscore(col_nm) for col_nm in pattern_detail_dat.columns]
     pattern_detail_dat.rename(columns={'distance': 'dist_from_previous_stop'}, inplace=True)
 
-    # Filter to Relevant Routes
-    q_jump_route_list = analysis_routes
-    pattern_q_jump_route_dat = pattern_dat.query('route in @q_jump_route_list')
-    if set(pattern_q_jump_route_dat.route.unique()) != set(q_jump_route_list):
-        miss_routes = set(q_jump_route_list) - set(pattern_q_jump_route_dat.route.unique())
-        print("Schedule data does not include the following route(s): " + miss_routes)
-
     # Join tables
-    pattern_pattern_detail_stop_q_jump_route_dat = (
-        pattern_q_jump_route_dat
+    pattern_pattern_detail_stop_dat = (
+        pattern_dat
         .merge(pattern_detail_dat, on='pattern_id', how='left')
         .merge(stop_dat, on='geo_id', how='left')
     )
 
-    (pattern_pattern_detail_stop_q_jump_route_dat
-     .sort_values(by=['route', 'pattern', 'order'], inplace=True)
-    )
+    return pattern_pattern_detail_stop_dat
 
-    # Check for Missing Lat Long In Stops   
-    mask_nan_latlong = (
-        pattern_pattern_detail_stop_q_jump_route_dat[['stop_lat', 'stop_lon']].isna().all(axis=1)
-    )
-    
-    assert_stop_sort_order_zero_has_nan_latlong = (
-        sum(pattern_pattern_detail_stop_q_jump_route_dat[mask_nan_latlong].stop_sort_order - 0)
-    )
-        
-    assert (assert_stop_sort_order_zero_has_nan_latlong == 0), \
-        print("Missing LatLong values found for stops, please address in source database")
 
-    # Ensure Table Values are Consistent and then Drop Superfluous Cols
-    assert (0 == sum(~ pattern_pattern_detail_stop_q_jump_route_dat.
-                     eval('''direction==pub_route_dir& route==ta_route''')))
-    pattern_pattern_detail_stop_q_jump_route_dat.drop(columns=['pub_route_dir', 'ta_route'], inplace=True)
+def read_sched_db_patterns_cached(path, cache_dir, analysis_routes=None, UID="", PWD="", source=None):
+    """
+    Parameters
+    ----------
+    path: str,
+        full path to the wmata schedule db, see read_sched_db_tables
+    cache_dir: str,
+        directory holding the cached tables. Created if it doesn't exist.
+    analysis_routes: list, optional
+        list of route names to read from the cached table. The default None reads all routes.
+    UID: str,
+        user id used to access db, if needed
+    PWD: str,
+        password used to access db, if needed
+    source: str, optional
+        one of 'access', 'csv' or 'sqlite'. The default None infers the source from path.
+    Returns
+    -------
+    pattern_pattern_detail_stop_dat: pd.DataFrame, 
+        see clean_sched_db_tables. Only includes analysis_routes when a cached table is read.
+    Notes
+    -----
+    Cached tables are named with the hash of the schedule db, so an edited or replaced 
+    schedule db is read again rather than served stale from the cache.
+    """
+    if source is None:
+        source = infer_sched_db_source(path)
+    os.makedirs(cache_dir, exist_ok=True)
 
-    return pattern_pattern_detail_stop_q_jump_route_dat
+    source_hash = hash_sched_db_source(path, source, cache_dir)
+    path_cache = os.path.join(cache_dir, "wmata_schedule_{}.parquet".format(source_hash))
+
+    if os.path.isfile(path_cache):
+        if analysis_routes is None:
+            return pd.read_parquet(path_cache)
+        return pd.read_parquet(path_cache, filters=[('route', 'in', list(analysis_routes))])
+
+    pattern_pattern_detail_stop_dat = clean_sched_db_tables(
+        *read_sched_db_tables(path, UID=UID, PWD=PWD, source=source))
+
+    # Write to a temporary file first so that an interrupted run doesn't corrupt the cache
+    path_cache_temp = path_cache + ".tmp"
+    pattern_pattern_detail_stop_dat.to_parquet(path_cache_temp, index=False)
+    os.replace(path_cache_temp, path_cache)
+    return pattern_pattern_detail_stop_dat
+
+
+def hash_sched_db_source(path, source, cache_dir):
+    """
+    Parameters
+    ----------
+    path: str,
+        full path to the wmata schedule db, see read_sched_db_tables
+    source: str,
+        one of 'access', 'csv' or 'sqlite'
+    cache_dir: str,
+        directory holding the cached tables
+    Returns
+    -------
+    source_hash: str, sha1 hash of the contents of the schedule db file(s)
+    Notes
+    -----
+    The hash of each file is stored in cache_dir along with its size and modification time,
+    and only recomputed when either changes. Entries for files no longer among the source 
+    files are dropped.
+    """
+    if source == 'csv':
+        source_files = [table_path for table, table_path in sorted(find_sched_db_csv_tables(path).items())]
+    else:
+        source_files = [path]
+
+    path_hashes = os.path.join(cache_dir, "wmata_schedule_hashes.json")
+    if os.path.isfile(path_hashes):
+        with open(path_hashes) as f:
+            file_hashes_old = json.load(f)
+    else:
+        file_hashes_old = {}
+
+    # Only the current source files are kept, so entries for moved or deleted files are dropped
+    file_hashes = {}
+    source_hash = hashlib.sha1()
+    for source_file in source_files:
+        source_file = os.path.abspath(source_file)
+        file_stat = os.stat(source_file)
+        file_key = [file_stat.st_size, file_stat.st_mtime_ns]
+        if ((source_file in file_hashes_old) 
+                and (file_hashes_old[source_file]['key'] == file_key)):
+            file_hashes[source_file] = file_hashes_old[source_file]
+        else:
+            file_hash = hashlib.sha1()
+            with open(source_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b''):
+                    file_hash.update(chunk)
+            file_hashes[source_file] = {'key': file_key, 'sha1': file_hash.hexdigest()}
+        source_hash.update(file_hashes[source_file]['sha1'].encode())
+
+    # Written to a unique temporary file then moved into place, so processes sharing cache_dir 
+    # don't write to the same file
+    if file_hashes != file_hashes_old:
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix=".tmp", delete=False) as f:
+            json.dump(file_hashes, f)
+        os.replace(f.name, path_hashes)
+    return source_hash.hexdigest()[:16]
 
 
 def merge_rawnav_wmata_schedule(analysis_route_,
                                 analysis_day_,
                                 rawnav_dat_,
                                 rawnav_sum_dat_,
-                                wmata_schedule_dat_):
+                                wmata_schedule_dat_,
+                                xy_cols=None,
+                                unit='ft'):
     """
     Parameters
     ----------
@@ -146,6 +411,12 @@ def merge_rawnav_wmata_schedule(analysis_route_,
     rawnav_dat_: pd.DataFrame, rawnav data
     rawnav_sum_dat_: pd.DataFrame, rawnav summary data
     wmata_schedule_dat_: pd.DataFrame, wmata schedule data
+    xy_cols: list, optional
+        x and y coordinate columns of rawnav_dat_ and wmata_schedule_dat_, see 
+        merge_rawnav_target_xy. The default None expects GeoDataFrames in a CRS with feet as 
+        units (or x_ft/y_ft columns), see merge_rawnav_target.
+    unit: str, optional
+        unit of the coordinates in xy_cols, 'ft' or 'm'. The default is 'ft'.
     Returns
     -------
     wmata_schedule_based_sum_dat: pd.DataFrame
@@ -164,11 +435,20 @@ def merge_rawnav_wmata_schedule(analysis_route_,
     if (rawnav_sum_subset_dat.shape[0] == 0): return None, None
 
     # Find rawnav point nearest each stop
-    nearest_rawnav_point_to_wmata_schedule_dat = (
-        merge_rawnav_target(
-            target_dat=wmata_schedule_dat_,
-            rawnav_dat=rawnav_subset_dat)
-    )
+    if xy_cols is None:
+        nearest_rawnav_point_to_wmata_schedule_dat = (
+            merge_rawnav_target(
+                target_dat=wmata_schedule_dat_,
+                rawnav_dat=rawnav_subset_dat)
+        )
+    else:
+        nearest_rawnav_point_to_wmata_schedule_dat = (
+            merge_rawnav_target_xy(
+                target_dat=wmata_schedule_dat_,
+                rawnav_dat=rawnav_subset_dat,
+                xy_cols=xy_cols,
+                unit=unit)
+        )
     
     # Trialing resetting index as suggested by Benjamin Malnor
     # In general indices past the initial read-in don't matter much, so this seems like a safe
@@ -212,7 +492,7 @@ def add_num_missing_stops_to_sum(rawnav_wmata_schedule_dat,
 
     rawnav_wmata_schedule_num_stops = (
         rawnav_wmata_schedule_dat
-        .groupby(['filename', 'index_run_start'])
+        .groupby(['filename', 'index_run_start'], observed = True)
         .agg(
             route=('route','first'),
             pattern=('pattern','first'),
@@ -257,41 +537,104 @@ def merge_rawnav_target(target_dat, rawnav_dat, quiet=True):
     """
     Parameters
     ----------
-    target_dat : gpd.GeoDataFrame
+    target_dat : gpd.GeoDataFrame or pd.DataFrame
         wmata schedule data with unique stops per route and info on short/long and direction.
-    rawnav_dat :gpd.GeoDataFrame
+    rawnav_dat :gpd.GeoDataFrame or pd.DataFrame
         rawnav data.
     Returns
     -------
     nearest_rawnav_point_to_target_data : gpd.GeoDataFrame
         A geopandas dataframe with nearest rawnav point to each of the wmata 
         schedule stops on that route.
+    Notes
+    -----
+    Either input can be a DataFrame with x_ft and y_ft columns in EPSG:2248 rather than a 
+    GeoDataFrame (see ll.add_projected_xy), so that no point geometry has to be built for 
+    the rawnav data. Checks the CRS of GeoDataFrames and then calls merge_rawnav_target_xy.
     """
+    target_rawnav_crs = [dat.crs for dat in [target_dat, rawnav_dat] 
+                         if isinstance(dat, gpd.GeoDataFrame)]
+    if len(target_rawnav_crs) < 2:
+        # x_ft and y_ft columns are in EPSG:2248
+        target_rawnav_crs.append(pyproj.CRS.from_epsg(2248))
+    
+    for crs in target_rawnav_crs:
+        assert (bool(re.search("US survey foot", crs.to_wkt()))),\
+            print('Need a CRS with feet as units')
+    assert (all(crs == target_rawnav_crs[0] for crs in target_rawnav_crs)), \
+        print("CRS must match between objects")
 
-    assert (bool(re.search("US survey foot", target_dat.crs.to_wkt()))),\
-        print('Need a CRS with feet as units')
-    assert (bool(re.search("US survey foot", rawnav_dat.crs.to_wkt()))),\
-        print('Need a CRS with feet as units')
-    assert (target_dat.crs == rawnav_dat.crs), print("CRS must match between objects")
+    # xy_cols of None reads the geometry of GeoDataFrames and x_ft/y_ft of DataFrames
+    nearest_rawnav_point_to_target_dat = (
+        merge_rawnav_target_xy(target_dat, rawnav_dat, xy_cols=None, unit='ft', quiet=quiet)
+    )
+        
+    return nearest_rawnav_point_to_target_dat
+
+
+def merge_rawnav_target_xy(target_dat, rawnav_dat, xy_cols=['x_ft', 'y_ft'], unit='ft', quiet=True):
+    """
+    Parameters
+    ----------
+    target_dat : pd.DataFrame
+        wmata schedule data with unique stops per route and info on short/long and direction,
+        with projected coordinates in xy_cols.
+    rawnav_dat : pd.DataFrame
+        rawnav data, with projected coordinates in xy_cols in the same CRS as target_dat.
+    xy_cols : list
+        names of the x and y coordinate columns in both inputs. The default is ['x_ft', 'y_ft'],
+        see ll.add_projected_xy. None uses the geometry of GeoDataFrames instead.
+    unit : str
+        unit of the coordinates, 'ft' or 'm'. The default is 'ft'.
+    quiet : boolean, optional
+        Whether to skip printing route and patterns without a target. The default is True.
+    Returns
+    -------
+    nearest_rawnav_point_to_target_data : pd.DataFrame
+        nearest rawnav point to each of the wmata schedule stops on that route, with 
+        dist_to_nearest_point in feet whatever the unit of the coordinates. Same type as 
+        target_dat.
+    Notes
+    -----
+    Only reads coordinate columns, so no shapely objects are needed for either input. The 
+    CRS of the coordinates isn't checked; they should be projected (not lat/long) and the 
+    same in both inputs.
+    """
+    assert (unit in unit_to_ft.keys()), \
+        print("unit should be one of {}".format(list(unit_to_ft.keys())))
 
-    # Iterate over groups of routes and patterns in rawnav data and target object
+    # Iterate over groups of routes and patterns in rawnav data and target object, finding the
+    # nearest points for all runs of a route and pattern at once
+    rawnav_xy_cols = ['x_ft', 'y_ft', 'geometry'] if xy_cols is None else xy_cols
     target_groups = target_dat.groupby(['route', 'pattern'])
-    rawnav_groups = rawnav_dat.groupby(
-        ['route', 'pattern', 'filename', 'index_run_start'])
+    rawnav_groups = (
+        rawnav_dat
+        .filter(items=['route', 'pattern', 'filename', 'index_run_start', 'index_loc', 'odom_ft', 
+                       'sec_past_st', 'lat', 'long'] + rawnav_xy_cols)
+        .groupby(['route', 'pattern'])
+    )
 
-    nearest_rawnav_point_to_target_dat = pd.DataFrame()
+    nearest_rawnav_point_to_target_list = []
     
     for name, rawnav_group in rawnav_groups:
-        try:
-            target_dat_relevant = \
-                target_groups.get_group(
-                    (name[0], name[1]))
-            nearest_rawnav_point_to_target_dat = \
-                pd.concat([nearest_rawnav_point_to_target_dat,
-                           ll.ckdnearest(target_dat_relevant, rawnav_group)])
-        except:
+        if name not in target_groups.groups:
             if (quiet == False):
                 print("No target geometry found for {} - {}".format(name[0],name[1]))
+            continue
+        
+        nearest_rawnav_point_to_target_list.append(
+            ll.ckdnearest_groups(target_groups.get_group(name), 
+                                 rawnav_group, 
+                                 ['filename', 'index_run_start'],
+                                 xy_cols=xy_cols))
+    
+    if len(nearest_rawnav_point_to_target_list) > 0:
+        nearest_rawnav_point_to_target_dat = pd.concat(nearest_rawnav_point_to_target_list)
+    else:
+        nearest_rawnav_point_to_target_dat = pd.DataFrame()
+    
+    if (unit != 'ft') and (len(nearest_rawnav_point_to_target_dat) > 0):
+        nearest_rawnav_point_to_target_dat['dist_to_nearest_point'] *= unit_to_ft[unit]
     
     nearest_rawnav_point_to_target_dat = (
         ll.reorder_first_cols(nearest_rawnav_point_to_target_dat,
@@ -345,17 +688,39 @@ def assert_clean_stop_order_increase_with_odom(nearest_rawnav_point_to_wmata_sch
             - where all stops with closest rawnav point > 100 ft. are removed.
     """
     row_before = nearest_rawnav_point_to_wmata_schedule_data_.shape[0]
-    nearest_rawnav_point_to_wmata_schedule_data_. \
-        sort_values(['filename', 'index_run_start', 'stop_sort_order'], inplace=True)
+    nearest_rawnav_point_to_wmata_schedule_data_ = (
+        nearest_rawnav_point_to_wmata_schedule_data_
+        .sort_values(['filename', 'index_run_start', 'stop_sort_order'])
+    )
     assert (nearest_rawnav_point_to_wmata_schedule_data_.duplicated(
         ['filename', 'index_run_start', 'stop_sort_order']).sum() == 0)
-    while (sum(nearest_rawnav_point_to_wmata_schedule_data_.
-                       groupby(['filename', 'index_run_start']).index_loc.diff().dropna() < 0) != 0):
-        nearest_rawnav_point_to_wmata_schedule_data_ = \
-            delete_rows_with_incorrect_stop_order(nearest_rawnav_point_to_wmata_schedule_data_)
+    
+    # Keep the most stops per run whose index_loc doesn't decrease with stop order, only
+    # checking runs where it does decrease somewhere
+    run_id = (
+        nearest_rawnav_point_to_wmata_schedule_data_
+        .groupby(['filename', 'index_run_start'], sort = False, observed = True)
+        .ngroup()
+        .to_numpy()
+    )
+    # Rows of each run are together after the sort, so each run is a slice
+    run_start = np.flatnonzero(ll.get_group_starts(run_id))
+    run_stop = np.append(run_start[1:], len(run_id))
+    index_loc = nearest_rawnav_point_to_wmata_schedule_data_.index_loc.to_numpy()
+    decreases = (np.diff(index_loc) < 0) & (run_id[1:] == run_id[:-1])
+    runs_wrong_order = np.unique(
+        np.searchsorted(run_start, np.flatnonzero(decreases) + 1, side = 'right') - 1)
+    
+    keep_rows = np.ones(len(index_loc), dtype=bool)
+    for run in runs_wrong_order:
+        start, stop = run_start[run], run_stop[run]
+        keep_rows[start:stop] = ll.longest_nondecreasing_mask(index_loc[start:stop])
+    nearest_rawnav_point_to_wmata_schedule_data_ = nearest_rawnav_point_to_wmata_schedule_data_[keep_rows]
+    
     row_after = nearest_rawnav_point_to_wmata_schedule_data_.shape[0]
     row_diff = row_before - row_after
-    print('deleted {} of {} stops with incorrect order from index table'.format(row_diff,row_before))
+    print('deleted {} of {} stops with incorrect order from index table ({} runs)'
+          .format(row_diff, row_before, len(runs_wrong_order)))
     return nearest_rawnav_point_to_wmata_schedule_data_
 
 
@@ -372,7 +737,7 @@ def delete_rows_with_incorrect_stop_order(nearest_rawnav_point_to_wmata_schedule
     """
 
     nearest_rawnav_point_to_wmata_schedule_data_.loc[:, 'diff_index'] = \
-        nearest_rawnav_point_to_wmata_schedule_data_.groupby(['filename', 'index_run_start']). \
+        nearest_rawnav_point_to_wmata_schedule_data_.groupby(['filename', 'index_run_start'], observed = True). \
             index_loc.diff().fillna(0)
                         
     wrong_snapping_dat = nearest_rawnav_point_to_wmata_schedule_data_.query('diff_index<0')
@@ -402,77 +767,55 @@ def include_wmata_schedule_based_summary(rawnav_q_dat, rawnav_sum_dat, nearest_s
     '''
     first_last_stop_dat = get_first_last_stop_rawnav(nearest_stop_dat)
     
-    rawnav_q_stop_dat = (
-        rawnav_q_dat
-        .merge(first_last_stop_dat
-               .drop(['odom_ft','sec_past_st'], axis = 1),
-               on=['filename', 'index_run_start'], 
-               how='right')
-    )
+    rawnav_q_stop_dat = subset_rawnav_to_first_last_stop(
+        rawnav_q_dat,
+        first_last_stop_dat,
+        ['lat', 'long', 'odom_ft', 'sec_past_st'])
     
-    rawnav_q_stop_dat = (
+    rawnav_q_stop_sum_dat = (
         rawnav_q_stop_dat
-        .query('index_loc >= index_loc_first_stop & index_loc <= index_loc_last_stop')
-    )
-    
-    rawnav_q_stop_dat = (
-        rawnav_q_stop_dat[
-            ['filename', 
-             'index_run_start', 
-             'lat', 
-             'long',
-             'heading', 
-             'odom_ft', 
-             'sec_past_st',
-             'first_stop_dist_nearest_point', 
-             'trip_length', 
-             'route_text',
-             'pattern_name', 
-             'direction',
-             'pattern_destination', 
-             'direction_id']
-        ]    
+        .groupby(['filename', 'index_run_start'], observed = True)
+        .agg(start_odom_ft_wmata_schedule=('odom_ft', 'min'),
+             end_odom_ft_wmata_schedule=('odom_ft', 'max'),
+             start_sec_wmata_schedule=('sec_past_st', 'min'),
+             end_sec_wmata_schedule=('sec_past_st', 'max'),
+             start_lat_wmata_schedule=('lat', 'first'),
+             end_lat_wmata_schedule=('lat', 'last'),
+             start_long_wmata_schedule=('long', 'first'),
+             end_long_wmata_schedule=('long', 'last'))
+    )
+    
+    # Stop information is the same for every rawnav point in a run, so is taken from the stops
+    stop_sum_dat = (
+        first_last_stop_dat
+        .groupby(['filename', 'index_run_start'], observed = True)
+        .agg(dist_first_stop_wmata_schedule=('first_stop_dist_nearest_point', 'first'),
+             trip_dist_mi_direct_wmata_schedule=('trip_length', 'first'),
+             route_text_wmata_schedule=('route_text', 'first'),
+             pattern_name_wmata_schedule=('pattern_name', 'first'),
+             direction_wmata_schedule=('direction', 'first'),
+             pattern_destination_wmata_schedule=('pattern_destination', 'first'),
+             direction_id_wmata_schedule=('direction_id', 'first'))
     )
-        
-    Map1 = lambda x: max(x) - min(x)
     
-    rawnav_q_stop_sum_dat = (
-        rawnav_q_stop_dat
-        .groupby(['filename', 'index_run_start'])
-        .agg({'odom_ft': ['min', 'max', Map1],
-              'sec_past_st': ['min', 'max', Map1],
-              'lat': ['first', 'last'],
-              'long': ['first', 'last'],
-              'first_stop_dist_nearest_point': ['first'],
-              'trip_length': ['first'],
-              'route_text': ['first'],
-              'pattern_name': ['first'],
-              'direction': ['first'],
-              'pattern_destination': ['first'],
-              'direction_id': ['first']})
-    )
-    
-    rawnav_q_stop_sum_dat.columns = ["_".join(x) for x in rawnav_q_stop_sum_dat.columns.ravel()]
-
     rawnav_q_stop_sum_dat = (
         rawnav_q_stop_sum_dat
-        .rename(columns = {'odom_ft_min':'start_odom_ft_wmata_schedule',
-                           'odom_ft_max':'end_odom_ft_wmata_schedule',
-                           'odom_ft_<lambda_0>':'run_dist_mi_odom_wmata_schedule', 
-                           'sec_past_st_min':'start_sec_wmata_schedule',
-                           'sec_past_st_max':'end_sec_wmata_schedule', 
-                           'sec_past_st_<lambda_0>':'run_dur_sec_wmata_schedule',
-                           'lat_first':'start_lat_wmata_schedule', 
-                           'lat_last':'end_lat_wmata_schedule',
-                           'long_first':'start_long_wmata_schedule', 
-                           'long_last': 'end_long_wmata_schedule',
-                           'first_stop_dist_nearest_point_first':'dist_first_stop_wmata_schedule', 
-                           'trip_length_first':'trip_dist_mi_direct_wmata_schedule',
-                           'route_text_first':'route_text_wmata_schedule', 
-                           'pattern_name_first':'pattern_name_wmata_schedule',
-                           'direction_first':'direction_wmata_schedule', 
-                           'pattern_destination_first':'pattern_destination_wmata_schedule',
-                           'direction_id_first':'direction_id_wmata_schedule'})
+        .assign(
+            run_dist_mi_odom_wmata_schedule = lambda x: 
+                x.end_odom_ft_wmata_schedule - x.start_odom_ft_wmata_schedule,
+            run_dur_sec_wmata_schedule = lambda x: 
+                x.end_sec_wmata_schedule - x.start_sec_wmata_schedule)
+        .join(stop_sum_dat, how='left')
+        .filter(items=['start_odom_ft_wmata_schedule',
+                       'end_odom_ft_wmata_schedule',
+                       'run_dist_mi_odom_wmata_schedule',
+                       'start_sec_wmata_schedule',
+                       'end_sec_wmata_schedule',
+                       'run_dur_sec_wmata_schedule',
+                       'start_lat_wmata_schedule',
+                       'end_lat_wmata_schedule',
+                       'start_long_wmata_schedule',
+                       'end_long_wmata_schedule'] + list(stop_sum_dat.columns))
     )
         
     # Mutate columns and add original summary information
@@ -494,6 +837,55 @@ def include_wmata_schedule_based_summary(rawnav_q_dat, rawnav_sum_dat, nearest_s
     return rawnav_q_stop_sum_dat
 
 
+def subset_rawnav_to_first_last_stop(rawnav_q_dat, first_last_stop_dat, columns, stop_columns=None):
+    """
+    Parameters
+    ----------
+    rawnav_q_dat: pd.DataFrame, rawnav data 
+    first_last_stop_dat: pd.DataFrame
+        first and last stop information for each run, see get_first_last_stop_rawnav
+    columns: list
+        columns of rawnav_q_dat to return in addition to filename and index_run_start
+    stop_columns: list
+        columns of first_last_stop_dat to add to the rawnav data, default None adds none
+    Returns
+    -------
+    rawnav_q_stop_dat: pd.DataFrame
+        rawnav data of runs in first_last_stop_dat from the first stop to the last stop, in 
+        the same order as rawnav_q_dat.
+    Notes
+    -----
+    Same rows as merging rawnav_q_dat onto first_last_stop_dat and filtering on index_loc,
+    but each rawnav row is looked up against the bounds of its run instead of being copied
+    for each first and last stop row.
+    """
+    stop_bounds = (
+        first_last_stop_dat
+        .drop_duplicates(['filename', 'index_run_start'])
+        .set_index(['filename', 'index_run_start'])
+    )
+    
+    run_pos = stop_bounds.index.get_indexer(
+        pd.MultiIndex.from_arrays([rawnav_q_dat.filename, rawnav_q_dat.index_run_start]))
+    in_run = run_pos >= 0
+    run_pos = np.where(in_run, run_pos, 0)
+    
+    index_loc = rawnav_q_dat.index_loc.to_numpy()
+    in_stops = (
+        in_run
+        & (index_loc >= stop_bounds.index_loc_first_stop.to_numpy()[run_pos])
+        & (index_loc <= stop_bounds.index_loc_last_stop.to_numpy()[run_pos])
+    )
+    
+    rawnav_q_stop_dat = rawnav_q_dat[['filename', 'index_run_start'] + columns][in_stops]
+    
+    if stop_columns is not None:
+        for col in stop_columns:
+            rawnav_q_stop_dat[col] = stop_bounds[col].to_numpy()[run_pos[in_stops]]
+    
+    return rawnav_q_stop_dat
+
+
 def get_first_last_stop_rawnav(nearest_rawnav_stop_dat):
     '''
 
@@ -513,7 +905,7 @@ def get_first_last_stop_rawnav(nearest_rawnav_stop_dat):
     
     last_stop_dat.loc[:, "tempCol"] = (
         last_stop_dat
-        .groupby(['filename', 'index_run_start'])
+        .groupby(['filename', 'index_run_start'], observed = True)
         .index_loc
         .transform(max)
     )
@@ -531,7 +923,7 @@ def get_first_last_stop_rawnav(nearest_rawnav_stop_dat):
     
     first_stop_dat.loc[:, "tempCol"] = ( 
         first_stop_dat
-        .groupby(['filename', 'index_run_start'])
+        .groupby(['filename', 'index_run_start'], observed = True)
         .index_loc
         .transform(min)
     )
@@ -556,7 +948,7 @@ def get_first_last_stop_rawnav(nearest_rawnav_stop_dat):
             on=['filename', 'index_run_start'],
             how='left'
         )
-        .drop(columns=['geometry', 'lat', 'long', 'pattern', 'route'])
+        .drop(columns=['geometry', 'lat', 'long', 'pattern', 'route'], errors='ignore')
     )
         
     return first_last_stop_dat
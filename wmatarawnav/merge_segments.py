@@ -7,13 +7,17 @@ Created on Mon Jul  6 22:28:17 2020
 
 from . import merge_schedule_stops as ws
 from . import low_level_fns as ll
+import numpy as np
+import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
 
 def merge_rawnav_segment(rawnav_gdf_, 
                          rawnav_sum_dat_,
                          target_,
-                         patterns_by_seg_):
+                         patterns_by_seg_,
+                         xy_cols=None,
+                         unit='ft'):
     """
     Parameters
     ----------
@@ -21,30 +25,82 @@ def merge_rawnav_segment(rawnav_gdf_,
     rawnav_sum_dat_: pd.DataFrame, rawnav summary data
     target_:geopandas.geodataframe.GeoDataFrame, segments with geom for first last vertex
     patterns_by_seg_: pd.DataFrame, crosswalk of route and pattern to seg_name_id
+    xy_cols: list, optional
+        see merge_rawnav_segments
+    unit: str, optional
+        see merge_rawnav_segments
     Returns
     -------
     summary_run_segment: pd.DataFrame
         trip summary data with additional information from wmata schedule data
     index_run_segment_start_end: gpd.GeoDataFrame
+    Notes
+    -----
+    To merge several segments, merge_rawnav_segments finds the nearest rawnav points to all 
+    of them at once.
     """
 
     assert(len(target_) == 1), print("Function expects a segments file with one record")
 
+    return merge_rawnav_segments(rawnav_gdf_, rawnav_sum_dat_, target_, patterns_by_seg_, 
+                                 xy_cols=xy_cols, unit=unit)
+
+
+def merge_rawnav_segments(rawnav_gdf_, 
+                          rawnav_sum_dat_,
+                          segments_,
+                          patterns_by_seg_,
+                          xy_cols=None,
+                          unit='ft'):
+    """
+    Parameters
+    ----------
+    rawnav_gdf_: gpd.GeoDataFrame, rawnav data, or a pd.DataFrame with x_ft and y_ft columns
+        (see ws.merge_rawnav_target)
+    rawnav_sum_dat_: pd.DataFrame, rawnav summary data
+    segments_: geopandas.geodataframe.GeoDataFrame, segments with geom for first last vertex,
+        one record per seg_name_id
+    patterns_by_seg_: pd.DataFrame, crosswalk of route and pattern to seg_name_id
+    xy_cols: list, optional
+        x and y coordinate columns of rawnav_gdf_, in the CRS of segments_, see 
+        ws.merge_rawnav_target_xy. The default None expects rawnav_gdf_ to be a GeoDataFrame 
+        in a CRS with feet as units (or have x_ft/y_ft columns), see ws.merge_rawnav_target.
+    unit: str, optional
+        unit of the coordinates in xy_cols, 'ft' or 'm'. The default is 'ft'.
+    Returns
+    -------
+    index_run_segment_start_end: gpd.GeoDataFrame
+        nearest rawnav point to the first and last vertex of each segment, for each run on a 
+        pattern crossing the segment
+    summary_run_segment: pd.DataFrame
+        trip summary data with additional information from wmata schedule data, one row per 
+        run and segment
+    Notes
+    -----
+    Rows for each seg_name_id are the same as calling merge_rawnav_segment with that segment, 
+    but the nearest rawnav points to all segments are found in one pass over the rawnav data.
+    Segments not in patterns_by_seg_ are skipped.
+    """
+    segments_ = segments_.loc[segments_.seg_name_id.isin(patterns_by_seg_.seg_name_id)]
+    
+    assert(not segments_.seg_name_id.duplicated().any()), \
+        print("Function expects a segments file with one record per seg_name_id")
+
     # Measure original shape for later testing.
     # Note that we default to the 2248 EPSG code (unit: feet) for measurement testing, 
     # which may be inappropriate if this code is used in other locations.
-    seg_length = (
-        target_
+    seg_length = pd.Series(
+        segments_
         .to_crs(2248)
         .geometry
         .length
-        .iloc[0] #return a float
+        .to_numpy(),
+        index = segments_.seg_name_id
     )
     
-    # Subset segment shapes to current segment and add route identifier
+    # Add route and pattern identifier to segment shapes
     seg_pattern_shape = (
-        target_
-        # Add route and pattern identifier
+        segments_
         .merge(
             patterns_by_seg_,
             on = ['seg_name_id'],
@@ -55,53 +111,84 @@ def merge_rawnav_segment(rawnav_gdf_,
     seg_pattern_first_last = ll.explode_first_last(seg_pattern_shape)
            
     # Find rawnav point nearest each segment
-    index_run_segment_start_end_1 = (
-        ws.merge_rawnav_target(
-            target_dat = seg_pattern_first_last,
-            rawnav_dat = rawnav_gdf_
+    if xy_cols is None:
+        index_run_segments_start_end_1 = (
+            ws.merge_rawnav_target(
+                target_dat = seg_pattern_first_last,
+                rawnav_dat = rawnav_gdf_
+            )
         )
-    )
-     
-    # Cleaning
-
-    # Note that while we could run some additional checks (Are *both* ends of the segment
-    # present? Does the run stay 'within' a certain radius of the segment line?) these 
-    # checks are largely superseded by checks that the odometer reading approximately matches
-    # the segment length (done further below). 
-    index_run_segment_start_end_2 = (
-        index_run_segment_start_end_1
-        .assign(flag_too_far = lambda x: x.dist_to_nearest_point > 50)
-        # note that we will give both the whole run the 'wrong order' flag in the summary table
-        # if the order test fails for any point
-        # This wrong order flag is necessary because some early login and late close out runs
-        # will have pings around certain segments, resulting in misshapen joins. This could 
-        # be addressed if we spent more time cleaning up those runs, but instead we just drop 
-        # them through these filters.
-        .assign(
-            flag_wrong_order = lambda x: 
-                x
-                .groupby(['filename','index_run_start'], sort = False)
-                .index_loc
-                .diff()
-                .fillna(0)
-                .lt(0) 
+    else:
+        # Segment ends are few, so their coordinates are taken from the point geometry
+        index_run_segments_start_end_1 = (
+            ws.merge_rawnav_target_xy(
+                target_dat = seg_pattern_first_last.assign(
+                    **{xy_cols[0]: seg_pattern_first_last.geometry.x,
+                       xy_cols[1]: seg_pattern_first_last.geometry.y}),
+                rawnav_dat = rawnav_gdf_,
+                xy_cols = xy_cols,
+                unit = unit
+            )
+            .drop(columns = xy_cols)
+        )
+    
+    index_run_segment_start_end_list = []
+    
+    for seg_name_id, index_run_segment_start_end_1 in (
+            index_run_segments_start_end_1.groupby('seg_name_id', sort = False)):
+        # Same index as finding the nearest points to this segment alone
+        index_run_segment_start_end_1.index = (
+            index_run_segment_start_end_1
+            .groupby(['filename','index_run_start'], sort = False, observed = True)
+            .cumcount()
+            .to_numpy()
         )
-    )
         
-    # Generate Summary
+        # Cleaning
+    
+        # Note that while we could run some additional checks (Are *both* ends of the segment
+        # present? Does the run stay 'within' a certain radius of the segment line?) these 
+        # checks are largely superseded by checks that the odometer reading approximately matches
+        # the segment length (done further below). 
+        index_run_segment_start_end_2 = (
+            index_run_segment_start_end_1
+            .assign(flag_too_far = lambda x: x.dist_to_nearest_point > 50)
+            # note that we will give both the whole run the 'wrong order' flag in the summary table
+            # if the order test fails for any point
+            # This wrong order flag is necessary because some early login and late close out runs
+            # will have pings around certain segments, resulting in misshapen joins. This could 
+            # be addressed if we spent more time cleaning up those runs, but instead we just drop 
+            # them through these filters.
+            .assign(
+                flag_wrong_order = lambda x: 
+                    x
+                    .groupby(['filename','index_run_start'], sort = False, observed = True)
+                    .index_loc
+                    .diff()
+                    .fillna(0)
+                    .lt(0) 
+            )
+        )
+
+        index_run_segment_start_end_list.append(index_run_segment_start_end_2)
+    
+    if len(index_run_segment_start_end_list) == 0:
+        return(pd.DataFrame(), pd.DataFrame())
+    
+    index_run_segment_start_end = ll.drop_geometry(pd.concat(index_run_segment_start_end_list))
+    
+    # Generate Summary, for all segments at once
     summary_run_segment = (
         include_segment_summary(
             rawnav_q_dat = rawnav_gdf_,
             rawnav_sum_dat = rawnav_sum_dat_,
-            nearest_seg_boundary_dat = index_run_segment_start_end_2,
+            nearest_seg_boundary_dat = index_run_segment_start_end,
             seg_length_ = seg_length
         )
     )
-
-    # Could do this earlier, but need to remove geometry reference in get_first_last_stop_rawnav if so
-    index_run_segment_start_end = ll.drop_geometry(index_run_segment_start_end_2)
       
     return(index_run_segment_start_end, summary_run_segment)
+
     
 def include_segment_summary(rawnav_q_dat, 
                             rawnav_sum_dat, 
@@ -113,96 +200,67 @@ def include_segment_summary(rawnav_q_dat,
     rawnav_q_dat: pd.DataFrame, rawnav data
     rawnav_sum_dat: pd.DataFrame, rawnav summary data
     nearest_seg_boundary_dat: gpd.GeoDataFrame
-        cleaned data on nearest rawnav point to where segment boundary lies
-    seg_length_: float
-        length of segment in feet
+        cleaned data on nearest rawnav point to where segment boundary lies, for one or more
+        segments
+    seg_length_: float or pd.Series
+        length of segment in feet, or a series of lengths indexed by seg_name_id when 
+        nearest_seg_boundary_dat holds several segments
     Returns
     -------
     rawnav_q_segment_summary: pd.DataFrame
-        run summary data with additional information from segment data
+        run summary data with additional information from segment data, ordered by segment
+        as in nearest_seg_boundary_dat and then by run
     Notes
     -----
     This function is largely copied and slimmed down from the schedule merge
     implementation. Making this function more flexible to accommodate both cases would be a significant
     investment given the variety of columns and aggregations that need to be applied in each case.     
+    The rawnav data is subset to all segments at once, see subset_rawnav_to_segments.
     """
-    seg_boundary_dat = ws.get_first_last_stop_rawnav(nearest_seg_boundary_dat)
-    rawnav_q_target_dat = (
-        rawnav_q_dat
-        .merge(seg_boundary_dat
-               .drop(['odom_ft','sec_past_st'], axis = 1),
-               on=['filename', 'index_run_start'], 
-               how='right'
-        )
-    )
+    seg_boundary_dat = pd.concat(
+        [ws.get_first_last_stop_rawnav(nearest_seg_boundary_dat_1)
+         for _, nearest_seg_boundary_dat_1 
+         in nearest_seg_boundary_dat.groupby('seg_name_id', sort = False)],
+        ignore_index = True)
+    seg_order = seg_boundary_dat.seg_name_id.drop_duplicates().tolist()
     
-    rawnav_q_target_dat = (
-        rawnav_q_target_dat
-        .query('index_loc>=index_loc_first_stop & index_loc<=index_loc_last_stop')
-    )
-
-    rawnav_q_target_dat = (
-        rawnav_q_target_dat
-        .filter(
-            items = 
-                ['filename',
-                 'index_run_start', 
-                 'seg_name_id', 
-                 'index_loc',
-                 'lat', 
-                 'long', 
-                 'heading', 
-                 'odom_ft', 
-                 'sec_past_st', 
-                 'first_stop_dist_nearest_point'
-                ]
-        )
-    )
+    rawnav_q_target_dat = subset_rawnav_to_segments(
+        rawnav_q_dat,
+        seg_boundary_dat,
+        ['index_loc', 'lat', 'long', 'odom_ft', 'sec_past_st'],
+        seg_columns = ['first_stop_dist_nearest_point'])
     
-    # We'll add some additional calcs to check on the odometer values within the segment
-    rawnav_q_target_dat[['odom_ft_next','sec_past_st_next']] = (
-        rawnav_q_target_dat
-        .groupby(['filename','index_run_start','seg_name_id'], sort = False)[['odom_ft','sec_past_st']]
-        .shift(-1)
-    )
-        
-    rawnav_q_target_dat = (
-        rawnav_q_target_dat
-        .assign(
-            secs_marg=lambda x: x.sec_past_st_next - x.sec_past_st,
-            odom_ft_marg=lambda x: x.odom_ft_next - x.odom_ft
-        )
-    )
-    
-    Map1 = lambda x: max(x) - min(x)
     rawnav_q_segment_summary = (
         rawnav_q_target_dat
-        .groupby(['filename', 'index_run_start', 'seg_name_id'])
-        .agg(
-            {'odom_ft': ['min', 'max', Map1, 'sum'],
-             'sec_past_st': ['min', 'max', Map1, 'sum'],
-             'lat': ['first', 'last'],
-             'long': ['first', 'last'],
-             'first_stop_dist_nearest_point': ['first'],
-             'index_loc' : ['first','last']}
-        )
+        .groupby(['filename', 'index_run_start', 'seg_name_id'], observed = True)
+        .agg(start_odom_ft_segment=('odom_ft', 'min'),
+             end_odom_ft_segment=('odom_ft', 'max'),
+             start_sec_segment=('sec_past_st', 'min'),
+             end_sec_segment=('sec_past_st', 'max'),
+             start_lat_segment=('lat', 'first'),
+             end_lat_segment=('lat', 'last'),
+             start_long_segment=('long', 'first'),
+             end_long_segment=('long', 'last'),
+             dist_first_stop_segment=('first_stop_dist_nearest_point', 'first'),
+             start_index_loc_segment=('index_loc', 'first'),
+             end_index_loc_segment=('index_loc', 'last'))
+        .assign(
+            trip_dist_ft_segment=lambda x: x.end_odom_ft_segment - x.start_odom_ft_segment,
+            trip_dur_sec_segment=lambda x: x.end_sec_segment - x.start_sec_segment)
+        .filter(items=['start_odom_ft_segment', 
+                       'end_odom_ft_segment',
+                       'trip_dist_ft_segment', 
+                       'start_sec_segment',
+                       'end_sec_segment', 
+                       'trip_dur_sec_segment',
+                       'start_lat_segment', 
+                       'end_lat_segment',
+                       'start_long_segment', 
+                       'end_long_segment',
+                       'dist_first_stop_segment',
+                       'start_index_loc_segment',
+                       'end_index_loc_segment'])
     )
-
-    rawnav_q_segment_summary.columns = ['start_odom_ft_segment', 
-                                     'end_odom_ft_segment',
-                                     'trip_dist_ft_segment', 
-                                     'odom_ft_marg_sum',
-                                     'start_sec_segment',
-                                     'end_sec_segment', 
-                                     'trip_dur_sec_segment',
-                                     'secs_marg_sum',
-                                     'start_lat_segment', 
-                                     'end_lat_segment',
-                                     'start_long_segment', 
-                                     'end_long_segment',
-                                     'dist_first_stop_segment',
-                                     'start_index_loc_segment',
-                                     'end_index_loc_segment'] 
     
     rawnav_q_segment_summary = (
         rawnav_q_segment_summary
@@ -216,8 +274,15 @@ def include_segment_summary(rawnav_q_dat,
             dist_first_stop_segment = lambda x: round(x.dist_first_stop_segment, 2)
         )
         .reset_index()
+        .assign(seg_order = lambda x: pd.Categorical(x.seg_name_id, categories = seg_order).codes)
+        .sort_values('seg_order', kind = 'mergesort')
+        .drop(columns = 'seg_order')
+        .reset_index(drop = True)
     )
     
+    if not isinstance(seg_length_, pd.Series):
+        seg_length_ = pd.Series(seg_length_, index = seg_order)
+    
     # Add flags at summary level
     # For example, we occassionally see the odometer reset in teh middle of a run
     # see 'rawnav05447191026.txt' and index_run_start 8055. If this occurred in a segment
@@ -226,8 +291,8 @@ def include_segment_summary(rawnav_q_dat,
     rawnav_q_segment_summary = (
         rawnav_q_segment_summary
         .assign(
-            flag_too_long_odom = lambda x, y = seg_length_:
-                abs(y - (x.trip_dist_ft_segment)) > 150,
+            flag_too_long_odom = lambda x:
+                abs(x.seg_name_id.map(seg_length_) - (x.trip_dist_ft_segment)) > 150,
             secs_total_mismatch = lambda x: 
                 ((x.end_sec_segment - x.start_sec_segment) 
                  - x.trip_dur_sec_segment),
@@ -239,8 +304,6 @@ def include_segment_summary(rawnav_q_dat,
         )
         .drop(
             columns = [
-                'secs_marg_sum',
-                'odom_ft_marg_sum',
                 'secs_total_mismatch',
                 'odom_total_mismatch',
                 'trip_dist_ft_segment'
@@ -250,7 +313,7 @@ def include_segment_summary(rawnav_q_dat,
     # Summarize index-level flags
     flags = (
         nearest_seg_boundary_dat
-        .groupby(['filename','index_run_start'])
+        .groupby(['filename','index_run_start','seg_name_id'], observed = True)
         .agg({'flag_too_far':['any'],
               'flag_wrong_order':['any']})
         .pipe(ll.reset_col_names)
@@ -266,7 +329,7 @@ def include_segment_summary(rawnav_q_dat,
         )
         .merge(
             flags,
-            on=['filename', 'index_run_start'], 
+            on=['filename', 'index_run_start', 'seg_name_id'], 
             how='left'
         )
         .pipe(
@@ -293,4 +356,82 @@ def include_segment_summary(rawnav_q_dat,
         
     return rawnav_q_segment_summary
 
+
+def subset_rawnav_to_segments(rawnav_q_dat, seg_boundary_dat, columns, seg_columns=None):
+    """
+    Parameters
+    ----------
+    rawnav_q_dat: pd.DataFrame, rawnav data 
+    seg_boundary_dat: pd.DataFrame
+        first and last rawnav point of each run on each segment, with columns filename, 
+        index_run_start, seg_name_id, index_loc_first_stop and index_loc_last_stop. See 
+        ws.get_first_last_stop_rawnav.
+    columns: list
+        columns of rawnav_q_dat to return in addition to filename and index_run_start
+    seg_columns: list
+        columns of seg_boundary_dat to add to the rawnav data in addition to seg_name_id, 
+        default None adds none
+    Returns
+    -------
+    rawnav_q_seg_dat: pd.DataFrame
+        rawnav data from the first to the last rawnav point of each run on each segment, 
+        ordered by the rows of seg_boundary_dat and then as in rawnav_q_dat. Rawnav rows on 
+        more than one segment are repeated for each.
+    Notes
+    -----
+    Same rows as ws.subset_rawnav_to_first_last_stop on each segment's rows of seg_boundary_dat,
+    but the rawnav data is looked up once for all segments. Rawnav rows of the runs in 
+    seg_boundary_dat are sorted by run and index_loc, so each run and segment is a slice.
+    """
+    seg_boundary_dat = (
+        seg_boundary_dat
+        .drop_duplicates(['filename', 'index_run_start', 'seg_name_id'])
+        .reset_index(drop = True)
+    )
+    seg_columns = ['seg_name_id'] + ([] if seg_columns is None else seg_columns)
+    
+    bound_keys = pd.MultiIndex.from_arrays([seg_boundary_dat.filename, 
+                                            seg_boundary_dat.index_run_start])
+    runs = bound_keys.unique()
+    bound_run = runs.get_indexer(bound_keys)
+    rawnav_run = runs.get_indexer(
+        pd.MultiIndex.from_arrays([rawnav_q_dat.filename, rawnav_q_dat.index_run_start]))
+    index_loc = rawnav_q_dat.index_loc.to_numpy(dtype = 'float64')
+    
+    rows = np.flatnonzero(rawnav_run >= 0)
+    rows = rows[np.lexsort((index_loc[rows], rawnav_run[rows]))]
+    
+    # Sort key of run and index_loc, offset so each run's index_loc values fall in 
+    # [0, loc_span). Bounds past either end of a run are moved just outside it.
+    loc_min = index_loc[rows].min() if len(rows) > 0 else 0
+    loc_span = (index_loc[rows].max() - loc_min + 1) if len(rows) > 0 else 1
+    rawnav_key = rawnav_run[rows] * loc_span + (index_loc[rows] - loc_min)
+    first_key = (
+        bound_run * loc_span
+        + np.clip(seg_boundary_dat.index_loc_first_stop.to_numpy(dtype = 'float64') - loc_min, 
+                  -0.5, loc_span - 0.5))
+    last_key = (
+        bound_run * loc_span
+        + np.clip(seg_boundary_dat.index_loc_last_stop.to_numpy(dtype = 'float64') - loc_min, 
+                  -0.5, loc_span - 0.5))
+    slice_start = np.searchsorted(rawnav_key, first_key, side = 'left')
+    slice_stop = np.searchsorted(rawnav_key, last_key, side = 'right')
+    slice_len = np.maximum(slice_stop - slice_start, 0)
+    
+    # Positions in rows of each slice, then back in rawnav_q_dat order within each slice
+    bound_id = np.repeat(np.arange(len(seg_boundary_dat)), slice_len)
+    pos = (np.arange(slice_len.sum()) 
+           + np.repeat(slice_start - (np.cumsum(slice_len) - slice_len), slice_len))
+    seg_rows = rows[pos]
+    order = np.lexsort((seg_rows, bound_id))
+    seg_rows = seg_rows[order]
+    bound_id = bound_id[order]
+    
+    rawnav_q_seg_dat = rawnav_q_dat[['filename', 'index_run_start'] + columns].iloc[seg_rows]
+    
+    for col in seg_columns:
+        rawnav_q_seg_dat[col] = seg_boundary_dat[col].to_numpy()[bound_id]
+    
+    return rawnav_q_seg_dat
+
     
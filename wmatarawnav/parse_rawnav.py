@@ -6,11 +6,13 @@ Purpose: Functions for processing rawnav data
 """
 
 import zipfile, re, numpy as np, pandas as pd, io, os, shutil, glob
-import pandasql as ps
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from functools import partial
 from zipfile import BadZipfile
 import geopandas as gpd
-from shapely.geometry import Point
 from pandas.io.parsers import ParserError
+from . import low_level_fns as ll
 
 # FIXME : Change all functions below to snake_case---refactor code
 # Parent Functions
@@ -65,7 +67,8 @@ def get_zipped_files_from_zip_dir(zip_dir_list, zipped_files_dir_parent, glob_se
     return file_universe
 
 
-def find_rawnav_routes(file_universe, nmax=None, quiet=True):
+def find_rawnav_routes(file_universe, nmax=None, quiet=True, workers=1, chunksize=None,
+                       path_inventory_cache=None):
     '''   
     Parameters
     ----------
@@ -79,6 +82,17 @@ def find_rawnav_routes(file_universe, nmax=None, quiet=True):
         limit files to read to this number. If None, all zip files read.
     quiet : boolean, optional
         Whether to print status. The default is True.
+    workers : int, optional
+        Number of processes used to search files for tags. The default of 1 searches files
+        serially in the current process. None uses one process per CPU core.
+    chunksize : int, optional
+        Number of files handed to a worker process at a time when workers != 1. If None,
+        files are split into roughly four chunks per worker.
+    path_inventory_cache : str, optional
+        Path to a parquet file used to store the inventory between runs. If given, only
+        files that are new or whose size or modification time changed since the last run
+        are searched for tags, and the cache is updated. The default of None searches every
+        file and does not use a cache.
 
     Returns
     -------
@@ -86,9 +100,45 @@ def find_rawnav_routes(file_universe, nmax=None, quiet=True):
     '''
     assert(len(file_universe)>0), print("No files present in file universe")
     assert((nmax == None) or (nmax > 0)), print("nmax must be greater than 0 or None")
+    assert((workers == None) or (workers > 0)), print("workers must be greater than 0 or None")
     file_universe_set = file_universe[0:nmax]
+    
+    if path_inventory_cache is None:
+        file_universe_df = inventory_rawnav_files(file_universe_set,
+                                                  quiet=quiet,
+                                                  workers=workers,
+                                                  chunksize=chunksize)
+    else:
+        file_universe_df = update_rawnav_inventory_cache(file_universe_set,
+                                                         path_inventory_cache,
+                                                         quiet=quiet,
+                                                         workers=workers,
+                                                         chunksize=chunksize)
+    return file_universe_df
+
+
+def inventory_rawnav_files(file_list, quiet=True, workers=1, chunksize=None):
+    '''
+    Parameters
+    ----------
+    file_list : list of str
+        Paths to zipped rawnav files. See find_rawnav_routes.
+    quiet : boolean, optional
+        Whether to print status. The default is True.
+    workers : int, optional
+        Number of processes used to search files for tags. See find_rawnav_routes.
+    chunksize : int, optional
+        Number of files handed to a worker process at a time. See find_rawnav_routes.
+    Returns
+    -------
+    file_universe_df : pd.DataFrame
+        One row per tag found in each file, indexed by the position of the file in file_list.
+    '''
     # Setup dataframe for iteration
-    file_universe_df = pd.DataFrame({'fullpath': file_universe_set})
+    file_universe_df = pd.DataFrame({'fullpath': list(file_list)})
+    
+    if len(file_universe_df) == 0:
+        return file_universe_df.reindex(columns = inventory_columns())
 
     file_universe_df['filename'] = file_universe_df['fullpath'].str.extract('(rawnav\d+.txt)')
     file_universe_df['file_busid'] = file_universe_df['fullpath'].str.extract('rawnav(\d{5})\S+.txt')
@@ -96,8 +146,16 @@ def find_rawnav_routes(file_universe, nmax=None, quiet=True):
     file_universe_df['file_busid'] = pd.to_numeric(file_universe_df['file_busid'])
     
     # Get Tags and Reformat
-    file_universe_df['taglist'] = [find_all_tags(path, quiet=quiet) for path in file_universe_df['fullpath']]
+    tag_lists = find_all_tags_in_files(file_universe_df['fullpath'].tolist(),
+                                       quiet=quiet,
+                                       workers=workers,
+                                       chunksize=chunksize,
+                                       return_offsets=True)
+    file_universe_df['taglist'] = [tag_line_elements for tag_line_elements, _ in tag_lists]
     file_universe_df = file_universe_df.explode('taglist')
+    # Offsets line up with the exploded tags, as each file has one offset per tag
+    file_universe_df['byte_offset'] = \
+        np.concatenate([tag_line_offsets for _, tag_line_offsets in tag_lists]).astype(float)
     file_universe_df[['line_num', 'route_pattern', 'tag_busid', 'tag_date', 'tag_time', 'Unk1', 'mi_to_ft']] = \
         file_universe_df['taglist'].str.split(',', expand=True)
     file_universe_df[['route', 'pattern']] = \
@@ -118,8 +176,22 @@ def find_rawnav_routes(file_universe, nmax=None, quiet=True):
     file_universe_df['wday'] = file_universe_df['tag_date'].dt.day_name()
     file_universe_df['line_num_next'] =\
         file_universe_df.groupby(['filename'], sort = False)['line_num'].shift(-1)
+    file_universe_df['byte_offset_next'] =\
+        file_universe_df.groupby(['filename'], sort = False)['byte_offset'].shift(-1)
     
     #Reorder Cols
+    file_universe_df = file_universe_df.reindex(columns = inventory_columns(), copy = False)
+        
+    return file_universe_df
+
+
+def inventory_columns():
+    '''
+    Returns
+    -------
+    list of str
+        Columns of the rawnav inventory, in order.
+    '''
     column_nm_map = ['fullpath', 
                      'filename', 
                      'file_id', 
@@ -127,6 +199,8 @@ def find_rawnav_routes(file_universe, nmax=None, quiet=True):
                      'taglist',
                      'line_num',
                      'line_num_next',
+                     'byte_offset',
+                     'byte_offset_next',
                      'route_pattern',
                      'route', 
                      'pattern', 
@@ -138,12 +212,115 @@ def find_rawnav_routes(file_universe, nmax=None, quiet=True):
                      'wday',
                      'Unk1',
                      'mi_to_ft']
+    return column_nm_map
+
+
+def update_rawnav_inventory_cache(file_list, path_inventory_cache, quiet=True, workers=1, chunksize=None):
+    '''
+    Parameters
+    ----------
+    file_list : list of str
+        Paths to zipped rawnav files. See find_rawnav_routes.
+    path_inventory_cache : str
+        Path to the parquet file holding the cached inventory. Created if it doesn't exist.
+    quiet : boolean, optional
+        Whether to print status. The default is True.
+    workers : int, optional
+        Number of processes used to search files for tags. See find_rawnav_routes.
+    chunksize : int, optional
+        Number of files handed to a worker process at a time. See find_rawnav_routes.
+    Returns
+    -------
+    file_universe_df : pd.DataFrame
+        Inventory of the files in file_list, same as returned by inventory_rawnav_files.
+    Notes
+    -----
+    Cached entries are keyed on the file's full path, size, and modification time. Files
+    that are new or changed are searched for tags and merged into the cache; entries for
+    files that no longer exist or have changed are dropped. Entries for files outside 
+    file_list are kept as long as the file is still on disk and unchanged.
+    '''
+    key_cols = ['fullpath', 'file_size', 'file_mtime']
+    if os.path.isfile(path_inventory_cache):
+        inventory_cache = pd.read_parquet(path_inventory_cache)
+    else:
+        inventory_cache = pd.DataFrame(columns = inventory_columns() + key_cols[1:])
+    # Caches written before a column was added to the inventory are rebuilt
+    if not set(inventory_columns() + key_cols[1:]).issubset(inventory_cache.columns):
+        inventory_cache = pd.DataFrame(columns = inventory_columns() + key_cols[1:])
     
-    file_universe_df = file_universe_df.reindex(columns = column_nm_map, copy = False)
-        
+    # Compare the cached file stats with the ones on disk now
+    cached_files = inventory_cache[key_cols].drop_duplicates('fullpath')
+    file_stats = get_file_stats(pd.unique(np.append(np.array(file_list, dtype=object), 
+                                                    cached_files.fullpath.values)))
+    cached_files = cached_files.merge(file_stats, on='fullpath', how='left', suffixes=('', '_now'))
+    cached_files_valid = cached_files.loc[
+        (cached_files.file_size == cached_files.file_size_now) &
+        (cached_files.file_mtime == cached_files.file_mtime_now), 
+        'fullpath']
+    
+    cached_files_valid_set = set(cached_files_valid)
+    files_to_scan = [file for file in file_list if file not in cached_files_valid_set]
+    if quiet != True:
+        print("Inventory cache: {} files reused, {} files searched for tags, {} entries dropped"
+              .format(len(set(file_list)) - len(files_to_scan),
+                      len(files_to_scan),
+                      len(cached_files) - len(cached_files_valid)))
+    
+    new_inventory = inventory_rawnav_files(files_to_scan, quiet=quiet, workers=workers, chunksize=chunksize)
+    new_inventory = new_inventory.merge(file_stats, on='fullpath', how='left')
+    
+    # Empty frames are left out of the concat so that they don't upcast column types to object
+    inventory_cache = pd.concat([inventory for inventory in 
+                                 [inventory_cache[inventory_cache.fullpath.isin(cached_files_valid)],
+                                  new_inventory]
+                                 if len(inventory) > 0] or [new_inventory],
+                                ignore_index=True)
+    inventory_cache = inventory_cache.reindex(columns = inventory_columns() + key_cols[1:])
+    
+    # Write to a temporary file first so that an interrupted run doesn't corrupt the cache
+    path_inventory_cache_temp = path_inventory_cache + ".tmp"
+    inventory_cache.to_parquet(path_inventory_cache_temp, index=False)
+    os.replace(path_inventory_cache_temp, path_inventory_cache)
+    
+    # Return the files in file_list in the same order and index as inventory_rawnav_files
+    file_position = pd.Series(np.arange(len(file_list)), index=file_list)
+    file_position = file_position[~file_position.index.duplicated(keep='first')]
+    file_universe_df = inventory_cache[inventory_cache.fullpath.isin(file_position.index)]
+    file_universe_df.index = file_universe_df.fullpath.map(file_position).values
+    file_universe_df = file_universe_df.sort_index(kind='mergesort')
+    file_universe_df = file_universe_df.reindex(columns = inventory_columns(), copy = False)
     return file_universe_df
 
 
+def get_file_stats(file_list):
+    '''
+    Parameters
+    ----------
+    file_list : list of str
+        Paths to files.
+    Returns
+    -------
+    pd.DataFrame
+        fullpath, file_size in bytes, and file_mtime in nanoseconds. Files that can't be 
+        found have missing size and modification time. Both are nullable Int64 columns, as 
+        nanosecond modification times are too large to be held exactly as floats.
+    '''
+    file_size = []
+    file_mtime = []
+    for file in file_list:
+        try:
+            file_stat = os.stat(file)
+            file_size.append(file_stat.st_size)
+            file_mtime.append(file_stat.st_mtime_ns)
+        except FileNotFoundError:
+            file_size.append(None)
+            file_mtime.append(None)
+    return pd.DataFrame({'fullpath': list(file_list), 
+                         'file_size': pd.array(file_size, dtype='Int64'), 
+                         'file_mtime': pd.array(file_mtime, dtype='Int64')})
+
+
 def load_rawnav_data(zip_folder_path, skiprows):
     '''
     Parameters
@@ -174,6 +351,96 @@ def load_rawnav_data(zip_folder_path, skiprows):
     return raw_data
 
 
+def load_rawnav_data_runs(zip_folder_path, skiprows, tag_info, analysis_routes):
+    '''
+    Parameters
+    ----------
+    zip_folder_path : str
+        Path to the zipped rawnav.txt file..
+    skiprows : int
+        Number of rows with metadata. Same as for load_rawnav_data, the line number of the 
+        first tag in tag_info.
+    tag_info : pd.DataFrame
+        Rawnav inventory rows for the file, including line_num, byte_offset, 
+        byte_offset_next, and route.
+    analysis_routes : list
+        Routes to read the data of. 
+    Raises
+    ------
+    ParserError
+        More number of , in a file. pandas has issue with tokenizing data.   
+    Returns
+    -------
+    pd.DataFrame with the file info, indexed the same as load_rawnav_data, but only 
+    including rows from runs on analysis_routes and the tag lines of other runs.
+    Notes
+    -----
+    Rather than parse the file from skiprows onward, we use the byte offsets found during 
+    the inventory to read the runs on analysis routes. The tag lines of other runs are 
+    still read so that runs end where they did in the full file and the tag checks in 
+    clean_rawnav_data still hold. A forward seek on a deflated member still decompresses
+    everything up to the offset, so the file is decompressed up to the last run read, but 
+    the lines of other runs are not parsed. 
+    Blank lines are counted in every run so that rows are numbered as in load_rawnav_data,
+    which drops them.
+    '''
+    zf = zipfile.ZipFile(zip_folder_path)
+    # Get Filename
+    namepat = re.compile('(rawnav\d+\.txt)')
+    zip_file_name = namepat.search(zip_folder_path).group(1)
+    tag_info = tag_info.sort_values('byte_offset', kind='mergesort')
+    # read_csv skips lines that are empty or only whitespace, numbering the rows it keeps 
+    # one after another, so we count these lines in each run, including runs not parsed
+    blank_line_pat = re.compile(rb'^[ \t\r]*\n', re.M)
+    chunks = []
+    chunk_index = []
+    # Index of the next line kept, counted as in load_rawnav_data from the line after skiprows
+    next_index = int(tag_info.line_num.iloc[0]) - skiprows - 1
+    with zf.open(zip_file_name, 'r') as input_file:
+        # load_rawnav_data gets the number of columns from the line after the first tag
+        input_file.seek(int(tag_info.byte_offset.iloc[0]))
+        input_file.readline()
+        first_line = input_file.readline()
+        while first_line and not first_line.strip():
+            first_line = input_file.readline()
+        for row in tag_info.itertuples():
+            input_file.seek(int(row.byte_offset))
+            if np.isnan(row.byte_offset_next):
+                if row.route not in analysis_routes:
+                    block = input_file.readline()
+                else:
+                    block = input_file.read()
+            else:
+                block = input_file.read(int(row.byte_offset_next - row.byte_offset))
+            if not block.endswith(b'\n'):
+                block = block + b'\n'
+            nlines_kept = block.count(b'\n') - len(blank_line_pat.findall(block))
+            if row.route in analysis_routes:
+                chunk = block
+                chunk_nlines_kept = nlines_kept
+            else:
+                # Only the tag line, which is never blank
+                chunk = block[:block.find(b'\n') + 1]
+                chunk_nlines_kept = 1
+            chunks.append(chunk)
+            chunk_index.append(np.arange(next_index, next_index + chunk_nlines_kept))
+            next_index += nlines_kept
+    
+    new_index = np.concatenate(chunk_index)
+    try:
+        raw_data = pd.read_csv(io.BytesIO(b''.join(chunks)), 
+                               header=None, 
+                               names=range(first_line.count(b',') + 1))
+    except ParserError as parseerr:
+        print("*" * 100)
+        print("More number of ',' in a file {}. pandas has issue with tokenizing data. Error: {}".format(zip_file_name,parseerr))
+        print("*" * 100)
+        return None
+    raw_data.index = new_index
+    raw_data = raw_data[raw_data.index >= 0]
+    return raw_data
+
+
 def clean_rawnav_data(data_dict, filename):
     '''
     Parameters
@@ -207,19 +474,23 @@ def clean_rawnav_data(data_dict, filename):
     except:
         print("TagLists Did not match in file {}".format(filename))
     
-    rawnavdata.reset_index(inplace=True);
+    # Keep the row labels as the index as well as index_loc, as rows are looked up by
+    # label below. Data from load_rawnav_data_runs skips the lines of some runs.
     # TODO: This line prevents the function from being rerun, need to address later.
     #   odd, given local scoping of functions 
     # IS okay on a first run though
-    rawnavdata.rename(columns={"index": "index_loc"}, inplace=True)
+    rawnavdata.insert(0, "index_loc", rawnavdata.index)
+    
+    # Label each row as data, a tag, APC, CAL, end of route, or invalid
+    row_class = classify_rawnav_rows(rawnavdata, tag_indices)
+    rawnavdata.loc[:, 'run_end_time'] = row_class.run_end_time
     
     # Get End of route Info
     tagline_data, delete_indices1 = add_end_route_info(rawnavdata, tagline_data)
-    rawnavdata = rawnavdata[~rawnavdata.index.isin(np.append(tag_indices, delete_indices1))]
    
-    # Remove APC and CAL labels and keep APC locations. 
-    rawnavdata, apc_tag_loc = remove_apc_cal_tags(rawnavdata)
-    rawnavdata = rawnavdata[rawnavdata.apply(check_valid_data_entry, axis=1)]
+    # Remove tags, end of route, APC and CAL labels, and invalid rows. Keep APC locations. 
+    apc_tag_loc = np.array(row_class.index[row_class.row_type.values == 'apc'])
+    rawnavdata = rawnavdata[row_class.row_type.values == 'data']
     apc_loc_dat = pd.Series(apc_tag_loc, name='apc_tag_loc')
     apc_loc_dat = \
         pd.merge_asof(apc_loc_dat, rawnavdata[["index_loc"]], left_on="apc_tag_loc", right_on="index_loc")
@@ -258,6 +529,134 @@ def clean_rawnav_data(data_dict, filename):
     return return_dict
 
 
+def clean_rawnav_files(rawnav_inventory_filtered, analysis_routes=None, workers=1, max_pending=None):
+    '''
+    Load and clean each file in the filtered rawnav inventory
+    Parameters
+    ----------
+    rawnav_inventory_filtered : pd.DataFrame
+        Rawnav inventory rows for each file to read, including tags for runs on other routes,
+        with line_num as an integer.
+    analysis_routes : list, optional
+        If given, only runs on these routes are read from each file (see 
+        load_rawnav_data_runs). The default of None reads each file from the first tag on.
+    workers : int, optional
+        Number of processes used to load and clean files. The default of 1 works through
+        files serially in the current process. None uses one process per CPU core.
+    max_pending : int, optional
+        Most files loaded or cleaned at once when workers != 1, limiting the memory used by
+        results that are waiting on an earlier file. The default of None allows two per worker.
+    Returns
+    -------
+    rawnav_data_dict : dict
+        Cleaned data for each file. filename is the dictionary key.
+    summary_data_dict : dict
+        Run summaries for each file. filename is the dictionary key.
+    rawnav_inventory_filtered_valid : pd.DataFrame
+        rawnav_inventory_filtered without files that could not be read.
+    '''
+    rawnav_data_dict = {}
+    summary_data_dict = {}
+    remove_files = []
+    
+    for clean_dict in iter_clean_rawnav_files(rawnav_inventory_filtered, 
+                                              analysis_routes=analysis_routes, 
+                                              workers=workers, 
+                                              max_pending=max_pending):
+        if clean_dict['rawnavdata'] is None:
+            remove_files.append(clean_dict['filename'])
+        else:
+            rawnav_data_dict[clean_dict['filename']] = clean_dict['rawnavdata']
+            summary_data_dict[clean_dict['filename']] = clean_dict['summary_data']
+    
+    rawnav_inventory_filtered_valid = \
+        rawnav_inventory_filtered[~rawnav_inventory_filtered.filename.isin(remove_files)]
+    return rawnav_data_dict, summary_data_dict, rawnav_inventory_filtered_valid
+
+
+def iter_clean_rawnav_files(rawnav_inventory_filtered, analysis_routes=None, workers=1, max_pending=None):
+    '''
+    Generator version of clean_rawnav_files, see that function for parameters.
+    Yields
+    -------
+    clean_dict : dict
+        filename, and rawnavdata and summary_data as returned by clean_rawnav_data, for each
+        file in order of fullpath. rawnavdata and summary_data are None if the file could not
+        be read.
+    Notes
+    -----
+    Files are independent of one another, so they are spread across processes. Results are 
+    yielded in the same order regardless of which worker finishes first. 
+    '''
+    assert((workers == None) or (workers > 0)), print("workers must be greater than 0 or None")
+    file_args = []
+    # Iterate over each file, skipping to the first row where data in our filtered inventory is found
+    for (fullpath, filename), tag_info_line_no in rawnav_inventory_filtered.groupby(['fullpath', 'filename']):
+        tag_info_line_no = tag_info_line_no.copy()
+        reference = min(tag_info_line_no.line_num)
+        # -1 refers to the fact that the tag line identifying the start of a run will be removed, such
+        # that the second row associated with a run will become the first row of data. This helps to 
+        # ensure that indices of the processed data will line up with values in the rawnav inventory
+        tag_info_line_no.loc[:, "new_line_no"] = tag_info_line_no.line_num - reference - 1
+        file_args.append((fullpath, filename, reference, tag_info_line_no, analysis_routes))
+    
+    if workers == 1 or len(file_args) <= 1:
+        for args in file_args:
+            yield load_clean_rawnav_file(*args)
+        return
+    
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(file_args))
+    if max_pending is None:
+        max_pending = 2 * workers
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for args in file_args:
+            pending.append(executor.submit(load_clean_rawnav_file, *args))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_clean_rawnav_file(fullpath, filename, skiprows, tag_info_line_no, analysis_routes=None):
+    '''
+    Parameters
+    ----------
+    fullpath : str
+        Path to the zipped rawnav.txt file.
+    filename : str
+        rawnav file name
+    skiprows : int
+        Line number of the first tag in tag_info_line_no.
+    tag_info_line_no : pd.DataFrame
+        Rawnav inventory rows for the file, with new_line_no.
+    analysis_routes : list, optional
+        If given, only runs on these routes are read. See clean_rawnav_files.
+    Returns
+    -------
+    clean_dict : dict
+        filename, and rawnavdata and summary_data as returned by clean_rawnav_data, or None
+        if the file could not be read.
+    '''
+    if analysis_routes is None:
+        raw_data = load_rawnav_data(zip_folder_path=fullpath, skiprows=skiprows)
+    else:
+        raw_data = load_rawnav_data_runs(zip_folder_path=fullpath, 
+                                         skiprows=skiprows,
+                                         tag_info=tag_info_line_no,
+                                         analysis_routes=analysis_routes)
+    if raw_data is None:
+        return {'filename': filename, 'rawnavdata': None, 'summary_data': None}
+    
+    clean_dict = clean_rawnav_data(data_dict=dict(RawData=raw_data, tagLineInfo=tag_info_line_no),
+                                   filename=filename)
+    clean_dict['filename'] = filename
+    return clean_dict
+
+
 def subset_rawnav_run(rawnav_data_dict_, rawnav_inventory_filtered_valid_, analysis_routes_):
     '''
     Subset data for analysis routes
@@ -302,19 +701,55 @@ def add_run_dividers(data, summary_data):
     Returns
     -------
     rawnav data with composite keys.
-
+    Notes
+    -----
+    Equivalent to a left join of data on summary_data where index_loc is between 
+    index_run_start and index_run_end. Rows are returned in data order, with a row for 
+    each matching run in summary_data order, and rows without a matching run are kept with
+    missing run values. Column types follow those returned when this join was done in SQLite.
     '''
-    summary_data.columns
+    data_cols = ['index_loc', 'lat', 'long', 'heading', 'door_state', 'veh_state', 'odom_ft',
+                 'sec_past_st', 'sat_cnt', 'stop_window', 'blank', 'lat_raw', 'long_raw', 'row_before_apc']
     tags_temp = summary_data[
-        ['route_pattern', 'route', 'pattern', 'index_run_start', 'index_run_end']]
-    q1 = '''SELECT data.index_loc,data.lat,data.long,data.heading,data.door_state,data.veh_state,data.odom_ft,
-    data.sec_past_st,data.sat_cnt,data.stop_window,data.blank,data.lat_raw,data.long_raw,data.row_before_apc,
-    tags_temp.route_pattern,tags_temp.route,tags_temp.pattern,tags_temp.index_run_start,
-    tags_temp.index_run_end
-    FROM data LEFT JOIN tags_temp on data.index_loc 
-    BETWEEN  tags_temp.index_run_start and tags_temp.index_run_end
-    '''
-    data = ps.sqldf(q1, locals())
+        ['route_pattern', 'route', 'pattern', 'index_run_start', 'index_run_end']].reset_index(drop=True)
+    
+    # Find the rows within each run from the sorted row locations. Runs with a missing start 
+    # or end match no rows.
+    index_loc = data['index_loc'].values
+    index_loc_order = np.argsort(index_loc, kind='mergesort')
+    index_loc_sorted = index_loc[index_loc_order]
+    run_start = tags_temp['index_run_start'].values.astype(float)
+    run_end = tags_temp['index_run_end'].values.astype(float)
+    run_valid = ~(np.isnan(run_start) | np.isnan(run_end))
+    lo = np.zeros(len(tags_temp), dtype=int)
+    hi = np.zeros(len(tags_temp), dtype=int)
+    lo[run_valid] = np.searchsorted(index_loc_sorted, run_start[run_valid], side='left')
+    hi[run_valid] = np.searchsorted(index_loc_sorted, run_end[run_valid], side='right')
+    n_rows_run = np.maximum(hi - lo, 0)
+    
+    # Expand to one (row, run) pair per match
+    run_pos = np.repeat(np.arange(len(tags_temp)), n_rows_run)
+    first_pair = np.cumsum(n_rows_run) - n_rows_run
+    row_pos = index_loc_order[np.repeat(lo, n_rows_run) + np.arange(n_rows_run.sum()) 
+                              - np.repeat(first_pair, n_rows_run)]
+    
+    # Keep rows without a run, then sort into data order, followed by run order
+    row_unmatched = np.setdiff1d(np.arange(len(data)), row_pos)
+    row_pos = np.concatenate([row_pos, row_unmatched])
+    run_pos = np.concatenate([run_pos, np.full(len(row_unmatched), -1)])
+    pair_order = np.lexsort((run_pos, row_pos))
+    row_pos = row_pos[pair_order]
+    run_pos = run_pos[pair_order]
+    
+    data = data[data_cols].iloc[row_pos].reset_index(drop=True)
+    data['row_before_apc'] = data['row_before_apc'].astype('int64')
+    # Integers are returned as int64, or float if any row is without a run, as SQLite did
+    for col in ['index_run_start', 'index_run_end']:
+        if pd.api.types.is_integer_dtype(tags_temp[col]):
+            tags_temp[col] = tags_temp[col].astype('int64')
+    # reindex returns missing values for rows without a run (-1)
+    tags_temp = tags_temp.reindex(run_pos).reset_index(drop=True)
+    data = pd.concat([data, tags_temp], axis=1)
     return data
 
 
@@ -440,6 +875,78 @@ def remove_apc_cal_tags(data):
     return data, apc_tag_loc
 
 
+def classify_rawnav_rows(data, tag_indices=None):
+    '''
+    Parameters
+    ----------
+    data : pd.DataFrame
+        Unclean data with tag information, with columns numbered as read from the file.
+    tag_indices : array-like, optional
+        Index labels of run tag lines, such as from the rawnav inventory. The default of 
+        None labels no rows as tags.
+    Returns
+    -------
+    row_class : pd.DataFrame
+        Same index as data, with columns
+        row_type : one of 'tag', 'end_route', 'cal', 'apc', 'data', or 'invalid'. Rows
+            are checked in that order, so that a row has the first type it matches.
+        run_end_time : time from "Buswares navigation reported end of route..." or
+            "Buswares is now using route zero" lines, otherwise missing.
+    Notes
+    -----
+    Data rows are those that pass the same checks as check_valid_data_entry: numeric lat,
+    long, and heading in range, door state of 'O' or 'C', and vehicle state of 'M' or 'S'.
+    '''
+    col_0 = data[0]
+    if pd.api.types.is_object_dtype(col_0):
+        col_0_upper = col_0.str.strip().str.upper()
+        is_cal = (col_0_upper == "CAL").values
+        is_apc = (col_0_upper == "APC").values
+        # Only lines starting with '/' can be end of route lines
+        run_end_time = pd.Series(np.nan, index=data.index, dtype=object)
+        maybe_end_route = col_0_upper.str.startswith('/').fillna(False).values
+        if maybe_end_route.any():
+            run_end_time[maybe_end_route] = \
+                col_0[maybe_end_route].str.extract(end_route_pattern())['run_end_time']
+    else:
+        is_cal = is_apc = np.zeros(len(data), dtype=bool)
+        run_end_time = pd.Series(np.nan, index=data.index, dtype=object)
+    is_end_route = run_end_time.notna().values
+    if tag_indices is None:
+        tag_indices = []
+    is_tag = data.index.isin(tag_indices)
+    
+    lat = pd.to_numeric(col_0, errors='coerce').values
+    long = pd.to_numeric(data[1], errors='coerce').values
+    heading = pd.to_numeric(data[2], errors='coerce').values
+    with np.errstate(invalid='ignore'):
+        is_data = ((-90 <= lat) & (lat <= 90) 
+                   & (-180 <= long) & (long <= 180) 
+                   & (0 <= heading) & (heading <= 360)
+                   & data[3].isin(['O', 'C']).values
+                   & data[4].isin(['M', 'S']).values)
+    
+    row_type = np.select([is_tag, is_end_route, is_cal, is_apc, is_data],
+                         ['tag', 'end_route', 'cal', 'apc', 'data'],
+                         default='invalid')
+    row_class = pd.DataFrame({'row_type': row_type, 'run_end_time': run_end_time.values}, 
+                             index=data.index)
+    return row_class
+
+
+def end_route_pattern():
+    '''
+    Returns
+    -------
+    Compiled regex for "Busware navigation reported end of route..." or
+    "Buswares is now using route zero" lines, with the time as run_end_time.
+    '''
+    pat = re.compile(
+        '^\s*/\s*(?P<run_end_time>\d{2}:\d{2}:\d{2})\s*(?:Buswares navigation reported end of route|Buswares is now using route zero)',
+        re.S)
+    return pat
+
+
 def add_end_route_info(data, tagline_data):
     '''
     Parameters
@@ -448,6 +955,8 @@ def add_end_route_info(data, tagline_data):
         Unclean data with info on end of route.
     tagline_data : pd.DataFrame
         Tagline data.
+        If data has a run_end_time column, such as from classify_rawnav_rows, it is used
+        rather than searching data for the end of route text again.
     Returns
     -------
     tagline_data : pd.DataFrame
@@ -457,10 +966,9 @@ def add_end_route_info(data, tagline_data):
     deleteIndices : np.array
         indices to delete from raw data.
     '''
-    pat = re.compile(
-        '^\s*/\s*(?P<run_end_time>\d{2}:\d{2}:\d{2})\s*(?:Buswares navigation reported end of route|Buswares is now using route zero)',
-        re.S)
-    data.loc[:, 'run_end_time'] = data[0].str.extract(pat)
+    # Reuse end of route times found by classify_rawnav_rows, if present
+    if 'run_end_time' not in data.columns:
+        data.loc[:, 'run_end_time'] = data[0].str.extract(end_route_pattern())
     end_of_route = data[['index_loc', 'run_end_time']]
     end_of_route = end_of_route[~(end_of_route.run_end_time.isna())]
     delete_indices = end_of_route.index_loc.values
@@ -504,15 +1012,11 @@ def get_distance_latlong_mi(data, lat1, long1, lat2, long2):
         distances in mile between (Lat1,long1) and (Lat2,long2) columns in Data.
         same size as number of rows in Data.
     '''
-    geometry1 = [Point(xy) for xy in zip(data[long1], data[lat1])]
-    gdf = gpd.GeoDataFrame(geometry=geometry1, crs={'init': 'epsg:4326'})
-    gdf.to_crs(epsg=3310, inplace=True)  # Distance in meters---Default is in degrees!
-    geometry2 = [Point(xy) for xy in zip(data[long2], data[lat2])]
-    gdf2 = gpd.GeoDataFrame(geometry=geometry2, crs={'init': 'epsg:4326'})
-    gdf2.to_crs(epsg=3310, inplace=True)  # Distance in meters---Default is in degrees!
-    # https://gis.stackexchange.com/questions/293310/how-to-use-geoseries-distance-to-get-the-right-answer
-    distance_mi = gdf.geometry.distance(gdf2) * 0.000621371  # meters to miles
-    return distance_mi.values
+    distance_mi = get_distance_latlong_m(data[long1].values, 
+                                         data[lat1].values, 
+                                         data[long2].values, 
+                                         data[lat2].values) * 0.000621371  # meters to miles
+    return distance_mi
 
 
 def get_distance_latlong_ft_from_geom(geometry1, geometry2):
@@ -528,16 +1032,44 @@ def get_distance_latlong_ft_from_geom(geometry1, geometry2):
     distances in feet between each points in geometry1 and geometry2.
     same size as geometry1 or geometry2. 
     '''
-    gdf = gpd.GeoDataFrame(geometry=geometry1, crs={'init': 'epsg:4326'})
-    gdf.to_crs(epsg=3310, inplace=True)  # Distance in meters---Default is in degrees!
-    gdf2 = gpd.GeoDataFrame(geometry=geometry2, crs={'init': 'epsg:4326'})
-    gdf2.to_crs(epsg=3310, inplace=True)  # Distance in meters---Default is in degrees!
+    geometry1 = gpd.GeoSeries(geometry1)
+    geometry2 = gpd.GeoSeries(geometry2)
+    distance_ft = get_distance_latlong_m(geometry1.x.values, 
+                                         geometry1.y.values, 
+                                         geometry2.x.values, 
+                                         geometry2.y.values) * 3.28084  # meters to feet
+    return distance_ft
+
+
+def get_distance_latlong_m(long1, lat1, long2, lat2):
+    '''
+    Parameters
+    ----------
+    long1, lat1 : np.array
+        1st set of coordinates, in decimal degrees (EPSG:4326).
+    long2, lat2 : np.array
+        2nd set of coordinates, same size as the first.
+    Returns
+    -------
+    DistanceM: np.array
+        distances in meters between each pair of points, or NaN if either point is missing.
+    Notes
+    -----
+    Points are projected to EPSG:3310 and the straight line distance is taken between them, 
+    same as reprojecting GeoDataFrames and calling .distance, but on arrays.
     # https://gis.stackexchange.com/questions/293310/how-to-use-geoseries-distance-to-get-the-right-answer
-    distance_ft = gdf.geometry.distance(gdf2) * 3.28084  # meters to feet
-    return (distance_ft.values)
+    '''
+    long1, lat1, long2, lat2 = [np.asarray(coord, dtype=float) for coord in [long1, lat1, long2, lat2]]
+    transformer = ll.get_transformer("EPSG:4326", "EPSG:3310")
+    x1, y1 = transformer.transform(long1, lat1)
+    x2, y2 = transformer.transform(long2, lat2)
+    distance_m = np.hypot(np.asarray(x2) - np.asarray(x1), np.asarray(y2) - np.asarray(y1))
+    is_finite = np.isfinite(long1) & np.isfinite(lat1) & np.isfinite(long2) & np.isfinite(lat2)
+    distance_m = np.where(is_finite, distance_m, np.nan)
+    return distance_m
 
 
-def find_all_tags(zip_folder_path, quiet=True):
+def find_all_tags(zip_folder_path, quiet=True, block_size=2**24, return_offsets=False):
     '''
     Parameters
     ----------
@@ -547,11 +1079,21 @@ def find_all_tags(zip_folder_path, quiet=True):
         Assumes that included text file has the same name as the zipped file,
         minus the '.zip' extension.
         Note: For absolute paths, use forward slashes.
+    quiet : boolean, optional
+        Whether to print status. The default is True.
+    block_size : int, optional
+        Number of decompressed bytes searched at a time. The default is 16 MB.
+    return_offsets : boolean, optional
+        Whether to also return the decompressed byte offset of each tag line. The default
+        is False.
     Returns
     -------
     TagLineElements
         List of Character strings including line number, pattern, vehicle,
         date, and time
+    TagLineOffsets
+        Only if return_offsets is True. List of byte offsets of the start of each tag line,
+        with NaN for the placeholder returned for files without tags.
     '''
     if quiet != True:
         print("Searching for tags in: " + zip_folder_path)
@@ -561,35 +1103,146 @@ def find_all_tags(zip_folder_path, quiet=True):
         namepat = re.compile('(rawnav\d+\.txt)')
         zip_file_name = namepat.search(zip_folder_path).group(1)
         # Get Info
-        infopat = '^\s*(\S+),(\d{1,5}),(\d{2}\/\d{2}\/\d{2}),(\d{2}:\d{2}:\d{2}),(\S+),(\S+)'
-        tag_line_elements = []
-        tag_line_num = 1
-        with io.TextIOWrapper(zf.open(zip_file_name, 'r'), encoding="utf-8") as input_file:
-            for current_line in input_file:
-                for match in re.finditer(infopat, current_line, re.S):
-                    # Turns out we don't really need capture groups
-                    # with string split approach, but leaving in for possible
-                    # future changes
-                    returnvals = str(tag_line_num) + "," + match.group()
-                    tag_line_elements.append(returnvals)
-                tag_line_num = tag_line_num + 1
+        with zf.open(zip_file_name, 'r') as input_file:
+            tag_line_elements, tag_line_offsets = scan_tag_lines(input_file, 
+                                                                 block_size=block_size, 
+                                                                 return_offsets=True)
         if len(tag_line_elements) == 0:
             tag_line_elements.append(',,,,,,')
+            tag_line_offsets.append(np.nan)
     except BadZipfile as BadZipEr:
         print("*" * 100)
         print("issue with opening zipped file: {}. Error: {}".format(zip_folder_path,BadZipEr))
         print("*" * 100)
         tag_line_elements = []
         tag_line_elements.append(',,,,,,')
+        tag_line_offsets = [np.nan]
     except KeyError as keyerr:
         print("*" * 100)
         print("Text file name doesn't match parent zip folder for': {}. Error: {}".format(zip_folder_path,keyerr))
         print("*" * 100)
         tag_line_elements = []
         tag_line_elements.append(',,,,,,')
+        tag_line_offsets = [np.nan]
+    if return_offsets:
+        return tag_line_elements, tag_line_offsets
+    return tag_line_elements
+
+
+def scan_tag_lines(input_file, block_size=2**24, return_offsets=False):
+    '''
+    Parameters
+    ----------
+    input_file: file-like object
+        Binary stream of a rawnav text file, such as the file returned by ZipFile.open().
+    block_size : int, optional
+        Number of decompressed bytes searched at a time. The default is 16 MB.
+    return_offsets : boolean, optional
+        Whether to also return the byte offset of each tag line. The default is False.
+    Returns
+    -------
+    TagLineElements
+        List of Character strings including line number, pattern, vehicle,
+        date, and time
+    TagLineOffsets
+        Only if return_offsets is True. List of byte offsets of the start of each tag line
+        from the start of input_file.
+    Notes
+    -----
+    Tag lines are a small share of the lines in a rawnav file, so rather than decode and
+    test every line, we search each block of bytes for the date and time fields that 
+    every tag line carries (ala '/06/19,05:15:24,'). Only lines with a hit are 
+    tested against the full tag pattern, and line numbers are found by counting the 
+    newlines between hits. Lines are split on '\\n', with any '\\r' before it ignored.
+    '''
+    # The leading '/' lets the regex engine skip ahead with a fast literal search
+    prefilter = re.compile(rb'/\d{2}/\d{2},\d{2}:\d{2}:\d{2},')
+    # Same pattern as was used line-by-line, less the '^' anchor, as matching starts at the 
+    # beginning of each line
+    infopat = re.compile(rb'\s*(\S+),(\d{1,5}),(\d{2}\/\d{2}\/\d{2}),(\d{2}:\d{2}:\d{2}),(\S+),(\S+)', re.S)
+    tag_line_elements = []
+    tag_line_offsets = []
+    tag_line_num = 1
+    data_offset = 0
+    remainder = b''
+    while True:
+        block = input_file.read(block_size)
+        if block:
+            # Only search through the last complete line, carrying the rest to the next block
+            data = remainder + block
+            cut = data.rfind(b'\n') + 1
+            data, remainder = data[:cut], data[cut:]
+        else:
+            data, remainder = remainder, b''
+        
+        counted_to = 0
+        last_line_start = -1
+        for hit in prefilter.finditer(data):
+            line_start = data.rfind(b'\n', 0, hit.start()) + 1
+            if line_start == last_line_start:
+                continue
+            line_end = data.find(b'\n', hit.end())
+            if line_end == -1:
+                line_end = len(data)
+            tag_line_num += data.count(b'\n', counted_to, line_start)
+            counted_to = line_start
+            last_line_start = line_start
+            match = infopat.match(data, line_start, line_end)
+            if match:
+                tag_line_elements.append(str(tag_line_num) + "," + match.group().decode("utf-8"))
+                tag_line_offsets.append(data_offset + line_start)
+        tag_line_num += data.count(b'\n', counted_to)
+        data_offset += len(data)
+        
+        if not block:
+            break
+    if return_offsets:
+        return tag_line_elements, tag_line_offsets
     return tag_line_elements
 
 
+def find_all_tags_in_files(file_list, quiet=True, workers=1, chunksize=None, return_offsets=False):
+    '''
+    Parameters
+    ----------
+    file_list: list
+        List of paths to zipped rawnav text files, as passed to find_all_tags.
+    quiet : boolean, optional
+        Whether to print status. The default is True.
+    workers : int, optional
+        Number of processes used to search files for tags. The default of 1 searches files
+        serially in the current process. None uses one process per CPU core.
+    chunksize : int, optional
+        Number of files handed to a worker process at a time. If None, files are split into
+        roughly four chunks per worker.
+    return_offsets : boolean, optional
+        Passed to find_all_tags. The default is False.
+    Returns
+    -------
+    tag_lists: list
+        List with the find_all_tags output for each file, in the same order as file_list.
+    Notes
+    -----
+    Files are independent of one another, so the search can be spread across processes. 
+    Results are returned in input order regardless of which worker finishes first. Issues
+    opening a file are printed by find_all_tags in the worker process, as in the serial case.
+    '''
+    if workers == 1 or len(file_list) <= 1:
+        return [find_all_tags(path, quiet=quiet, return_offsets=return_offsets) for path in file_list]
+    
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(file_list))
+    if chunksize is None:
+        chunksize = max(1, len(file_list) // (workers * 4))
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tag_lists = list(executor.map(partial(find_all_tags, quiet=quiet, return_offsets=return_offsets), 
+                                      file_list, 
+                                      chunksize=chunksize))
+    return tag_lists
+
+
 def move_empty_incorrect_label_files(file, path_source_data, issue='EmptyFiles'):
     '''
     Parameters
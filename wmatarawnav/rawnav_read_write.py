@@ -6,14 +6,27 @@ Created on Thu Jul  9 12:20:18 2020
 """
 
 import os
+import json
+import shutil
+import uuid
+import hashlib
+import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 from itertools import product
 from . import low_level_fns as ll
+from . import parse_rawnav as pr
 
+# Integer columns in versions 2 and 3 of rawnav_data_schema are read as pandas nullable 
+# integers, so missing values don't turn them into floats
+nullable_int_types = {pa.int16(): pd.Int16Dtype(),
+                      pa.int32(): pd.Int32Dtype(),
+                      pa.int64(): pd.Int64Dtype()}
 
-def read_cleaned_rawnav(path, analysis_routes_, analysis_days_ = None):
+def read_cleaned_rawnav(path, analysis_routes_, analysis_days_ = None, columns = None, runs = None,
+                        start_time = None, end_time = None, cache_dir = None):
     """
     Parameters
     ----------
@@ -26,11 +39,35 @@ def read_cleaned_rawnav(path, analysis_routes_, analysis_days_ = None):
     analysis_days_: list,
         days of the week for which data is needed. Should be a subset of following:
         ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
-
+    columns: list,
+        columns to read, default None reads all columns. The key columns filename, 
+        index_run_start, index_loc (rawnav data only), route, wday and pattern are always read.
+        If x_ft and y_ft are asked for but weren't written (versions 1 and 2 of 
+        rawnav_data_schema), they're projected from lat and long after the read.
+    runs: pd.DataFrame,
+        runs to read, with columns filename and index_run_start. Default None reads all runs.
+    start_time: str or pd.Timestamp,
+        earliest run start_date_time to read, inclusive. Default None for no limit.
+    end_time: str or pd.Timestamp,
+        latest run start_date_time to read, exclusive. Default None for no limit.
+    cache_dir: str,
+        local directory to cache route and wday partitions in as Arrow IPC files, see 
+        read_rawnav_partition_cached. Default None uses the directory in the environment 
+        variable WMATARAWNAV_CACHE_DIR if it's set, and otherwise reads from parquet each time.
     Returns
     -------
     rawnav_dat: pd.DataFrame,
       rawnav data
+    Notes
+    -----
+    columns, runs, start_time and end_time are passed to the parquet read as a projection
+    and filters, so row groups and columns that aren't needed aren't decoded. The filter on 
+    runs is by filename and by index_run_start separately, so the exact runs are then 
+    subset after the read.
+    Reads data written with any version of rawnav_data_schema. Dictionary encoded 
+    columns in versions 2 and 3 are returned as categories, so group on them with 
+    observed=True. Integer columns with missing values are returned as pandas nullable 
+    integers (Int16, Int32 or Int64) rather than floats.
     """
     
     # Parameter Checks
@@ -51,21 +88,70 @@ def read_cleaned_rawnav(path, analysis_routes_, analysis_days_ = None):
     assert (len(analysis_days_) == len(set(analysis_days_))),\
         print("analysis_days_ entries cannot be duplicated")     
          
+    if runs is not None:
+        assert (set(['filename', 'index_run_start']).issubset(set(runs.columns))),\
+            print("runs needs the columns filename and index_run_start")
+    
     # Function Body
+    if cache_dir is None:
+        cache_dir = os.environ.get('WMATARAWNAV_CACHE_DIR') or None
     
     combo = pd.DataFrame(list(product(analysis_routes_, analysis_days_)), columns = ['route','wday'])
     combo_zip = zip(combo.route, combo.wday)
-    filter_parquet = [[('route','=',route),('wday', '=', day)] for route, day in combo_zip]
+    
+    filter_common = []
+    if runs is not None:
+        filter_common += [
+            ('filename', 'in', set(runs.filename.astype(str))),
+            ('index_run_start', 'in', set(runs.index_run_start.astype(int)))]
+    if start_time is not None:
+        filter_common += [('start_date_time', '>=', pd.Timestamp(start_time))]
+    if end_time is not None:
+        filter_common += [('start_date_time', '<', pd.Timestamp(end_time))]
+    
+    filter_parquet = [[('route','=',route),('wday', '=', day)] + filter_common 
+                      for route, day in combo_zip]
     
     try:
-        rawnav_temp_dat = (
-            pq.read_table(source=os.path.join(path),
-                          filters=filter_parquet,
-                          use_pandas_metadata = True)
-            .to_pandas())
+        if columns is not None:
+            columns = ll.check_convert_list(columns)
+            dataset_columns = ds.dataset(path, partitioning='hive').schema.names
+            key_columns = [col for col in ['filename', 'index_run_start', 'index_loc', 'route', 
+                                           'wday', 'pattern'] 
+                           if (col in dataset_columns) and (col not in columns)]
+            columns = list(columns) + key_columns
+            # Datasets written without projected coordinates get them from lat/long
+            add_xy = (set(['x_ft', 'y_ft']) & set(columns)) - set(dataset_columns)
+            if len(add_xy) > 0:
+                columns = [col for col in columns if col not in add_xy]
+                columns += [col for col in ['lat', 'long'] if col not in columns]
         
-        # NOTE: could selectt fewer columns to save memory/time on read in, but don't expect
-        # performance boost to be that great, could be obnoxious
+        if cache_dir is None:
+            rawnav_temp_dat = (
+                pq.read_table(source=os.path.join(path),
+                              columns=columns,
+                              filters=filter_parquet,
+                              use_pandas_metadata = True)
+                .to_pandas(types_mapper = nullable_int_types.get))
+        else:
+            # Partitions are cached whole, so columns and filters are applied after 
+            tables = [read_rawnav_partition_cached(path, route, day, cache_dir) 
+                      for route, day in product(analysis_routes_, analysis_days_)]
+            tables = [table for table in tables if table is not None]
+            if len(tables) == 0:
+                raise IndexError('No partitions found')
+            rawnav_temp_table = pa.concat_tables(tables)
+            if (start_time is not None) or (end_time is not None):
+                start_date_time = rawnav_temp_table.column('start_date_time').to_pandas()
+                keep_rows = pd.Series(True, index = start_date_time.index)
+                if start_time is not None:
+                    keep_rows &= start_date_time >= pd.Timestamp(start_time)
+                if end_time is not None:
+                    keep_rows &= start_date_time < pd.Timestamp(end_time)
+                rawnav_temp_table = rawnav_temp_table.filter(pa.array(keep_rows.values))
+            if columns is not None:
+                rawnav_temp_table = rawnav_temp_table.select(columns)
+            rawnav_temp_dat = rawnav_temp_table.to_pandas(types_mapper = nullable_int_types.get)
     except Exception as e:
         if str(type(e)) == "<class 'IndexError'>":
             raise ValueError('No data found for any of given filter conditions')
@@ -74,12 +160,15 @@ def read_cleaned_rawnav(path, analysis_routes_, analysis_days_ = None):
             raise
     else:
         # In case partition was written multiple times, we take the last entry added.
+        # Datasets written with a manifest are already unique, see update_rawnav_manifest.
         
         # A little hack used depending on the dataset read in
         check_data =  all(item in list(rawnav_temp_dat.columns) for item in ['index_loc','filename','index_run_start'])
         check_summary = all(item in list(rawnav_temp_dat.columns) for item in ['filename','index_run_start'])
         
-        if check_data:
+        if check_summary and check_rawnav_manifest_unique(path, analysis_routes_, analysis_days_):
+            pass
+        elif check_data:
             rawnav_temp_dat = rawnav_temp_dat[
                 ~rawnav_temp_dat.duplicated(['index_loc', 'filename', 'index_run_start'], keep='last')] 
         elif check_summary:
@@ -89,25 +178,630 @@ def read_cleaned_rawnav(path, analysis_routes_, analysis_days_ = None):
             print("Doesn't match expected input")
             raise
         
+        # Versions 2 and 3 of the data schema store index_loc as an integer
+        compact_schema = check_data and pd.api.types.is_integer_dtype(rawnav_temp_dat.index_loc)
+        
         # Even after defining the schema on parquet write, we're still seeing some strings 
         # read in as categories rather than as strings. Very odd.
         rawnav_temp_dat.route = rawnav_temp_dat.route.astype('str') 
         rawnav_temp_dat.wday = rawnav_temp_dat.wday.astype('str') 
+        # Integer columns without missing values go back to numpy integers, which are
+        # faster to work with downstream
+        for col in rawnav_temp_dat.columns:
+            if (pd.api.types.is_extension_array_dtype(rawnav_temp_dat[col]) 
+                and pd.api.types.is_integer_dtype(rawnav_temp_dat[col])
+                and not rawnav_temp_dat[col].hasnans):
+                rawnav_temp_dat[col] = rawnav_temp_dat[col].to_numpy(
+                    dtype = rawnav_temp_dat[col].dtype.numpy_dtype)
         # Even though we could store as int, in case the values have NA's, we store as float
         # and then convert to int after the fact. If you happen to run into a problem here, do an adhoc
         # load of the parquet file and then after filtering NA values, convert pattern to 
         # integer.
-        rawnav_temp_dat.pattern = rawnav_temp_dat.pattern.astype('int') 
+        if compact_schema:
+            rawnav_temp_dat.pattern = rawnav_temp_dat.pattern.astype('int32') 
+        else:
+            rawnav_temp_dat.pattern = rawnav_temp_dat.pattern.astype('int') 
+        
+        if (columns is not None) and (len(add_xy) > 0):
+            rawnav_temp_dat = ll.add_projected_xy(rawnav_temp_dat)
+        
+        if runs is not None:
+            run_keys = pd.MultiIndex.from_arrays([runs.filename.astype(str), 
+                                                  runs.index_run_start.astype(int)])
+            rawnav_temp_dat = rawnav_temp_dat[
+                pd.MultiIndex.from_arrays([rawnav_temp_dat.filename.astype(str),
+                                           rawnav_temp_dat.index_run_start.astype(int)])
+                .isin(run_keys)]
 
     return rawnav_temp_dat
 
-def rawnav_data_schema():
+def read_rawnav_partition_cached(path, route, day, cache_dir):
+    """
+    Parameters
+    ----------
+    path: str,
+        path where the parquet files for cleaned data are kept, ala rawnav_data.parquet
+    route: str,
+        route partition to read
+    day: str,
+        wday partition to read
+    cache_dir: str,
+        local directory for cached partitions. Created if needed.
+    Returns
+    -------
+    table: pa.Table,
+        all rows and columns of the partition, including route and wday. None if the 
+        partition doesn't exist.
+    Notes
+    -----
+    The partition is saved as an uncompressed Arrow IPC file that's memory-mapped when read,
+    so repeated reads skip decoding parquet. A json file next to it records the size and 
+    modification time of each parquet file in the partition, and the cache is rebuilt when 
+    these change.
+    """
+    path_partition = os.path.join(path, 'route={}'.format(route), 'wday={}'.format(day))
+    if not os.path.isdir(path_partition):
+        return None
+    
+    signature = {
+        'source': os.path.abspath(path_partition),
+        'files': sorted([[file, 
+                          os.stat(os.path.join(path_partition, file)).st_size,
+                          os.stat(os.path.join(path_partition, file)).st_mtime_ns]
+                         for file in os.listdir(path_partition) 
+                         if not file.startswith(('.', '_'))])}
+    
+    path_cache = os.path.join(
+        cache_dir,
+        hashlib.sha1(signature['source'].encode()).hexdigest()[:16] + '_{}_{}'.format(route, day))
+    
+    if os.path.isfile(path_cache + '.json') and os.path.isfile(path_cache + '.arrow'):
+        with open(path_cache + '.json') as f:
+            if json.load(f) == signature:
+                return pa.ipc.open_file(pa.memory_map(path_cache + '.arrow', 'r')).read_all()
+    
+    # IPC files need one dictionary per column for dictionary encoded columns
+    table = pq.read_table(path_partition).unify_dictionaries()
+    table = (
+        table
+        .append_column('route', pa.array([str(route)] * table.num_rows, pa.string()))
+        .append_column('wday', pa.array([str(day)] * table.num_rows, pa.string())))
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    with pa.OSFile(path_cache + '.arrow.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(path_cache + '.arrow.tmp', path_cache + '.arrow')
+    with open(path_cache + '.json', 'w') as f:
+        json.dump(signature, f)
+    return table
+
+
+def write_clean_rawnav_files(rawnav_inventory_filtered, 
+                             analysis_routes, 
+                             path_rawnav_data, 
+                             path_summary_rawnav,
+                             read_analysis_runs_only=False,
+                             workers=1,
+                             max_pending=None,
+                             schema_version=1):
     """
+    Load, clean, and write rawnav files one at a time
+    Parameters
+    ----------
+    rawnav_inventory_filtered: pd.DataFrame,
+        Rawnav inventory rows for each file to read, with line_num as an integer. See 
+        parse_rawnav.clean_rawnav_files.
+    analysis_routes: list,
+        routes to write. Any existing output for these routes is removed first.
+    path_rawnav_data: str,
+        path to the rawnav data parquet dataset, ala rawnav_data.parquet
+    path_summary_rawnav: str,
+        path to the rawnav summary parquet dataset, ala rawnav_summary.parquet
+    read_analysis_runs_only: bool,
+        whether to read only runs on analysis_routes from each file, see 
+        parse_rawnav.load_rawnav_data_runs. The default is False.
+    workers: int,
+        number of processes used to load and clean files, see parse_rawnav.clean_rawnav_files
+    max_pending: int,
+        most files loaded or cleaned at once, see parse_rawnav.clean_rawnav_files
+    schema_version: int,
+        version of rawnav_data_schema to write the rawnav data with. The default is 1.
+    Returns
+    -------
+    rawnav_inventory_filtered_valid: pd.DataFrame,
+        rawnav_inventory_filtered without files that could not be read.
+    Notes
+    -----
+    Gives the same datasets as combining cleaned files by route and writing each with 
+    pq.write_to_dataset, partitioned on route and wday, but each cleaned file is appended to
+    a parquet file per route and wday as it's done, so that only one file is held in memory 
+    at a time. Each input file becomes a row group. Both datasets get a manifest of the runs 
+    in each file, see update_rawnav_manifest.
+    """
+    analysis_routes = ll.check_convert_list(analysis_routes)
+    for path in [path_rawnav_data, path_summary_rawnav]:
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        for analysis_route in analysis_routes:
+            shutil.rmtree(os.path.join(path, "route={}".format(analysis_route)), ignore_errors=True)
+    
+    rawnav_inventory_filtered = (
+        rawnav_inventory_filtered[
+            rawnav_inventory_filtered
+            .groupby('filename', sort = False)['route']
+            .transform(lambda x: x.isin(analysis_routes).any())
+        ]
+    )
+    
+    writers = {}
+    manifest = {}
+    remove_files = []
+    try:
+        for clean_dict in pr.iter_clean_rawnav_files(
+                rawnav_inventory_filtered,
+                analysis_routes=analysis_routes if read_analysis_runs_only else None,
+                workers=workers,
+                max_pending=max_pending):
+            
+            if clean_dict['rawnavdata'] is None:
+                remove_files.append(clean_dict['filename'])
+                continue
+            
+            # Filter to analysis routes, convert col types once NAs removed
+            summary_rawnav = clean_dict['summary_data']
+            summary_rawnav = summary_rawnav[summary_rawnav['route'].isin(analysis_routes)]
+            summary_rawnav = summary_rawnav.assign(
+                route=lambda x: x.route.astype('str'),
+                pattern=lambda x: x.pattern.astype('int32'))
+            
+            # Remove duplicate runs
+            summary_rawnav = summary_rawnav[
+                ~summary_rawnav.duplicated(['filename', 'index_run_start'], keep='last')]  
+            
+            # Join Additional Identifying Information
+            out_rawnav_dat = clean_dict['rawnavdata']
+            out_rawnav_dat = out_rawnav_dat[out_rawnav_dat['route'].isin(analysis_routes)]
+            out_rawnav_dat = out_rawnav_dat.reset_index(drop=True)
+            out_rawnav_dat = out_rawnav_dat.merge(
+                summary_rawnav[['filename', 'index_run_start', 'route', 'wday', 'start_date_time']],
+                on=['filename', 'index_run_start', 'route'],
+                how='left')
+            
+            assert (out_rawnav_dat.groupby(['route', 'filename', 'index_run_start', 'index_loc'])['index_loc'].
+                    count().values.max(initial=0) <= 1)
+            
+            # Column conversion after missing values removed
+            out_rawnav_dat = out_rawnav_dat.assign(
+                route=lambda x: x.route.astype('str'),
+                pattern=lambda x: x.pattern.astype('double')) 
+            
+            write_partitions(writers, 'summary', summary_rawnav, path_summary_rawnav, 
+                             rawnav_summary_schema(), manifest=manifest)
+            write_partitions(writers, 'data', out_rawnav_dat, path_rawnav_data, 
+                             rawnav_data_schema(version=schema_version), manifest=manifest)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    
+    for dataset, path in [('summary', path_summary_rawnav), ('data', path_rawnav_data)]:
+        runs = [runs for writer_key, entry in manifest.items() if writer_key[0] == dataset
+                for runs in entry['runs']]
+        if len(runs) > 0:
+            update_rawnav_manifest(path, pd.concat(runs))
+    
+    rawnav_inventory_filtered_valid = \
+        rawnav_inventory_filtered[~rawnav_inventory_filtered.filename.isin(remove_files)]
+    return rawnav_inventory_filtered_valid
+
+
+def write_partitions(writers, dataset, df, root_path, schema, partition_cols=['route', 'wday'],
+                     manifest=None, row_group_size=2**17):
+    """
+    Parameters
+    ----------
+    writers: dict,
+        open pq.ParquetWriters, keyed on dataset and partition values. Writers for new 
+        partitions are added, and should be closed by the caller.
+    dataset: str,
+        name used to keep writers for different datasets apart
+    df: pd.DataFrame,
+        data to append
+    root_path: str,
+        root directory of the dataset
+    schema: pa.schema,
+        schema for the dataset, including partition columns
+    partition_cols: list,
+        columns to partition on. As with pq.write_to_dataset, these are dropped from the 
+        files and rows with missing values in them are not written. 
+    manifest: dict,
+        if given, rows are deduplicated on their key (see rawnav_key_columns) before being 
+        written, and the path of each new file and the runs written to it are added to 
+        manifest, keyed like writers. Rows of each run are kept together, and the range of
+        rows holding each run is recorded, see read_run. Pass the runs to 
+        update_rawnav_manifest once writers are closed.
+    row_group_size: int,
+        most rows in a parquet row group. Smaller row groups make reading single runs with 
+        read_run faster, at some cost in compression.
+    Returns
+    -------
+    None.
+    """
+    subschema = schema
+    for col in partition_cols:
+        subschema = subschema.remove(subschema.get_field_index(col))
+    
+    if len(df) == 0:
+        return None
+    
+    if manifest is not None:
+        df = df[~df.duplicated(rawnav_key_columns(df.columns), keep='last')]
+    
+    for keys, subgroup in df.groupby(partition_cols):
+        if not isinstance(keys, tuple):
+            keys = (keys,)
+        if manifest is not None:
+            # Runs stay in the order they first appear
+            run_order = subgroup.groupby(['filename', 'index_run_start'], sort = False).ngroup()
+            subgroup = subgroup.iloc[np.argsort(run_order.values, kind = 'stable')]
+        subtable = rawnav_table_from_pandas(subgroup.drop(columns=partition_cols), subschema)
+        writer_key = (dataset,) + keys
+        if writer_key not in writers:
+            subdir = os.path.join(
+                root_path,
+                *['{colname}={value}'.format(colname=name, value=val) 
+                  for name, val in zip(partition_cols, keys)])
+            os.makedirs(subdir, exist_ok=True)
+            path_part = os.path.join(subdir, uuid.uuid4().hex + '.parquet')
+            writers[writer_key] = pq.ParquetWriter(path_part, subtable.schema)
+            if manifest is not None:
+                manifest[writer_key] = {
+                    'part': os.path.relpath(path_part, root_path).replace(os.sep, '/'),
+                    'runs': [],
+                    'n_rows': 0}
+        writers[writer_key].write_table(subtable, row_group_size=row_group_size)
+        
+        if manifest is not None:
+            runs = (
+                subgroup
+                .groupby(['filename', 'index_run_start'], sort = False)
+                .size()
+                .reset_index(name = 'n_rows')
+                .assign(part = manifest[writer_key]['part'],
+                        **{name : str(val) for name, val in zip(partition_cols, keys)}))
+            row_stop = manifest[writer_key]['n_rows'] + runs.n_rows.cumsum()
+            runs['row_start'] = row_stop - runs.n_rows
+            runs['row_stop'] = row_stop
+            manifest[writer_key]['runs'].append(runs)
+            manifest[writer_key]['n_rows'] += len(subgroup)
+    return None
+
+
+def rawnav_key_columns(columns):
+    """
+    Parameters
+    ----------
+    columns: list,
+        columns of rawnav data or rawnav summary data
+    Returns
+    -------
+    key_columns: list,
+        columns identifying a row, filename and index_run_start, plus index_loc for rawnav data
+    """
+    key_columns = ['index_loc', 'filename', 'index_run_start']
+    if 'index_loc' not in columns:
+        key_columns = ['filename', 'index_run_start']
+    return key_columns
+
+
+def update_rawnav_manifest(root_path, manifest_new):
+    """
+    Parameters
+    ----------
+    root_path: str,
+        root directory of a dataset written with write_partitions
+    manifest_new: pd.DataFrame,
+        runs just written, with columns filename, index_run_start, n_rows, part, row_start, 
+        row_stop, and the partition columns. part is the path of the file relative to 
+        root_path, and rows row_start up to row_stop of that file hold the run.
+    Returns
+    -------
+    manifest: pd.DataFrame,
+        manifest saved to _manifest.parquet in root_path
+    Notes
+    -----
+    Entries for files that no longer exist (such as after a route is removed and rewritten)
+    are dropped. Runs in manifest_new are removed from any files written earlier, so that 
+    writing a run again replaces it rather than adding a duplicate.
+    """
+    path_manifest = os.path.join(root_path, '_manifest.parquet')
+    manifest_old = read_rawnav_manifest(root_path)
+    
+    if manifest_old is not None:
+        manifest_old = manifest_old[
+            manifest_old.part.map(lambda x: os.path.isfile(os.path.join(root_path, x)))]
+        
+        new_keys = pd.MultiIndex.from_frame(manifest_new[['filename', 'index_run_start']])
+        replaced = pd.MultiIndex.from_frame(manifest_old[['filename', 'index_run_start']]).isin(new_keys)
+        
+        for part in manifest_old.part[replaced].unique():
+            path_part = os.path.join(root_path, part)
+            table_part = pq.read_table(path_part)
+            keep_rows = ~pd.MultiIndex.from_arrays([
+                table_part.column('filename').to_pandas().astype(str),
+                table_part.column('index_run_start').to_pandas().astype('int64')]).isin(new_keys)
+            if keep_rows.any():
+                pq.write_table(table_part.filter(pa.array(keep_rows)), path_part + '.tmp')
+                os.replace(path_part + '.tmp', path_part)
+            else:
+                os.remove(path_part)
+        
+        manifest_old = manifest_old[~replaced]
+        if ('row_start' in manifest_old.columns) and replaced.any():
+            # Rows of remaining runs move up in files that were rewritten
+            manifest_old = manifest_old.sort_values(['part', 'row_start'], kind = 'mergesort')
+            manifest_old['row_stop'] = manifest_old.groupby('part')['n_rows'].cumsum()
+            manifest_old['row_start'] = manifest_old.row_stop - manifest_old.n_rows
+        manifest = pd.concat([manifest_old, manifest_new], ignore_index=True)
+    else:
+        manifest = manifest_new.reset_index(drop=True)
+    
+    manifest = manifest.astype({'filename': str, 'index_run_start': 'int64', 'n_rows': 'int64'})
+    if manifest.columns.isin(['row_start', 'row_stop']).sum() == 2:
+        manifest = manifest.astype({'row_start': 'int64', 'row_stop': 'int64'})
+    manifest.to_parquet(path_manifest + '.tmp', index=False)
+    os.replace(path_manifest + '.tmp', path_manifest)
+    return manifest
+
+
+def read_rawnav_manifest(root_path):
+    """
+    Parameters
+    ----------
+    root_path: str,
+        root directory of a dataset written with write_partitions
+    Returns
+    -------
+    manifest: pd.DataFrame,
+        runs in each file of the dataset, see update_rawnav_manifest. None if the dataset has
+        no manifest.
+    """
+    path_manifest = os.path.join(root_path, '_manifest.parquet')
+    if not os.path.isfile(path_manifest):
+        return None
+    return pd.read_parquet(path_manifest)
+
+
+def check_rawnav_manifest_unique(root_path, analysis_routes_, analysis_days_):
+    """
+    Parameters
+    ----------
+    root_path: str,
+        root directory of a dataset partitioned on route and wday
+    analysis_routes_: list,
+        routes to check
+    analysis_days_: list,
+        days of the week to check
+    Returns
+    -------
+    bool,
+        True if the manifest lists every file in these partitions and no run is in more 
+        than one, so that rows are unique without deduplicating.
+    """
+    manifest = read_rawnav_manifest(root_path)
+    if manifest is None:
+        return False
+    
+    parts = []
+    for route, day in product(analysis_routes_, analysis_days_):
+        subdir = 'route={}/wday={}'.format(route, day)
+        if os.path.isdir(os.path.join(root_path, subdir)):
+            parts += [subdir + '/' + file for file in os.listdir(os.path.join(root_path, subdir))
+                      if not file.startswith(('.', '_'))]
+    
+    manifest = manifest[manifest.part.isin(parts)]
+    return (set(parts).issubset(set(manifest.part)) 
+            and not manifest.duplicated(['filename', 'index_run_start']).any())
+
+
+def read_run(path, filename, index_run_start, columns=None):
+    """
+    Parameters
+    ----------
+    path: str,
+        path where the parquet files for cleaned data are kept, ala rawnav_data.parquet
+    filename: str,
+        rawnav file of the run, ala rawnav06435191012.txt
+    index_run_start: int,
+        index_run_start of the run
+    columns: list,
+        columns to read, default None reads all columns
+    Returns
+    -------
+    rawnav_run: pd.DataFrame,
+        rows of the run, with the route and wday columns
+    Notes
+    -----
+    Uses the manifest to read only the row groups holding the run. Datasets without a 
+    manifest, or written before row ranges were recorded, are read with a filter instead.
+    """
+    if columns is not None:
+        columns = [col for col in ll.check_convert_list(columns) if col not in ['route', 'wday']]
+    
+    manifest = read_rawnav_manifest(path)
+    if (manifest is None) or ('row_start' not in manifest.columns):
+        if columns is not None:
+            columns = columns + ['route', 'wday']
+        rawnav_run = (
+            pq.read_table(source=path,
+                          columns=columns,
+                          filters=[('filename', '=', filename), 
+                                   ('index_run_start', '=', index_run_start)])
+            .to_pandas())
+    else:
+        entry = manifest[(manifest.filename == filename) 
+                         & (manifest.index_run_start == index_run_start)]
+        if len(entry) == 0:
+            raise ValueError('Run {} {} not found in manifest'.format(filename, index_run_start))
+        entry = entry.iloc[-1]
+        
+        parquet_file = pq.ParquetFile(os.path.join(path, entry.part))
+        row_group_rows = [parquet_file.metadata.row_group(i).num_rows 
+                          for i in range(parquet_file.num_row_groups)]
+        row_group_stop = np.cumsum(row_group_rows)
+        row_group_start = row_group_stop - row_group_rows
+        row_groups = np.flatnonzero((row_group_start < entry.row_stop) 
+                                    & (row_group_stop > entry.row_start))
+        
+        rawnav_run = (
+            parquet_file
+            .read_row_groups(row_groups, columns=columns)
+            .slice(entry.row_start - row_group_start[row_groups[0]], entry.n_rows)
+            .to_pandas())
+        rawnav_run = rawnav_run.assign(route=entry.route, wday=entry.wday)
+    
+    for col in rawnav_run.columns:
+        if pd.api.types.is_categorical_dtype(rawnav_run[col]):
+            rawnav_run[col] = rawnav_run[col].astype(object)
+    return rawnav_run
+
+
+def write_rawnav_dataset(df, root_path, schema, partition_cols=['route', 'wday']):
+    """
+    Parameters
+    ----------
+    df: pd.DataFrame,
+        data to write
+    root_path: str,
+        root directory of the dataset
+    schema: pa.schema,
+        schema for the dataset, including partition columns, such as from rawnav_data_schema
+    partition_cols: list,
+        columns to partition on
+    Returns
+    -------
+    None.
+    Notes
+    -----
+    Same as pq.write_to_dataset, but also handles dictionary encoded columns, see 
+    rawnav_table_from_pandas, and keeps a manifest of the runs in each file, see 
+    update_rawnav_manifest. Rows are deduplicated on their run key when written, 
+    so read_cleaned_rawnav doesn't need to.
+    """
+    writers = {}
+    manifest = {}
+    try:
+        write_partitions(writers, 'data', df, root_path, schema, partition_cols=partition_cols,
+                         manifest=manifest)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    
+    if len(manifest) > 0:
+        update_rawnav_manifest(root_path, pd.concat([runs for entry in manifest.values() 
+                                                     for runs in entry['runs']]))
+    return None
+
+
+def rawnav_table_from_pandas(df, schema):
+    """
+    Parameters
+    ----------
+    df: pd.DataFrame,
+        data with at least the columns in schema
+    schema: pa.schema,
+        such as from rawnav_data_schema or rawnav_summary_schema
+    Returns
+    -------
+    table: pa.Table,
+        df converted to schema, without the index
+    Notes
+    -----
+    pa.Table.from_pandas doesn't convert strings to dictionary types, so when the schema
+    has any, columns are converted one at a time. Casts are safe, so that for instance a 
+    float column with fractional values raises an error rather than being truncated to an 
+    integer. Missing values are stored as nulls. When the schema has x_ft and y_ft columns
+    that df doesn't, they're projected from lat and long.
+    """
+    if set(['x_ft', 'y_ft']).issubset(schema.names) and not set(['x_ft', 'y_ft']).issubset(df.columns):
+        df = ll.add_projected_xy(df)
+    
+    if not any(pa.types.is_dictionary(field.type) for field in schema):
+        return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    
+    arrays = []
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            array = (
+                pa.array(df[field.name], type=field.type.value_type, from_pandas=True)
+                .dictionary_encode())
+        else:
+            array = pa.array(df[field.name], from_pandas=True).cast(field.type, safe=True)
+        arrays.append(array)
+    table = pa.Table.from_arrays(arrays, schema=schema)
+    return table
+
+
+# Rawnav data columns read in by the analysis scripts, other columns (blank, lat_raw, long_raw,
+# sat_cnt) aren't used. Pass to read_cleaned_rawnav as columns, adding x_ft and y_ft where the 
+# projected coordinates are needed.
+rawnav_data_cols = ['index_loc', 'lat', 'long', 'heading', 'door_state', 'veh_state', 'odom_ft', 
+                    'sec_past_st', 'stop_window', 'row_before_apc', 'route_pattern', 'pattern',
+                    'index_run_start', 'index_run_end', 'filename', 'start_date_time']
+
+def rawnav_data_schema(version=1):
+    """
+    Parameters
+    ----------
+    version: int,
+        1 stores most columns as float64 or string. 2 is more compact, using 32-bit integers
+        for keys, counts, and odometer/time values, float32 for heading and blank, booleans for
+        row_before_apc, and dictionary encoding for repeated strings. Missing integers are 
+        stored as nulls. lat/long stay float64 to keep their precision. 3 is 2 with the 
+        columns x_ft and y_ft, the coordinates projected to EPSG:2248, added on write if 
+        missing (see ll.add_projected_xy). The default is 1.
     Returns
     -------
     rawnav_data_schema: pa.schema,
       a schema for rawnav data, put here to keep code a bit tidier
     """
+    assert (version in [1, 2, 3]), print("version must be 1, 2 or 3")
+    
+    if version in [2, 3]:
+        string_dictionary = pa.dictionary(pa.int32(), pa.string())
+        # route and wday are partition columns and aren't stored in the files, so are left as
+        # strings to avoid partitioning on categories
+        rawnav_data_schema = pa.schema([
+            pa.field('index_loc', pa.int32()),
+            pa.field('lat', pa.float64()),
+            pa.field('long', pa.float64()),
+            pa.field('heading', pa.float32()),
+            pa.field('door_state', string_dictionary),
+            pa.field('veh_state', string_dictionary),
+            pa.field('odom_ft', pa.int32()),
+            pa.field('sec_past_st', pa.int32()),
+            pa.field('sat_cnt', pa.int16()),
+            pa.field('stop_window', string_dictionary),
+            pa.field('blank', pa.float32()),
+            pa.field('lat_raw', pa.float64()),
+            pa.field('long_raw',pa.float64()),
+            pa.field('row_before_apc', pa.bool_()),
+            pa.field('route_pattern', string_dictionary),
+            pa.field('route', pa.string()),
+            pa.field('pattern', pa.int32()),
+            pa.field('index_run_start', pa.int32()),
+            pa.field('index_run_end', pa.int32()),
+            pa.field('filename', string_dictionary),
+            pa.field('wday', pa.string()),
+            pa.field('start_date_time', pa.timestamp('us'))
+        ])
+        if version == 3:
+            rawnav_data_schema = (
+                rawnav_data_schema
+                .append(pa.field('x_ft', pa.float64()))
+                .append(pa.field('y_ft', pa.float64()))
+            )
+        return rawnav_data_schema
     
     rawnav_data_schema = pa.schema([
         pa.field('index_loc', pa.float64()),